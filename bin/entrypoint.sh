@@ -34,6 +34,18 @@ fi
 if [ -n "$CEPH_MGR_SERVICE" ]; then
   echo "\$USER10\$=${CEPH_MGR_SERVICE}" >> ${NAGIOS_HOME}/etc/resource.cfg
 fi
+if [ -n "$SNMP_NOTIF_SOCKET" ]; then
+  echo "\$USER12\$=${SNMP_NOTIF_SOCKET}" >> ${NAGIOS_HOME}/etc/resource.cfg
+fi
+if [ -n "$NOTIF_SUPPRESSOR_STATE_FILE" ]; then
+  echo "\$USER13\$=${NOTIF_SUPPRESSOR_STATE_FILE}" >> ${NAGIOS_HOME}/etc/resource.cfg
+fi
+if [ -n "$CHECK_SERVER_SOCKET" ]; then
+  echo "\$USER14\$=${CHECK_SERVER_SOCKET}" >> ${NAGIOS_HOME}/etc/resource.cfg
+fi
+if [ -n "$REST_NOTIF_SPOOL_FILE" ]; then
+  echo "\$USER11\$=${REST_NOTIF_SPOOL_FILE}" >> ${NAGIOS_HOME}/etc/resource.cfg
+fi
 
 touch ${NAGIOS_HOME}/etc/objects/prometheus_discovery_objects.cfg
 chown nagios ${NAGIOS_HOME}/etc/objects/prometheus_discovery_objects.cfg
@@ -42,6 +54,37 @@ sed -i -e 's/APACHE_FRONTEND_PORT/'${APACHE_FRONTEND_PORT}'/' /etc/apache2/ports
 sed -i -e 's/APACHE_FRONTEND_SECURE_PORT/'${APACHE_FRONTEND_SECURE_PORT}'/' /etc/apache2/ports.conf
 
 /etc/init.d/apache2 restart
+
+# the resident sender and the delivery worker send the summaries of
+# coalesced notifications once their window is over
+SUPPRESSOR_ARGS=""
+if [ -n "$NOTIF_SUPPRESSOR_STATE_FILE" ]; then
+  SUPPRESSOR_ARGS="--suppress_state_file ${NOTIF_SUPPRESSOR_STATE_FILE}"
+fi
+if [ -n "$SNMP_NOTIF_SOCKET" ]; then
+  su -s /bin/sh nagios -c "${NAGIOS_PLUGIN_DIR}/send_snmp_trap.py --serve --socket ${SNMP_NOTIF_SOCKET} ${SUPPRESSOR_ARGS}" &
+fi
+if [ -n "$CHECK_SERVER_SOCKET" ]; then
+  su -s /bin/sh nagios -c "${NAGIOS_PLUGIN_DIR}/check_server.py --socket ${CHECK_SERVER_SOCKET}" &
+fi
+if [ -n "$REST_NOTIF_SPOOL_FILE" ]; then
+  # the spool is written by the event handlers running as nagios
+  su -s /bin/sh nagios -c "${NAGIOS_PLUGIN_DIR}/deliver_http_post_events.py --spool_file ${REST_NOTIF_SPOOL_FILE} ${SUPPRESSOR_ARGS} -d" &
+fi
 /etc/init.d/nagios stop
 
-/opt/nagios/bin/nagios /opt/nagios/etc/nagios.cfg
+if [ "$NAGIOS_PRECACHE_OBJECTS" = "true" ]; then
+  # the pre-flight checks of discovery reloads run as nagios and rewrite
+  # the precached objects file, so it is not left to root here
+  PRECACHED_OBJECT_FILE=$(sed -n 's/^precached_object_file=//p' /opt/nagios/etc/nagios.cfg)
+  if [ -n "$PRECACHED_OBJECT_FILE" ] && [ -e "$PRECACHED_OBJECT_FILE" ]; then
+    chown nagios "$PRECACHED_OBJECT_FILE"
+  fi
+fi
+if [ "$NAGIOS_PRECACHE_OBJECTS" = "true" ] && su -s /bin/sh nagios -c "/opt/nagios/bin/nagios -pv /opt/nagios/etc/nagios.cfg" > /dev/null; then
+  # read the precached objects written by the pre-flight check, also on
+  # reloads triggered by check_update_prometheus_hosts.py --precache_objects
+  /opt/nagios/bin/nagios -u /opt/nagios/etc/nagios.cfg
+else
+  /opt/nagios/bin/nagios /opt/nagios/etc/nagios.cfg
+fi
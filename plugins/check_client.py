@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+# Copyright 2017 The Openstack-Helm Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# Runs a check plugin in check_server.py, with the output and exit code the
+# plugin has when run by itself.
+# Examples:
+# /opt/nagios/libexec/check_client.py --socket $USER14$
+#                      query_prometheus_alerts.py
+#                      --prometheus_api $USER2$
+#                      --alertname 'node_load_high'
+#                      --msg_format 'load is high on {instance}'
+# The plugin is run by itself when no server listens on the socket, or the
+# server does not serve it. Only modules loaded by the interpreter anyway
+# are imported here.
+import json
+import os
+import socket
+import sys
+
+STATE_UNKNOWN = 3
+
+# longer than the default check_server.py --check_timeout
+SERVER_TIMEOUT_SECONDS = 60
+
+PLUGIN_DIR = os.path.dirname(os.path.abspath(__file__))
+USAGE = "usage: check_client.py [--socket socket] plugin [argument ...]\n"
+
+
+def run_in_server(socket_path, plugin, argv):
+    """return the response of the server, None if it does not run the
+    plugin"""
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    client.settimeout(SERVER_TIMEOUT_SECONDS)
+    try:
+        try:
+            client.connect(socket_path)
+        except socket.error:
+            return None
+        client.sendall(json.dumps({'plugin': plugin, 'argv': argv}).encode(
+            'utf-8'))
+        client.shutdown(socket.SHUT_WR)
+        chunks = []
+        while True:
+            chunk = client.recv(65536)
+            if not chunk:
+                break
+            chunks.append(chunk)
+    finally:
+        client.close()
+    response = json.loads(b''.join(chunks).decode('utf-8'))
+    return response if response['served'] else None
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    socket_path = None
+    if argv[:1] == ['--socket'] and len(argv) > 1:
+        socket_path, argv = argv[1], argv[2:]
+    if not argv:
+        sys.stderr.write(USAGE)
+        return STATE_UNKNOWN
+    plugin, plugin_argv = os.path.basename(argv[0]), argv[1:]
+
+    if socket_path:
+        try:
+            response = run_in_server(socket_path, plugin, plugin_argv)
+        except (socket.error, ValueError, KeyError) as e:
+            # the check may have run, so it is not run again
+            print("UNKNOWN: check server failed to run {}. {}".format(
+                plugin, str(e)))
+            return STATE_UNKNOWN
+        if response is not None:
+            sys.stdout.write(response['stdout'])
+            sys.stderr.write(response['stderr'])
+            return response['code']
+
+    path = os.path.join(PLUGIN_DIR, plugin)
+    try:
+        os.execv(path, [path] + plugin_argv)
+    except OSError as e:
+        print("UNKNOWN: unable to run {}. {}".format(path, str(e)))
+        return STATE_UNKNOWN
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -15,19 +15,58 @@
 # Examples:
 # /usr/lib/nagios/plugins/check_exporter_health_metric.py --exporter_api 172.17.0.1:9100/metrics --health_metric go_info --critical 2 --warning 1
 # Output:
-# Warning: go_info metric is a warning value of 1(go_info{version="go1.9.1"})
+# Warning: go_info metric is a warning value of 1.0(go_info{version="go1.9.1"})
+# --health_metric is the exact name of a metric family, and the check is
+# UNKNOWN when the scrape has no samples of it.
+#
+# Many rules can be evaluated from a single scrape with --rules_file:
+# /usr/lib/nagios/plugins/check_exporter_health_metric.py --exporter_api 172.17.0.1:9283/metrics --rules_file /opt/nagios/etc/ceph_exporter_rules.json
+# where the rules file holds a list of:
+#    {
+#        "service_description": "CEPH_health",
+#        "health_metric": "ceph_health_status",
+#        "labels": {"cluster": "ceph"},
+#        "critical": 2,
+#        "warning": 1
+#    }
+# labels and warning are optional. One result line per rule is printed
+# after a summary line, or with --command_file and --host_name each rule is
+# submitted as a passive result for its service_description.
+#
+# With --cache_ttl the whole scrape is parsed once into a cache shared by
+# every check of the same exporter url until it expires.
 import argparse
+import hashlib
+import json
+import os
+import socket
 import sys
+import tempfile
+import time
+import zlib
 import requests
-import re
+
+from nagiosutil import NagiosUtil
+from prometheus_exposition import Sample
+from prometheus_exposition import iter_samples
+from snapshot_cache import load_snapshot
 
 STATE_OK = 0
 STATE_WARNING = 1
 STATE_CRITICAL = 2
 STATE_UNKNOWN = 3
 
+# order of severity when several results are combined into one
+STATE_SEVERITY = [STATE_OK, STATE_UNKNOWN, STATE_WARNING, STATE_CRITICAL]
+STATE_NAMES = {STATE_OK: 'OK', STATE_WARNING: 'WARNING',
+               STATE_CRITICAL: 'CRITICAL', STATE_UNKNOWN: 'UNKNOWN'}
+
+SCRAPE_CHUNK_BYTES = 65536
+DEFAULT_TIMEOUT_SECONDS = 10
+DEFAULT_MAX_BYTES = 32 * 1024 * 1024
+
 
-def main():
+def main(argv=None):
     parser = argparse.ArgumentParser(
         description='Nagios plugin to query prometheus exporter and monitor metrics')
     parser.add_argument(
@@ -38,65 +77,275 @@ def main():
         help='exporter location with scheme and port')
     parser.add_argument('--health_metric', metavar='--health_metric', type=str,
                         required=False, default="health_status",
-                        help='Name of health metric')
+                        help='Metric family name of the health metric')
     parser.add_argument('--critical', metavar='--critical', type=int,
-                        required=True,
-                        help='Value to alert critical')
+                        required=False,
+                        help='Value to alert critical. Required without --rules_file')
     parser.add_argument('--warning', metavar='--warning', type=int,
                         required=False,
                         help='Value to alert warning')
+    parser.add_argument('--timeout', metavar='--timeout', type=float,
+                        required=False, default=DEFAULT_TIMEOUT_SECONDS,
+                        help='Seconds allowed for the whole scrape')
+    parser.add_argument('--max_bytes', metavar='--max_bytes', type=int,
+                        required=False, default=DEFAULT_MAX_BYTES,
+                        help='Largest uncompressed scrape to read, 0 for no limit')
+    parser.add_argument('--cache_ttl', metavar='--cache_ttl', type=int,
+                        required=False, default=0,
+                        help='Seconds to share the parsed scrape of an exporter between checks. 0 disables the cache.')
+    parser.add_argument('--cache_dir', metavar='--cache_dir', type=str,
+                        required=False,
+                        help='Directory of the scrape cache. Defaults to the temp directory.')
+    parser.add_argument('--rules_file', metavar='--rules_file', type=str,
+                        required=False,
+                        help='JSON list of rules evaluated from a single scrape. See examples.')
+    parser.add_argument('--command_file', metavar='--command_file', type=str,
+                        required=False,
+                        help='With --rules_file, submit each rule as a passive result to this Nagios command file')
+    parser.add_argument('--host_name', metavar='--host_name', type=str,
+                        required=False,
+                        help='With --command_file, Nagios host of the passive results')
+
+    args = parser.parse_args(argv)
+    if args.rules_file:
+        if args.command_file and not args.host_name:
+            parser.error('--host_name is required with --command_file')
+        evaluate_rules_file(args)
+    if args.critical is None:
+        parser.error('--critical is required without --rules_file')
 
-    args = parser.parse_args()
     metrics, error_messages = query_exporter_metric(
-        args.exporter_api, args.health_metric)
+        args.exporter_api, args.health_metric, args.timeout, args.max_bytes,
+        args.cache_ttl, args.cache_dir)
     if error_messages:
         print(
             "Unknown: unable to query metrics. {}".format(
                 ",".join(error_messages)))
         sys.exit(STATE_UNKNOWN)
 
+    state, output = evaluate_metric(
+        args.health_metric, metrics, args.critical, args.warning)
+    print(output)
+    sys.exit(state)
+
+
+def evaluate_metric(metric_name, metrics, critical, warning):
+    """return (state, output) for the {series: value} samples of a metric,
+    UNKNOWN when there are none"""
+    if not metrics:
+        return STATE_UNKNOWN, "Unknown: no {metric_name} samples in the exporter scrape".format(
+            metric_name=metric_name)
     criticalMessages = []
     warningMessages = []
-    for key, value in metrics.iteritems():
-        if value == args.critical:
+    for key, value in metrics.items():
+        if value == critical:
             criticalMessages.append(
                 "Critical: {metric_name} metric is a critical value of {metric_value}({detail})".format(
-                    metric_name=args.health_metric, metric_value=value, detail=key))
-        elif args.warning and value == args.warning:
+                    metric_name=metric_name, metric_value=value, detail=key))
+        elif warning and value == warning:
             warningMessages.append(
                 "Warning: {metric_name} metric is a warning value of {metric_value}({detail})".format(
-                    metric_name=args.health_metric, metric_value=value, detail=key))
+                    metric_name=metric_name, metric_value=value, detail=key))
 
     if criticalMessages:
-        print(",".join(criticalMessages))
-        sys.exit(STATE_CRITICAL)
+        return STATE_CRITICAL, ",".join(criticalMessages)
     elif warningMessages:
-        print(",".join(warningMessages))
-        sys.exit(STATE_WARNING)
+        return STATE_WARNING, ",".join(warningMessages)
     else:
-        print("OK: {metric_name} metric has a OK value({detail})".format(
-            metric_name=args.health_metric, detail=str(metrics)))
+        return STATE_OK, "OK: {metric_name} metric has a OK value({detail})".format(
+            metric_name=metric_name, detail=str(metrics))
+
+
+def evaluate_rules_file(args):
+    try:
+        with open(args.rules_file, 'r') as rules_json:
+            rules = json.load(rules_json)
+        for rule in rules:
+            if not rule.get('health_metric') or rule.get('critical') is None:
+                raise ValueError(
+                    "health_metric and critical are required in rule {}".format(rule))
+            if args.command_file and not rule.get('service_description'):
+                raise ValueError(
+                    "service_description is required in rule {} with --command_file".format(rule))
+    except Exception as e:
+        print("Unknown: unable to load rules. {}".format(str(e)))
+        sys.exit(STATE_UNKNOWN)
+
+    samples, error_messages = query_exporter_samples(
+        args.exporter_api, set(rule['health_metric'] for rule in rules),
+        args.timeout, args.max_bytes, args.cache_ttl, args.cache_dir)
+    results = []
+    for rule in rules:
+        if error_messages:
+            results.append((STATE_UNKNOWN, "Unknown: unable to query metrics. {}".format(
+                ",".join(error_messages))))
+            continue
+        labels = rule.get('labels') or {}
+        metrics = dict(
+            (sample.series, sample.value) for sample in samples
+            if sample.family == rule['health_metric'] and
+            all(sample.labels.get(name) == value
+                for name, value in labels.items()))
+        results.append(evaluate_metric(
+            rule['health_metric'], metrics, rule['critical'], rule.get('warning')))
+
+    if args.command_file:
+        try:
+            submitted = NagiosUtil.submit_service_check_results(
+                args.command_file,
+                [(args.host_name, rule['service_description'], state, output)
+                 for rule, (state, output) in zip(rules, results)])
+        except Exception as e:
+            print("Unknown: unable to submit rule results. {}".format(str(e)))
+            sys.exit(STATE_UNKNOWN)
+        if error_messages:
+            print("Unknown: unable to query metrics. {}".format(
+                ",".join(error_messages)))
+            sys.exit(STATE_UNKNOWN)
+        print("OK: submitted {} exporter rule results".format(submitted))
         sys.exit(STATE_OK)
 
+    worst = max([state for state, output in results] or [STATE_OK],
+                key=STATE_SEVERITY.index)
+    failing = len([state for state, output in results if state != STATE_OK])
+    print("{}: {} of {} exporter rules are not OK".format(
+        STATE_NAMES[worst], failing, len(results)))
+    for rule, (state, output) in zip(rules, results):
+        print("{}: {}".format(
+            rule.get('service_description', rule['health_metric']), output))
+    sys.exit(worst)
+
+
+def query_exporter_metric(exporter_api, metric_name,
+                          timeout=DEFAULT_TIMEOUT_SECONDS,
+                          max_bytes=DEFAULT_MAX_BYTES, cache_ttl=0,
+                          cache_dir=None):
+    samples, error_messages = query_exporter_samples(
+        exporter_api, [metric_name], timeout, max_bytes, cache_ttl, cache_dir)
+    metrics = dict((sample.series, sample.value) for sample in samples)
+    return metrics, error_messages
+
+
+def query_exporter_samples(exporter_api, metric_names,
+                           timeout=DEFAULT_TIMEOUT_SECONDS,
+                           max_bytes=DEFAULT_MAX_BYTES, cache_ttl=0,
+                           cache_dir=None):
+    """return the samples of every metric family in metric_names, from the
+    shared scrape cache when cache_ttl is set"""
+    if cache_ttl <= 0:
+        return scrape_exporter(exporter_api, metric_names, timeout, max_bytes)
+
+    url = include_schema(exporter_api)
+    cache_file = os.path.join(
+        cache_dir or tempfile.gettempdir(),
+        'exporter_samples_{}.json'.format(
+            hashlib.sha1(url.encode('utf-8')).hexdigest()[:12]))
 
-def query_exporter_metric(exporter_api, metric_name):
+    def scrape_all_families():
+        samples, error_messages = scrape_exporter(
+            exporter_api, None, timeout, max_bytes)
+        return [list(sample) for sample in samples], error_messages
+
+    try:
+        cached_samples, error_messages = load_snapshot(
+            cache_file, cache_ttl, scrape_all_families)
+    except Exception as e:
+        return [], ["ERROR using exporter scrape cache {}: {}".format(
+            cache_file, str(e))]
+    if error_messages:
+        return [], error_messages
+    metric_names = set(metric_names)
+    return [Sample(*sample) for sample in cached_samples
+            if sample[0] in metric_names], []
+
+
+def scrape_exporter(exporter_api, metric_names, timeout, max_bytes):
+    """scrape the exporter once, gzip compressed, within timeout seconds and
+    max_bytes of uncompressed exposition, and return the samples of every
+    metric family in metric_names (all families if None)"""
     error_messages = []
-    metrics = dict()
+    samples = []
     try:
-        response = requests.get(include_schema(exporter_api), verify=False)  # nosec
-        line_item_metrics = re.findall(
-            "^{}.*".format(metric_name),
-            response.text,
-            re.MULTILINE)
-        for metric in line_item_metrics:
-            metric_with_labels, value = metric.split(" ")
-            metrics[metric_with_labels] = float(value)
+        deadline = time.time() + timeout
+        response = requests.get(include_schema(exporter_api), verify=False,  # nosec
+                                stream=True, timeout=timeout,
+                                headers={'Accept': 'text/plain',
+                                         'Accept-Encoding': 'gzip'})
+        try:
+            # closing the response once the families are read stops the download
+            samples = list(iter_samples(
+                bounded_lines(response, deadline, max_bytes), metric_names))
+        finally:
+            response.close()
     except Exception as e:
         error_messages.append(
             "ERROR retrieving ceph exporter api {}".format(
                 str(e)))
 
-    return metrics, error_messages
+    return samples, error_messages
+
+
+def bounded_lines(response, deadline, max_bytes):
+    """iterate the decompressed lines of response, failing once the deadline
+    passes or more than max_bytes have been read. the limits are checked on
+    every chunk read from the connection, not per line, so a body without
+    newlines or one trickling in can not run past them"""
+    read_bytes = 0
+    pending = []
+    for chunk in read_chunks(response, deadline):
+        read_bytes += len(chunk)
+        if max_bytes and read_bytes > max_bytes:
+            raise ValueError(
+                "exporter response is larger than {} bytes".format(max_bytes))
+        lines = chunk.split(b'\n')
+        if len(lines) > 1:
+            yield b''.join(pending + lines[:1])
+            for line in lines[1:-1]:
+                yield line
+            pending = []
+        pending.append(lines[-1])
+    if any(pending):
+        yield b''.join(pending)
+
+
+def read_chunks(response, deadline):
+    """iterate the decompressed chunks of the body of response, each read
+    from the connection limited to the time left until the deadline.
+    the body is read from the http.client response under urllib3, whose
+    read waits for a whole chunk before urllib3 2.0"""
+    body = response.raw._fp
+    # read1 returns what has arrived, the python 2 httplib response only
+    # has read
+    read = getattr(body, 'read1', None) or body.read
+    sock = getattr(response.raw.connection, 'sock', None)
+    decoder = None
+    if response.headers.get('Content-Encoding', '').lower() == 'gzip':
+        decoder = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    while True:
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            raise ValueError(
+                "exporter response took longer than the timeout")
+        if sock is not None:
+            sock.settimeout(remaining)
+        try:
+            chunk = read(SCRAPE_CHUNK_BYTES)
+        except socket.timeout:
+            raise ValueError(
+                "exporter response took longer than the timeout")
+        if not chunk:
+            break
+        if decoder is None:
+            yield chunk
+            continue
+        # decompressed a chunk at a time, so max_bytes also bounds the
+        # memory of a highly compressed body
+        yield decoder.decompress(chunk, SCRAPE_CHUNK_BYTES)
+        while decoder.unconsumed_tail:
+            yield decoder.decompress(decoder.unconsumed_tail,
+                                     SCRAPE_CHUNK_BYTES)
+    if decoder is not None:
+        yield decoder.flush()
 
 
 def include_schema(api):
@@ -0,0 +1,232 @@
+#!/usr/bin/env python
+# Copyright 2017 The Openstack-Helm Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# check_prometheus_metric.py - Nagios plugin checking a Prometheus query
+# result against thresholds, with the options and output of
+# check_prometheus_metric.sh but a single in-process HTTP request.
+# Examples:
+# /usr/lib/nagios/plugins/check_prometheus_metric.py
+#                      -H http://prom-metrics.openstack.svc.cluster.local:9090
+#                      -q 'node_load1' -w 8 -c 16 -n 'load' -t vector -i
+# In vector mode every series of the result is compared, the status is the
+# worst of them and the output names how many series are over the levels.
+import argparse
+import math
+import operator
+import sys
+
+import requests
+
+STATE_OK = 0
+STATE_WARNING = 1
+STATE_CRITICAL = 2
+STATE_UNKNOWN = 3
+
+STATE_SEVERITY = [STATE_OK, STATE_UNKNOWN, STATE_WARNING, STATE_CRITICAL]
+STATE_NAMES = {STATE_OK: 'OK', STATE_WARNING: 'WARNING',
+               STATE_CRITICAL: 'CRITICAL', STATE_UNKNOWN: 'UNKNOWN'}
+
+COMPARISON_METHODS = {'gt': operator.gt, 'ge': operator.ge,
+                      'lt': operator.lt, 'le': operator.le,
+                      'eq': operator.eq, 'ne': operator.ne}
+
+QUERY_TIMEOUT_SECONDS = 30
+
+USAGE = """
+  check_prometheus_metric.py - Nagios plugin wrapper for checking Prometheus
+                               metrics.
+
+  Usage:
+  check_prometheus_metric.py -H HOST -q QUERY -w INT -c INT -n NAME [-m METHOD] [-O] [-i] [-t QUERY_TYPE]
+
+  options:
+    -H HOST          URL of Prometheus host to query.
+    -q QUERY         Prometheus query, in single quotes, that returns by default a float or int (see -t).
+    -w INT           Warning level value (must be zero or positive).
+    -c INT           Critical level value (must be zero or positive).
+    -n NAME          A name for the metric being checked.
+    -m METHOD        Comparison method, one of gt, ge, lt, le, eq, ne.
+                     (Defaults to ge unless otherwise specified.)
+    -C CURL_OPTS     Accepted for compatibility, only -k/--insecure is used.
+    -O               Accept NaN as an "OK" result .
+    -i               Print the extra metric information into the Nagios message.
+    -t QUERY_TYPE    Prometheus query return type: scalar (default) or vector.
+                     Every element of the vector is checked.
+"""
+
+
+class UsageError(Exception):
+    pass
+
+
+class ArgumentParser(argparse.ArgumentParser):
+    """reports usage errors as an UNKNOWN check result"""
+
+    def error(self, message):
+        raise UsageError(message)
+
+
+def level(value):
+    if not value.isdigit():
+        raise argparse.ArgumentTypeError('requires an integer')
+    return int(value)
+
+
+def parse_args(argv=None):
+    parser = ArgumentParser(add_help=False)
+    parser.add_argument('-H', dest='prometheus_server')
+    parser.add_argument('-q', dest='query')
+    parser.add_argument('-w', dest='warning_level', type=level)
+    parser.add_argument('-c', dest='critical_level', type=level)
+    parser.add_argument('-n', dest='metric_name')
+    parser.add_argument('-m', dest='comparison_method', default='ge',
+                        choices=sorted(COMPARISON_METHODS))
+    parser.add_argument('-C', dest='curl_opts', default='')
+    parser.add_argument('-O', dest='nan_ok', action='store_true')
+    parser.add_argument('-i', dest='nagios_info', action='store_true')
+    parser.add_argument('-t', dest='query_type', default='scalar',
+                        choices=['scalar', 'vector'])
+    parser.add_argument('--timeout', type=float,
+                        default=QUERY_TIMEOUT_SECONDS)
+    args = parser.parse_args(argv)
+    if None in (args.prometheus_server, args.query, args.metric_name,
+                args.warning_level, args.critical_level):
+        raise UsageError('missing required option')
+    return args
+
+
+def include_schema(api):
+    if api.startswith("http://") or api.startswith("https://"):
+        return api
+    return "http://{}".format(api)
+
+
+def query_prometheus(args):
+    """return the result of the instant query, raising on errors"""
+    curl_opts = args.curl_opts.split()
+    response = requests.get(
+        include_schema(args.prometheus_server) + '/api/v1/query',
+        params={'query': args.query}, timeout=args.timeout,
+        verify=not ('-k' in curl_opts or '--insecure' in curl_opts))
+    response.raise_for_status()
+    data = response.json()['data']
+    if data['resultType'] == 'scalar':
+        return [{'metric': {}, 'value': data['result']}]
+    return data['result']
+
+
+def to_number(value):
+    """float of a prometheus sample value, None if it is not a number"""
+    try:
+        number = float(value)
+    except (TypeError, ValueError):
+        return None
+    return None if math.isnan(number) else number
+
+
+def format_metric(metric):
+    """metric labels printed as jq and xargs printed them"""
+    return '{ ' + ', '.join('{}: {}'.format(name, value)
+                            for name, value in sorted(metric.items())) + ' }'
+
+
+def get_scalar_value(args, value):
+    """the first sample value rounded to an integer, +Inf above both levels
+    and -Inf below any level, or the value as text if it is no number"""
+    if value == '+Inf':
+        return args.warning_level + args.critical_level
+    if value == '-Inf':
+        return -1
+    number = to_number(value)
+    if number is None:
+        return value
+    return int('%.0f' % number)
+
+
+def compare(args, values):
+    """return the state of every value, in one pass per level"""
+    method = COMPARISON_METHODS[args.comparison_method]
+    critical = map(method, values, [args.critical_level] * len(values))
+    warning = map(method, values, [args.warning_level] * len(values))
+    return [STATE_CRITICAL if is_critical else
+            STATE_WARNING if is_warning else STATE_OK
+            for is_critical, is_warning in zip(critical, warning)]
+
+
+def check(args, result):
+    """return (state, short text, long text) of a query result"""
+    if args.query_type == 'scalar':
+        sample = result[0]['value'][1] if result else 'null'
+        values = [get_scalar_value(args, sample)]
+        metrics = ['UNKNOWN']
+    else:
+        values = [sample['value'][1] for sample in result] or ['null']
+        metrics = [format_metric(sample['metric']) for sample in result] or \
+            ['null']
+
+    numbers = [value if isinstance(value, int) else to_number(value)
+               for value in values]
+    compared = [number for number in numbers if number is not None]
+    states = iter(compare(args, compared))
+    states = [next(states) if number is not None else
+              STATE_OK if args.nan_ok and value == 'NaN' else STATE_UNKNOWN
+              for value, number in zip(values, numbers)]
+
+    worst = max(range(len(states)),
+                key=lambda position: STATE_SEVERITY.index(states[position]))
+    state = states[worst]
+    text = "{} is {}".format(args.metric_name, values[worst])
+    if state == STATE_UNKNOWN:
+        short_text, long_text = "unable to parse prometheus response", text
+    else:
+        short_text, long_text = text, None
+        offending = len([s for s in states if s == state])
+        if len(states) > 1 and state != STATE_OK:
+            short_text += " ({} of {} series {})".format(
+                offending, len(states), STATE_NAMES[state])
+    if args.nagios_info:
+        short_text += ": {}".format(metrics[worst])
+    return state, short_text, long_text
+
+
+def main(argv=None):
+    try:
+        args = parse_args(argv)
+    except UsageError as e:
+        print("UNKNOWN - {}".format(e))
+        print(USAGE)
+        return STATE_UNKNOWN
+
+    try:
+        result = query_prometheus(args)
+    except Exception as e:
+        print("UNKNOWN - unable to query prometheus: {}".format(e))
+        return STATE_UNKNOWN
+
+    try:
+        state, short_text, long_text = check(args, result)
+    except (KeyError, TypeError, IndexError):
+        # matrix and string results hold no sample value, which the shell
+        # script read as null
+        state, short_text, long_text = (
+            STATE_UNKNOWN, "unable to parse prometheus response",
+            "{} is null".format(args.metric_name))
+    print("{} - {}".format(STATE_NAMES[state], short_text))
+    if long_text:
+        print(long_text)
+    return state
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,370 @@
+#!/usr/bin/env python
+# Copyright 2017 The Openstack-Helm Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# Examples:
+# /opt/nagios/libexec/check_prometheus_trend.py
+#                      --prometheus_api http://prom-metrics.openstack.svc.cluster.local:9090
+#                      --query 'node_filesystem_avail{mountpoint="/"}'
+#                      --metric_name 'root filesystem space'
+#                      --mode time_to_exhaustion --threshold 0
+#                      --range 21600 --step 300
+#                      --warning 86400 --critical 14400
+# Output:
+#  WARNING: root filesystem space reaches 0 in 52310s on {instance="node1:9100"}
+#
+# Modes, evaluated per series over the samples of the last --range seconds:
+#  slope               least squares slope per second, as deriv() computes
+#  percent_over        percent of the samples above --threshold
+#  time_to_exhaustion  seconds until the fitted line reaches --threshold, as
+#                      predict_linear() extrapolates it
+#
+# The samples of earlier runs are kept in a cache file, so a run only asks
+# /api/v1/query_range for the steps since the previous run, plus the last
+# --late_steps steps again for samples that were not ingested yet.
+import argparse
+import hashlib
+import json
+import math
+import operator
+import os
+import sys
+import tempfile
+import time
+
+import requests
+
+from snapshot_cache import read_snapshot
+from snapshot_cache import write_snapshot
+
+STATE_OK = 0
+STATE_WARNING = 1
+STATE_CRITICAL = 2
+STATE_UNKNOWN = 3
+
+STATE_SEVERITY = [STATE_OK, STATE_UNKNOWN, STATE_WARNING, STATE_CRITICAL]
+STATE_NAMES = {STATE_OK: 'OK', STATE_WARNING: 'WARNING',
+               STATE_CRITICAL: 'CRITICAL', STATE_UNKNOWN: 'UNKNOWN'}
+
+COMPARISON_METHODS = {'gt': operator.gt, 'ge': operator.ge,
+                      'lt': operator.lt, 'le': operator.le}
+DEFAULT_COMPARISON = {'slope': 'ge', 'percent_over': 'ge',
+                      'time_to_exhaustion': 'le'}
+
+QUERY_TIMEOUT_SECONDS = 10
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Nagios plugin to check the trend of a prometheus'
+                    ' range query')
+    parser.add_argument('--prometheus_api', metavar='prometheus_api', type=str,
+                        required=True,
+                        help='Prometheus API location with scheme and port')
+    parser.add_argument(
+        '--query',
+        metavar='query',
+        type=str,
+        required=True,
+        help='PromQL expression evaluated over the range')
+    parser.add_argument(
+        '--metric_name',
+        metavar='metric_name',
+        type=str,
+        required=True,
+        help='A name for the metric being checked, used in the message')
+    parser.add_argument(
+        '--mode',
+        metavar='mode',
+        type=str,
+        required=True,
+        choices=sorted(DEFAULT_COMPARISON),
+        help='slope, percent_over or time_to_exhaustion')
+    parser.add_argument(
+        '--range',
+        metavar='range',
+        type=int,
+        required=False,
+        default=3600,
+        help='Seconds of samples evaluated, default is 3600')
+    parser.add_argument(
+        '--step',
+        metavar='step',
+        type=int,
+        required=False,
+        default=60,
+        help='Seconds between the samples, default is 60')
+    parser.add_argument(
+        '--threshold',
+        metavar='threshold',
+        type=float,
+        required=False,
+        help='Value the samples are counted above with percent_over, and'
+             ' the value predicted with time_to_exhaustion')
+    parser.add_argument(
+        '--warning',
+        metavar='warning',
+        type=float,
+        required=True,
+        help='Warning level of the slope, percent or seconds')
+    parser.add_argument(
+        '--critical',
+        metavar='critical',
+        type=float,
+        required=True,
+        help='Critical level of the slope, percent or seconds')
+    parser.add_argument(
+        '--comparison',
+        metavar='comparison',
+        type=str,
+        required=False,
+        choices=sorted(COMPARISON_METHODS),
+        help='How the levels are compared, gt, ge, lt or le. Defaults to le'
+             ' for time_to_exhaustion and ge otherwise')
+    parser.add_argument(
+        '--late_steps',
+        metavar='late_steps',
+        type=int,
+        required=False,
+        default=2,
+        help='Most recent cached steps that are fetched again, default is 2')
+    parser.add_argument(
+        '--cache_file',
+        metavar='cache_file',
+        type=str,
+        required=False,
+        help='Location of the sample cache. Defaults to a file per'
+             ' prometheus_api, query, step and range in the temp directory.')
+    parser.add_argument(
+        '--timeout',
+        metavar='timeout',
+        type=float,
+        required=False,
+        default=QUERY_TIMEOUT_SECONDS,
+        help='Seconds to wait for prometheus to answer')
+
+    args = parser.parse_args(argv)
+    if args.step <= 0:
+        parser.error('--step must be positive')
+    if args.range < 2 * args.step:
+        parser.error('--range must cover at least two steps')
+    if args.late_steps < 0:
+        parser.error('--late_steps must not be negative')
+    if args.mode != 'slope' and args.threshold is None:
+        parser.error('--threshold is required with --mode {}'.format(
+            args.mode))
+    args.comparison = args.comparison or DEFAULT_COMPARISON[args.mode]
+    return args
+
+
+def main(argv=None):
+    args = parse_args(argv)
+
+    series, error_messages = load_range(args, time.time())
+    if error_messages:
+        print("Unknown: unable to query prometheus range. {}".format(
+            ",".join(error_messages)))
+        return STATE_UNKNOWN
+    if not series:
+        print("Unknown: {} returned no samples in the last {} seconds".format(
+            args.query, args.range))
+        return STATE_UNKNOWN
+
+    state, message = evaluate(args, series)
+    print("{}: {}".format(STATE_NAMES[state], message))
+    return state
+
+
+def include_schema(prometheus_api):
+    if prometheus_api.startswith(
+            "http://") or prometheus_api.startswith("https://"):
+        return prometheus_api
+    else:
+        return "http://{}".format(prometheus_api)
+
+
+def query_range(args, start, end):
+    """return the matrix of the query from start to end, both included"""
+    error_messages = []
+    result = []
+    try:
+        response = requests.get(
+            include_schema(args.prometheus_api) + "/api/v1/query_range",
+            params={'query': args.query, 'start': start, 'end': end,
+                    'step': args.step},
+            timeout=args.timeout)
+        response_json = response.json()
+        if response_json.get('status') == 'error':
+            error_messages.append("Error response from prometheus: {}".format(
+                response_json.get('error')))
+        else:
+            result = response_json['data']['result']
+    except Exception as e:
+        error_messages.append(
+            "ERROR invoking prometheus api {}".format(str(e)))
+    return result, error_messages
+
+
+def get_cache_file(args):
+    """return the cache file of the query of args, and the key identifying
+    the query inside it"""
+    key = hashlib.sha1(json.dumps(
+        [include_schema(args.prometheus_api), args.query, args.step,
+         args.range]).encode('utf-8')).hexdigest()
+    cache_file = args.cache_file or os.path.join(
+        tempfile.gettempdir(), 'prometheus_trend_{}.json'.format(key))
+    return cache_file, key
+
+
+def load_range(args, now):
+    """return ({series labels: [[timestamp, value], ...]}, error_messages)
+    of the steps in the range ending at now. the steps cached by earlier
+    runs are reused, the cache is dropped after a gap longer than the
+    range, a change of the query or when it does not cover the range.
+    both ends are on the step grid, so the range spans whole steps"""
+    end = int(now) // args.step * args.step
+    start = end - args.range // args.step * args.step
+    cache_file, key = get_cache_file(args)
+
+    series = {}
+    fetch_start = start
+    cache = read_snapshot(cache_file, args.range)
+    if cache and cache.get('query') == key and \
+            cache.get('from', end) <= start <= cache['until'] <= end:
+        fetch_start = max(start, cache['until'] - args.late_steps * args.step)
+        for labels, samples in cache['series'].items():
+            kept = [sample for sample in samples
+                    if start <= sample[0] < fetch_start]
+            if kept:
+                series[labels] = kept
+
+    result, error_messages = query_range(args, fetch_start, end)
+    if error_messages:
+        return None, error_messages
+    for item in result:
+        labels = json.dumps(item['metric'], sort_keys=True)
+        series.setdefault(labels, []).extend(
+            [timestamp, value] for timestamp, value in item['values']
+            if fetch_start <= timestamp <= end)
+
+    try:
+        write_snapshot(cache_file, {'query': key, 'from': start,
+                                    'until': end, 'series': series})
+    except (IOError, OSError):
+        pass  # the next run fetches the whole range again
+
+    return series, []
+
+
+def get_values(samples):
+    """(timestamp, float value) of the samples that are numbers"""
+    values = []
+    for timestamp, value in samples:
+        value = float(value)
+        if not math.isnan(value):
+            values.append((float(timestamp), value))
+    return values
+
+
+def fit_line(values):
+    """least squares (slope, value at the last timestamp) of (timestamp,
+    value) pairs, None with fewer than two timestamps"""
+    if len(values) < 2:
+        return None
+    mean_time = sum(t for t, v in values) / len(values)
+    mean_value = sum(v for t, v in values) / len(values)
+    variance = sum((t - mean_time) ** 2 for t, v in values)
+    if not variance:
+        return None
+    slope = sum((t - mean_time) * (v - mean_value)
+                for t, v in values) / variance
+    return slope, mean_value + slope * (values[-1][0] - mean_time)
+
+
+def get_slope(args, values):
+    fit = fit_line(values)
+    return None if fit is None else fit[0]
+
+
+def get_percent_over(args, values):
+    if not values:
+        return None
+    over = len([v for t, v in values if v > args.threshold])
+    return 100.0 * over / len(values)
+
+
+def get_time_to_exhaustion(args, values):
+    """seconds from the last sample until the fitted line reaches the
+    threshold, infinite when the line does not head towards it"""
+    fit = fit_line(values)
+    if fit is None:
+        return None
+    slope, last_value = fit
+    if not slope:
+        return float('inf')
+    seconds = (args.threshold - last_value) / slope
+    return seconds if seconds >= 0 else float('inf')
+
+
+EVALUATIONS = {'slope': get_slope, 'percent_over': get_percent_over,
+               'time_to_exhaustion': get_time_to_exhaustion}
+
+
+def describe(args, result):
+    if args.mode == 'slope':
+        return "slope is {:.6g}/s".format(result)
+    if args.mode == 'percent_over':
+        return "is over {:g} in {:.1f}% of the samples".format(
+            args.threshold, result)
+    if math.isinf(result):
+        return "does not head towards {:g}".format(args.threshold)
+    return "reaches {:g} in {:.0f}s".format(args.threshold, result)
+
+
+def format_labels(labels):
+    return '{' + ','.join('{}="{}"'.format(name, value) for name, value
+                          in sorted(json.loads(labels).items())) + '}'
+
+
+def evaluate(args, series):
+    """return the worst (state, message) of the series"""
+    method = COMPARISON_METHODS[args.comparison]
+    results = []
+    for labels in sorted(series):
+        result = EVALUATIONS[args.mode](args, get_values(series[labels]))
+        if result is None:
+            state = STATE_UNKNOWN
+        elif method(result, args.critical):
+            state = STATE_CRITICAL
+        elif method(result, args.warning):
+            state = STATE_WARNING
+        else:
+            state = STATE_OK
+        results.append((state, labels, result))
+
+    state, labels, result = max(
+        results, key=lambda item: STATE_SEVERITY.index(item[0]))
+    if result is None:
+        message = "{} has too few samples to evaluate".format(
+            args.metric_name)
+    else:
+        message = "{} {}".format(args.metric_name, describe(args, result))
+    count = len([item for item in results if item[0] == state])
+    if len(results) > 1 and state != STATE_OK:
+        message += " ({} of {} series {})".format(
+            count, len(results), STATE_NAMES[state])
+    return state, message + " on " + format_labels(labels)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -23,8 +23,25 @@
 
 import sys
 import argparse
+import json
 import requests
+import socket
+import ssl
+import threading
+import time
 import warnings
+
+try:
+    import http.client as httplib
+    import queue
+    from urllib.parse import urlsplit
+except ImportError:  # python 2
+    import httplib
+    import Queue as queue
+    from urlparse import urlsplit
+
+from nagiosutil import NagiosUtil
+
 warnings.filterwarnings("ignore")
 
 STATE_OK = 0
@@ -32,11 +49,20 @@ STATE_WARNING = 1
 STATE_CRITICAL = 2
 STATE_UNKNOWN = 3
 
+STATE_SEVERITY = [STATE_OK, STATE_UNKNOWN, STATE_WARNING, STATE_CRITICAL]
+STATE_NAMES = {STATE_OK: 'OK', STATE_WARNING: 'WARNING',
+               STATE_CRITICAL: 'CRITICAL', STATE_UNKNOWN: 'UNKNOWN'}
+
+TIMEOUT_SECONDS = 10
+
+PHASES = ('dns', 'connect', 'tls', 'ttfb', 'transfer', 'total')
+READ_CHUNK_BYTES = 65536
 
-def main():
+
+def main(argv=None):
     parser = argparse.ArgumentParser(description='Check REST API status.')
     parser.add_argument('--url', metavar='URL', type=str,
-                        required=True,
+                        required=False,
                         help='REST URL')
     parser.add_argument(
         '--expected_response_code',
@@ -68,82 +94,442 @@ def main():
     parser.add_argument('--http_proxy', metavar='http_proxy', type=str,
                         required=False,
                         help='Name of the http proxy.')
+    parser.add_argument(
+        '--phase_timing',
+        action='store_true',
+        help='Time DNS lookup, TCP connect, TLS handshake, time to first'
+             ' byte and body transfer separately and report them as'
+             ' perfdata. Proxies are not supported in this mode')
+    parser.add_argument(
+        '--phase_warning_seconds',
+        metavar='phase_warning_seconds',
+        type=parse_phase_thresholds,
+        required=False,
+        help='With --phase_timing, comma separated phase=seconds warning'
+             ' thresholds, ex. dns=0.5,connect=1,ttfb=2. Phases are {}'.format(
+                 ','.join(PHASES)))
+    parser.add_argument(
+        '--phase_critical_seconds',
+        metavar='phase_critical_seconds',
+        type=parse_phase_thresholds,
+        required=False,
+        help='With --phase_timing, comma separated phase=seconds critical'
+             ' thresholds')
+    parser.add_argument(
+        '--max_body_bytes',
+        metavar='max_body_bytes',
+        type=int,
+        required=False,
+        help='With --phase_timing, stop downloading the body after this'
+             ' many bytes')
+    parser.add_argument(
+        '--urls_file',
+        metavar='urls_file',
+        type=str,
+        required=False,
+        help='JSON list of URL definitions checked concurrently instead of'
+             ' --url, each with url and optionally the other arguments of'
+             ' this script and service_description')
+    parser.add_argument(
+        '--workers',
+        metavar='workers',
+        type=int,
+        required=False,
+        default=16,
+        help='With --urls_file, number of URLs checked at the same time')
+    parser.add_argument(
+        '--command_file',
+        metavar='command_file',
+        type=str,
+        required=False,
+        help='With --urls_file, submit per URL results as passive checks to'
+             ' this Nagios external command file')
+    parser.add_argument(
+        '--host_name',
+        metavar='host_name',
+        type=str,
+        required=False,
+        help='Nagios host of the passive check results')
+
+    args = parser.parse_args(argv)
 
-    args = parser.parse_args()
+    if bool(args.url) == bool(args.urls_file):
+        parser.error('exactly one of --url and --urls_file is required')
 
-    timeout_seconds = 10
-    warning_seconds = timeout_seconds
-    critical_seconds = timeout_seconds
+    if args.phase_timing and (args.http_proxy or args.https_proxy):
+        parser.error('--phase_timing does not support proxies')
 
-    if args.warning_response_seconds:
-        warning_seconds = int(args.warning_response_seconds)
+    if args.urls_file:
+        check_urls_file(args)
 
-    if args.critical_response_seconds:
-        critical_seconds = int(args.critical_response_seconds)
+    if args.phase_timing:
+        state, output = check_url_phases(
+            args.url,
+            get_expected_response_codes(args.expected_response_code,
+                                        args.expected_response_codes),
+            get_response_seconds(args.warning_response_seconds),
+            get_response_seconds(args.critical_response_seconds),
+            args.phase_warning_seconds or {},
+            args.phase_critical_seconds or {},
+            args.max_body_bytes)
+    else:
+        state, output = check_url(
+            requests, args.url,
+            get_expected_response_codes(args.expected_response_code,
+                                        args.expected_response_codes),
+            get_response_seconds(args.warning_response_seconds),
+            get_response_seconds(args.critical_response_seconds),
+            get_proxies(args.http_proxy, args.https_proxy))
+    print(output)
+    sys.exit(state)
+
+
+def parse_phase_thresholds(value):
+    """parse dns=0.5,connect=1 into {'dns': 0.5, 'connect': 1.0}"""
+    thresholds = {}
+    for item in (value or '').split(','):
+        if not item:
+            continue
+        phase, _, seconds = item.partition('=')
+        phase = phase.strip()
+        if phase not in PHASES:
+            raise argparse.ArgumentTypeError(
+                "unknown phase {} in {}, phases are {}".format(
+                    phase, value, ','.join(PHASES)))
+        try:
+            thresholds[phase] = float(seconds)
+        except ValueError:
+            raise argparse.ArgumentTypeError(
+                "invalid seconds for phase {} in {}".format(phase, value))
+    return thresholds
 
+
+def get_expected_response_codes(expected_response_code,
+                                expected_response_codes_csv):
     expected_response_codes = []
-    if args.expected_response_code:
-        if args.expected_response_code not in expected_response_codes:
-            expected_response_codes.append(args.expected_response_code)
+    if expected_response_code:
+        if expected_response_code not in expected_response_codes:
+            expected_response_codes.append(expected_response_code)
 
-    if args.expected_response_codes:
-        for expected_response_code in args.expected_response_codes.split(','):
+    if isinstance(expected_response_codes_csv, list):
+        expected_response_codes_csv = ','.join(
+            str(code) for code in expected_response_codes_csv)
+    if expected_response_codes_csv:
+        for expected_response_code in str(expected_response_codes_csv).split(','):
             required_response_code = int(expected_response_code)
             if required_response_code not in expected_response_codes:
                 expected_response_codes.append(required_response_code)
 
     if len(expected_response_codes) < 1:
         expected_response_codes.append(200)
+    return expected_response_codes
+
 
+def get_response_seconds(response_seconds):
+    if response_seconds:
+        return int(response_seconds)
+    return TIMEOUT_SECONDS
+
+
+def get_proxies(http_proxy, https_proxy):
     proxies = {
         "http": "",
         "https": ""
     }
-    if args.http_proxy:
-        proxies["http"] = args.http_proxy
-    if args.https_proxy:
-        proxies["https"] = args.https_proxy
+    if http_proxy:
+        proxies["http"] = http_proxy
+    if https_proxy:
+        proxies["https"] = https_proxy
+    return proxies
 
+
+def check_url(session, url, expected_response_codes, warning_seconds,
+              critical_seconds, proxies, timeout_seconds=TIMEOUT_SECONDS):
+    """return (state, output) of fetching url with session, which may be the
+    requests module itself or a requests.Session reusing connections"""
     try:
-        response = requests.get(
-            include_schema(
-                args.url),
+        response = session.get(
+            include_schema(url),
             proxies=proxies,
             timeout=timeout_seconds,
             verify=False)  # nosec
 
-        response_seconds = response.elapsed.total_seconds()
-        response_time = "[RT={:.4f}]".format(response_seconds)
+        return evaluate_response(
+            url, expected_response_codes, response.status_code,
+            response.elapsed.total_seconds(), warning_seconds,
+            critical_seconds)
+
+    except requests.exceptions.Timeout:
+        return STATE_CRITICAL, "CRITICAL: Timeout in {} seconds to fetch from URL {}".format(
+            timeout_seconds, url)
+    except Exception as e:
+        return STATE_CRITICAL, "CRITICAL: Failed to fetch from URL {} with reason {}".format(
+            url, e)
 
-        if response.status_code not in expected_response_codes:
-            print("CRITICAL: using URL {} expected HTTP status codes {} but got {}. {}".format(
-                args.url, expected_response_codes, response.status_code, response_time))
-            sys.exit(STATE_CRITICAL)
 
-        if response_seconds >= warning_seconds and response_seconds < critical_seconds:
-            print("WARNING: using URL {} response seconds {} is more than warning threshold {} seconds. {}".format(
-                args.url, response_seconds, warning_seconds, response_time))
-            sys.exit(STATE_WARNING)
+def evaluate_response(url, expected_response_codes, status_code,
+                      response_seconds, warning_seconds, critical_seconds):
+    response_time = "[RT={:.4f}]".format(response_seconds)
 
-        if response_seconds >= critical_seconds:
-            print("CRITICAL: using URL {} response seconds {} is more than critical threshold {} seconds. {}".format(
-                args.url, response_seconds, critical_seconds, response_time))
-            sys.exit(STATE_CRITICAL)
+    if status_code not in expected_response_codes:
+        return STATE_CRITICAL, "CRITICAL: using URL {} expected HTTP status codes {} but got {}. {}".format(
+            url, expected_response_codes, status_code, response_time)
 
-        print("OK: URL {} returned response code {}. {}".format(
-            args.url, response.status_code, response_time))
-        sys.exit(STATE_OK)
+    if response_seconds >= warning_seconds and response_seconds < critical_seconds:
+        return STATE_WARNING, "WARNING: using URL {} response seconds {} is more than warning threshold {} seconds. {}".format(
+            url, response_seconds, warning_seconds, response_time)
 
-    except requests.exceptions.Timeout:
-        print("CRITICAL: Timeout in {} seconds to fetch from URL {}".format(
-            timeout_seconds, args.url))
-        sys.exit(STATE_CRITICAL)
+    if response_seconds >= critical_seconds:
+        return STATE_CRITICAL, "CRITICAL: using URL {} response seconds {} is more than critical threshold {} seconds. {}".format(
+            url, response_seconds, critical_seconds, response_time)
+
+    return STATE_OK, "OK: URL {} returned response code {}. {}".format(
+        url, status_code, response_time)
+
+
+def measure_phases(url, timeout_seconds, max_body_bytes=None):
+    """return (status_code, {phase: seconds}, body_bytes) of a GET of url,
+    timing every phase of the request on its own socket"""
+    parts = urlsplit(include_schema(url))
+    https = parts.scheme == 'https'
+    port = parts.port or (443 if https else 80)
+    path = parts.path or '/'
+    if parts.query:
+        path += '?' + parts.query
+
+    phases = {}
+    started = time.time()
+    addresses = socket.getaddrinfo(parts.hostname, port, 0, socket.SOCK_STREAM)
+    phases['dns'] = time.time() - started
+
+    mark = time.time()
+    sock = None
+    for family, socktype, proto, canonname, address in addresses:
+        sock = socket.socket(family, socktype, proto)
+        sock.settimeout(timeout_seconds)
+        try:
+            sock.connect(address)
+            break
+        except socket.error as e:
+            sock.close()
+            sock = None
+            error = e
+    if sock is None:
+        raise error
+    phases['connect'] = time.time() - mark
+
+    mark = time.time()
+    if https:
+        context = ssl.create_default_context()
+        context.check_hostname = False
+        context.verify_mode = ssl.CERT_NONE  # nosec
+        sock = context.wrap_socket(sock, server_hostname=parts.hostname)
+    phases['tls'] = time.time() - mark
+
+    connection = httplib.HTTPConnection(parts.hostname, port,
+                                        timeout=timeout_seconds)
+    connection.sock = sock
+    try:
+        mark = time.time()
+        connection.request('GET', path)
+        response = connection.getresponse()
+        phases['ttfb'] = time.time() - mark
+
+        mark = time.time()
+        body_bytes = 0
+        while max_body_bytes is None or body_bytes < max_body_bytes:
+            read_bytes = READ_CHUNK_BYTES
+            if max_body_bytes is not None:
+                read_bytes = min(read_bytes, max_body_bytes - body_bytes)
+            chunk = response.read(read_bytes)
+            if not chunk:
+                break
+            body_bytes += len(chunk)
+        phases['transfer'] = time.time() - mark
+        phases['total'] = time.time() - started
+        return response.status, phases, body_bytes
+    finally:
+        connection.close()
+
+
+def get_phase_perfdata(phases, body_bytes, phase_warning, phase_critical):
+    perfdata = []
+    for phase in PHASES:
+        perfdata.append("{}={:.6f}s;{};{};0".format(
+            phase, phases[phase], phase_warning.get(phase, ''),
+            phase_critical.get(phase, '')))
+    perfdata.append("size={}B;;;0".format(body_bytes))
+    return " ".join(perfdata)
+
+
+def check_url_phases(url, expected_response_codes, warning_seconds,
+                     critical_seconds, phase_warning, phase_critical,
+                     max_body_bytes=None, timeout_seconds=TIMEOUT_SECONDS):
+    """return (state, output) of fetching url like check_url(), with every
+    phase timed, checked against its thresholds and added as perfdata"""
+    try:
+        status_code, phases, body_bytes = measure_phases(
+            url, timeout_seconds, max_body_bytes)
+    except socket.timeout:
+        return STATE_CRITICAL, "CRITICAL: Timeout in {} seconds to fetch from URL {}".format(
+            timeout_seconds, url)
     except Exception as e:
-        print("CRITICAL: Failed to fetch from URL {} with reason {}".format(
-            args.url, e))
-        sys.exit(STATE_CRITICAL)
+        return STATE_CRITICAL, "CRITICAL: Failed to fetch from URL {} with reason {}".format(
+            url, e)
+
+    # the same span requests reports as elapsed, up to the response headers
+    response_seconds = phases['total'] - phases['transfer']
+    state, output = evaluate_response(
+        url, expected_response_codes, status_code, response_seconds,
+        warning_seconds, critical_seconds)
+
+    if status_code in expected_response_codes:
+        for phase in PHASES:
+            for phase_state, thresholds, name in (
+                    (STATE_CRITICAL, phase_critical, 'critical'),
+                    (STATE_WARNING, phase_warning, 'warning')):
+                if phase in thresholds and phases[phase] >= thresholds[phase]:
+                    if STATE_SEVERITY.index(phase_state) > \
+                            STATE_SEVERITY.index(state):
+                        state = phase_state
+                        output = "{}: using URL {} {} seconds {:.4f} is more than {} threshold {} seconds. [RT={:.4f}]".format(
+                            STATE_NAMES[phase_state], url, phase,
+                            phases[phase], name, thresholds[phase],
+                            response_seconds)
+                    break
+
+    return state, "{} | {}".format(
+        output, get_phase_perfdata(phases, body_bytes, phase_warning,
+                                   phase_critical))
+
+
+def check_definition(session, definition):
+    if definition.get('phase_timing'):
+        if definition.get('http_proxy') or definition.get('https_proxy'):
+            return STATE_UNKNOWN, "UNKNOWN: phase_timing does not support proxies, URL {}".format(
+                definition['url'])
+        return check_url_phases(
+            definition['url'],
+            get_expected_response_codes(
+                definition.get('expected_response_code'),
+                definition.get('expected_response_codes')),
+            get_response_seconds(definition.get('warning_response_seconds')),
+            get_response_seconds(definition.get('critical_response_seconds')),
+            parse_phase_thresholds(definition.get('phase_warning_seconds')),
+            parse_phase_thresholds(definition.get('phase_critical_seconds')),
+            definition.get('max_body_bytes'))
+    return check_url(
+        session, definition['url'],
+        get_expected_response_codes(
+            definition.get('expected_response_code'),
+            definition.get('expected_response_codes')),
+        get_response_seconds(definition.get('warning_response_seconds')),
+        get_response_seconds(definition.get('critical_response_seconds')),
+        get_proxies(definition.get('http_proxy'),
+                    definition.get('https_proxy')))
+
+
+def validate_definition(definition):
+    """raise ValueError unless the codes and thresholds of definition
+    parse as check_definition() parses them"""
+    try:
+        get_expected_response_codes(
+            definition.get('expected_response_code'),
+            definition.get('expected_response_codes'))
+        get_response_seconds(definition.get('warning_response_seconds'))
+        get_response_seconds(definition.get('critical_response_seconds'))
+        parse_phase_thresholds(definition.get('phase_warning_seconds'))
+        parse_phase_thresholds(definition.get('phase_critical_seconds'))
+    except (ValueError, TypeError, AttributeError,
+            argparse.ArgumentTypeError) as e:
+        raise ValueError("invalid definition {}: {}".format(
+            definition, str(e)))
+    max_body_bytes = definition.get('max_body_bytes')
+    if max_body_bytes is not None and not isinstance(max_body_bytes, int):
+        raise ValueError(
+            "max_body_bytes is not an integer in definition {}".format(
+                definition))
+
+
+def check_definitions(definitions, workers):
+    """return (state, output) of every definition, checked by a bounded
+    pool of threads each keeping its own session, so connections to the
+    same host are reused across the URLs a thread checks"""
+    results = [None] * len(definitions)
+    pending = queue.Queue()
+    for position, definition in enumerate(definitions):
+        pending.put((position, definition))
+
+    def worker():
+        session = requests.Session()
+        try:
+            while True:
+                try:
+                    position, definition = pending.get_nowait()
+                except queue.Empty:
+                    return
+                try:
+                    results[position] = check_definition(session, definition)
+                except Exception as e:
+                    # a failing URL does not cost the results of the others
+                    results[position] = STATE_UNKNOWN, "UNKNOWN: unable to check URL {}. {}".format(
+                        definition['url'], str(e))
+        finally:
+            session.close()
+
+    threads = [threading.Thread(target=worker)
+               for _ in range(max(1, min(workers, len(definitions))))]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+
+def check_urls_file(args):
+    try:
+        with open(args.urls_file, 'r') as urls_json:
+            definitions = json.load(urls_json)
+        for definition in definitions:
+            if not definition.get('url'):
+                raise ValueError(
+                    "url is required in definition {}".format(definition))
+            validate_definition(definition)
+            if args.command_file:
+                definition.setdefault('host_name', args.host_name)
+                if not definition['host_name'] or \
+                        not definition.get('service_description'):
+                    raise ValueError(
+                        "host_name and service_description are required in definition {} with --command_file".format(
+                            definition))
+    except Exception as e:
+        print("UNKNOWN: unable to load URL definitions. {}".format(str(e)))
+        sys.exit(STATE_UNKNOWN)
+
+    results = check_definitions(definitions, args.workers)
+
+    if args.command_file:
+        try:
+            submitted = NagiosUtil.submit_service_check_results(
+                args.command_file,
+                [(definition['host_name'], definition['service_description'],
+                  state, output)
+                 for definition, (state, output) in zip(definitions, results)])
+        except Exception as e:
+            print("UNKNOWN: unable to submit URL results. {}".format(str(e)))
+            sys.exit(STATE_UNKNOWN)
+        print("OK: submitted {} URL results".format(submitted))
+        sys.exit(STATE_OK)
 
-    sys.exit(STATE_OK)
+    worst = max([state for state, output in results] or [STATE_OK],
+                key=STATE_SEVERITY.index)
+    failing = len([state for state, output in results if state != STATE_OK])
+    print("{}: {} of {} URLs are not OK".format(
+        STATE_NAMES[worst], failing, len(results)))
+    for state, output in results:
+        print(output)
+    sys.exit(worst)
 
 
 def include_schema(api):
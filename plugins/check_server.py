@@ -0,0 +1,297 @@
+#!/usr/bin/env python
+# Copyright 2017 The Openstack-Helm Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# Resident server running the python check plugins in-process, for
+# check_client.py.
+# Examples:
+# /opt/nagios/libexec/check_server.py
+#                      --socket /opt/nagios/var/rw/check_server.sock
+# The plugins of CHECK_PLUGINS are imported once at startup and their
+# main(argv) is called in a thread per check, with the output of the thread
+# captured and the exit code taken from the SystemExit or return value.
+# The module level requests functions are served from a pool of sessions,
+# so checks against the same endpoint reuse keep-alive connections, and
+# requests made without a timeout get --request_timeout.
+# A check still running after --check_timeout is answered UNKNOWN, and
+# keeps its worker until it returns. When every worker is busy the check is
+# not served and check_client.py runs the plugin by itself.
+# Plugins that reload nagios or can run as daemons are not served, and the
+# checks share the working directory and environment of the server.
+import argparse
+import importlib
+import json
+import os
+import socket
+import sys
+import threading
+import traceback
+
+import requests
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+try:
+    import socketserver
+except ImportError:
+    import SocketServer as socketserver
+try:
+    from StringIO import StringIO
+except ImportError:
+    from io import StringIO
+
+STATE_UNKNOWN = 3
+
+CHECK_TIMEOUT_SECONDS = 50
+REQUEST_TIMEOUT_SECONDS = 10
+
+# query_prometheus_alerts_bulk.py is left out for its -d daemon mode, and
+# check_update_prometheus_hosts.py for reloading nagios
+CHECK_PLUGINS = ('check_exporter_health_metric.py',
+                 'check_prometheus_metric.py',
+                 'check_prometheus_trend.py',
+                 'check_rest_get_api.py',
+                 'query_elasticsearch.py',
+                 'query_elasticsearch_batch.py',
+                 'query_prometheus_alerts.py')
+
+
+class ThreadOutput(object):
+    """stream writing to the buffer of the current thread while it is
+    captured, and to the original stream otherwise"""
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.local = threading.local()
+
+    def capture(self):
+        self.local.buffer = StringIO()
+
+    def release(self):
+        """stop capturing, return what the thread wrote"""
+        output = self.local.buffer.getvalue()
+        self.local.buffer = None
+        return output
+
+    def write(self, data):
+        buffer = getattr(self.local, 'buffer', None)
+        (self.stream if buffer is None else buffer).write(data)
+
+    def flush(self):
+        if getattr(self.local, 'buffer', None) is None:
+            self.stream.flush()
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+
+class ThreadArgv(list):
+    """sys.argv indexed as the argv of the check run by the current thread,
+    so argparse names the plugin in its usage and errors"""
+
+    def __init__(self, argv):
+        list.__init__(self, argv)
+        self.local = threading.local()
+
+    def set(self, argv):
+        self.local.argv = argv
+
+    def __getitem__(self, index):
+        argv = getattr(self.local, 'argv', None)
+        return list.__getitem__(self if argv is None else argv, index)
+
+
+class SessionPool(object):
+    """requests.request() replacement lending pooled sessions, so the keep
+    alive connections of a session outlive the check that opened them"""
+
+    def __init__(self, size, timeout):
+        self.size = size
+        self.timeout = timeout
+        self.sessions = queue.LifoQueue()
+
+    def request(self, method, url, **kwargs):
+        if kwargs.get('timeout') is None:
+            kwargs['timeout'] = self.timeout
+        try:
+            session = self.sessions.get_nowait()
+        except queue.Empty:
+            session = requests.Session()
+        try:
+            return session.request(method=method, url=url, **kwargs)
+        finally:
+            # cookies of one check are not sent by the next
+            session.cookies.clear()
+            if self.sessions.qsize() < self.size:
+                self.sessions.put(session)
+            else:
+                session.close()
+
+    def install(self):
+        # requests.get() and the other helpers call requests.api.request
+        requests.api.request = self.request
+        requests.request = self.request
+
+
+def load_plugins(names):
+    """import the plugins of names, return {name: module} of those that
+    import and have a main()"""
+    plugins = {}
+    for name in names:
+        try:
+            module = importlib.import_module(name[:-len('.py')])
+        except Exception as e:
+            print("Not serving {}: {}".format(name, str(e)))
+            continue
+        if hasattr(module, 'main'):
+            plugins[name] = module
+    return plugins
+
+
+def run_check(name, module, argv, stdout, stderr):
+    """return (exit code, stdout, stderr) of module.main(argv)"""
+    stdout.capture()
+    stderr.capture()
+    sys.argv.set([name] + argv)
+    try:
+        try:
+            code = module.main(argv)
+        except SystemExit as e:
+            code = e.code
+        except Exception:
+            traceback.print_exc(file=sys.stderr)
+            code = STATE_UNKNOWN
+        if code is not None and not isinstance(code, int):
+            # as the interpreter does for sys.exit(message)
+            sys.stderr.write("{}\n".format(code))
+            code = 1
+    finally:
+        sys.argv.set(None)
+        output = stdout.release()
+        errors = stderr.release()
+    return code or 0, output, errors
+
+
+class CheckHandler(socketserver.StreamRequestHandler):
+    """reads a JSON {"plugin", "argv"} request up to the end of the client
+    writes, answers with {"served", "code", "stdout", "stderr"}"""
+
+    def handle(self):
+        try:
+            request = json.loads(self.rfile.read().decode('utf-8'))
+            name = os.path.basename(request['plugin'])
+            module = self.server.plugins.get(name)
+            if module is None or not self.server.workers.acquire(False):
+                response = {'served': False}
+            else:
+                response = self.run(name, module, list(request['argv']))
+            self.wfile.write(json.dumps(response).encode('utf-8'))
+        except (ValueError, KeyError, TypeError, socket.error) as e:
+            print("Invalid check request: {}".format(str(e)))
+
+    def run(self, name, module, argv):
+        """run the check in a worker thread holding the acquired worker
+        until the check returns, answer UNKNOWN if that takes longer than
+        the check timeout"""
+        results = queue.Queue()
+
+        def work():
+            try:
+                results.put(run_check(name, module, argv, self.server.stdout,
+                                      self.server.stderr))
+            finally:
+                self.server.workers.release()
+
+        worker = threading.Thread(target=work)
+        worker.daemon = True
+        worker.start()
+        try:
+            code, output, errors = results.get(
+                timeout=self.server.check_timeout)
+        except queue.Empty:
+            code, output, errors = STATE_UNKNOWN, (
+                "UNKNOWN: {} did not finish within {} seconds in the check"
+                " server\n".format(name, self.server.check_timeout)), ''
+        return {'served': True, 'code': code, 'stdout': output,
+                'stderr': errors}
+
+
+class CheckServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, socket_path, plugins, workers, check_timeout):
+        if os.path.exists(socket_path):
+            os.unlink(socket_path)
+        socketserver.UnixStreamServer.__init__(self, socket_path,
+                                               CheckHandler)
+        os.chmod(socket_path, 0o660)
+        self.plugins = plugins
+        self.workers = threading.BoundedSemaphore(workers)
+        self.check_timeout = check_timeout
+        sys.argv = ThreadArgv(sys.argv)
+        self.stdout = sys.stdout = ThreadOutput(sys.stdout)
+        self.stderr = sys.stderr = ThreadOutput(sys.stderr)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Resident server running python check plugins for'
+                    ' check_client.py')
+    parser.add_argument('--socket', metavar='socket', type=str,
+                        required=True,
+                        help='Unix socket to listen on')
+    parser.add_argument(
+        '--workers',
+        metavar='workers',
+        type=int,
+        required=False,
+        default=32,
+        help='Checks run at the same time, default is 32')
+    parser.add_argument(
+        '--sessions',
+        metavar='sessions',
+        type=int,
+        required=False,
+        default=32,
+        help='HTTP sessions kept for reuse, default is 32')
+    parser.add_argument(
+        '--check_timeout',
+        metavar='check_timeout',
+        type=float,
+        required=False,
+        default=CHECK_TIMEOUT_SECONDS,
+        help='Seconds a check may run before it is answered UNKNOWN,'
+             ' default is 50')
+    parser.add_argument(
+        '--request_timeout',
+        metavar='request_timeout',
+        type=float,
+        required=False,
+        default=REQUEST_TIMEOUT_SECONDS,
+        help='Timeout of the requests that checks make without one,'
+             ' default is 10')
+    args = parser.parse_args(argv)
+
+    plugins = load_plugins(CHECK_PLUGINS)
+    SessionPool(args.sessions, args.request_timeout).install()
+    server = CheckServer(args.socket, plugins, args.workers,
+                         args.check_timeout)
+    print("Serving {} on {}".format(", ".join(sorted(plugins)), args.socket))
+    sys.stdout.flush()
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,9 +1,13 @@
 #!/usr/bin/env python
 import argparse
+import hashlib
 import sys
 import requests
 import os
 import signal
+import subprocess
+import tempfile
+import threading
 import time
 
 NAGIOS_HOST_FORMAT = """
@@ -25,6 +29,19 @@ define hostgroup {{
 """
 NAGIOS_OK = 0
 NAGIOS_CRITICAL = 2
+NAGIOS_RELOAD_TIMEOUT_SECONDS = 120
+# a one-shot run is a service check itself, so it returns well within the
+# 60 seconds nagios allows service checks by default
+ONE_SHOT_RELOAD_WAIT_MAX_SECONDS = 45
+
+# Aggregations project the series down to the labels discovery reads, so
+# the server drops the remaining labels and duplicate series before they
+# are serialized.
+NODE_UNAME_QUERY = 'max by (nodename, instance) (node_uname_info)'
+NODE_LABELS_QUERY = ('max without (instance, job, namespace, pod, service,'
+                     ' endpoint, kubernetes_name,'
+                     ' kubernetes_namespace, kubernetes_pod_name)'
+                     ' (kube_node_labels)')
 
 
 def main():
@@ -42,7 +59,18 @@ def main():
         type=int,
         required=False,
         default=60,
-        help='When run as daemon, sleep time')
+        help='When run as daemon, sleep time. With --probe, the shortest sleep time')
+    parser.add_argument(
+        '--max_update_seconds',
+        metavar='max_update_seconds',
+        type=int,
+        required=False,
+        default=600,
+        help='With --probe, the longest sleep time while no changes are seen')
+    parser.add_argument(
+        '--probe',
+        action='store_true',
+        help='When run as daemon, run a cheap change probe every cycle and the full discovery only when it differs from the previous cycle')
     parser.add_argument(
         '--hosts',
         metavar='get_nagios_hosts',
@@ -62,6 +90,45 @@ def main():
         required=False,
         default="/opt/nagios/etc/conf.d/prometheus_discovery_objects.cfg",
         help='Output Nagios Host definition to stdout')
+    parser.add_argument(
+        '--precache_objects',
+        action='store_true',
+        help='Verify the configuration and write the precached objects file before reloading Nagios. Nagios must be started with -u to use it')
+    parser.add_argument(
+        '--reload_window',
+        metavar='reload_window',
+        type=int,
+        required=False,
+        default=0,
+        help='When run as daemon, seconds to collect further discovery changes into the same Nagios reload')
+    parser.add_argument(
+        '--reload_wait_seconds',
+        metavar='reload_wait_seconds',
+        type=int,
+        required=False,
+        help='Seconds to wait for Nagios to finish a reload to report how long it took. Defaults to {} when run as daemon and 0, only requesting the reload, otherwise, where at most {} are waited'.format(
+            NAGIOS_RELOAD_TIMEOUT_SECONDS, ONE_SHOT_RELOAD_WAIT_MAX_SECONDS))
+    parser.add_argument(
+        '--nagios_bin',
+        metavar='nagios_bin',
+        type=str,
+        required=False,
+        default="/opt/nagios/bin/nagios",
+        help='Nagios binary used for the pre-flight check')
+    parser.add_argument(
+        '--nagios_cfg',
+        metavar='nagios_cfg',
+        type=str,
+        required=False,
+        default="/opt/nagios/etc/nagios.cfg",
+        help='Nagios main configuration file')
+    parser.add_argument(
+        '--status_file',
+        metavar='status_file',
+        type=str,
+        required=False,
+        default="/opt/nagios/var/status.dat",
+        help='Nagios status file, used to measure how long a reload takes')
     parser.add_argument(
         '-d',
         action='store_true',
@@ -69,17 +136,39 @@ def main():
 
     args, unknown = parser.parse_known_args()
 
+    reload_wait_seconds = args.reload_wait_seconds
+    if reload_wait_seconds is None:
+        reload_wait_seconds = NAGIOS_RELOAD_TIMEOUT_SECONDS if args.d else 0
+    elif not args.d:
+        reload_wait_seconds = min(reload_wait_seconds,
+                                  ONE_SHOT_RELOAD_WAIT_MAX_SECONDS)
+
+    reloader = None
+    if args.precache_objects or args.reload_window > 0:
+        reloader = NagiosReloader(
+            args.object_file_loc, args.reload_window, args.precache_objects,
+            args.nagios_bin, args.nagios_cfg, args.status_file,
+            reload_wait_seconds)
+
     if args.hosts:
         print(get_nagios_hosts(args.prometheus_api))
     elif args.hostgroups:
         print(get_nagios_hostgroups(args.prometheus_api))
     elif args.object_file_loc:
-        if args.d:
+        if args.d and args.probe:
+            try:
+                run_probing_daemon(
+                    args.prometheus_api, args.object_file_loc,
+                    args.update_seconds, args.max_update_seconds, reloader)
+            except Exception as e:
+                print("Error updating nagios config")
+                sys.exit(NAGIOS_CRITICAL)
+        elif args.d:
             while True:
                 try:
                     update_config_file(
-                        args.prometheus_api, args.object_file_loc)
-                    time.sleep(args.update_seconds)
+                        args.prometheus_api, args.object_file_loc, reloader)
+                    sleep_with_pending_reload(args.update_seconds, reloader)
                 except Exception as e:
                     print("Error updating nagios config")
                     sys.exit(NAGIOS_CRITICAL)
@@ -88,7 +177,10 @@ def main():
                 print("OK- Nagios host configuration already updated.")
                 sys.exit(NAGIOS_OK)
             try:
-                update_config_file(args.prometheus_api, args.object_file_loc)
+                update_config_file(
+                    args.prometheus_api, args.object_file_loc, reloader)
+                if reloader:
+                    reloader.reload()
             except Exception as e:
                 print("Error updating nagios config")
                 sys.exit(NAGIOS_CRITICAL)
@@ -96,17 +188,273 @@ def main():
             sys.exit(NAGIOS_OK)
 
 
-def update_config_file(prometheus_api, object_file_loc):
-    nagios_hosts = get_nagios_hosts(prometheus_api)
-    nagios_hostgroups = get_nagios_hostgroups(prometheus_api)
+def update_config_file(prometheus_api, object_file_loc, reloader=None):
+    unames_json, labels_json = query_prometheus_discovery_sources(
+        prometheus_api)
+    hostgroup_dictionary = get_nagios_hostgroups_dictionary(
+        prometheus_api, labels_json)
+    nagios_hosts = get_nagios_hosts(
+        prometheus_api, unames_json, hostgroup_dictionary)
+    nagios_hostgroups = get_nagios_hostgroups(
+        prometheus_api, hostgroup_dictionary)
 
     if not nagios_hosts:
         print("no hosts discovered. Either prometheus is unreachable or is not collecting node metrics.")
         sys.exit(NAGIOS_CRITICAL)
 
-    with open(object_file_loc, 'w+') as object_file:
-        object_file.write("{} \n {}".format(nagios_hosts, nagios_hostgroups))
-    reload_nagios()
+    previous_content = None
+    if reloader:
+        previous_content = read_file(object_file_loc)
+    if write_if_changed(object_file_loc,
+                        "{} \n {}".format(nagios_hosts, nagios_hostgroups)):
+        if reloader:
+            reloader.changed(previous_content)
+            reloader.reload_if_due()
+        else:
+            reload_nagios()
+        return True
+    return False
+
+
+class NagiosReloader(object):
+    """Reloads Nagios after discovery changes. Changes arriving within
+    window_seconds of the first one share a single reload. With
+    precache_objects the configuration is verified and the precached objects
+    file written first, and a configuration that fails verification is
+    rolled back instead of reloaded. The reload is waited for up to
+    wait_seconds to report how long it took, as seen in the status file, so
+    to within its status_update_interval."""
+
+    def __init__(self, object_file_loc, window_seconds, precache_objects,
+                 nagios_bin, nagios_cfg, status_file,
+                 wait_seconds=NAGIOS_RELOAD_TIMEOUT_SECONDS):
+        self.object_file_loc = object_file_loc
+        self.window_seconds = window_seconds
+        self.precache_objects = precache_objects
+        self.nagios_bin = nagios_bin
+        self.nagios_cfg = nagios_cfg
+        self.status_file = status_file
+        self.wait_seconds = wait_seconds
+        self.pending_since = None
+        self.pending_changes = 0
+        self.rollback_content = None
+
+    def changed(self, previous_content):
+        if self.pending_since is None:
+            self.pending_since = time.time()
+            self.rollback_content = previous_content
+        self.pending_changes += 1
+
+    def due_in(self):
+        """seconds until the pending reload is due, None if none pending"""
+        if self.pending_since is None:
+            return None
+        return max(0, self.pending_since + self.window_seconds - time.time())
+
+    def reload_if_due(self):
+        if self.due_in() == 0:
+            self.reload()
+
+    def reload(self):
+        if self.pending_since is None:
+            return
+        changes = self.pending_changes
+        rollback_content = self.rollback_content
+        self.pending_since = None
+        self.pending_changes = 0
+        self.rollback_content = None
+
+        preflight_seconds = 0
+        if self.precache_objects:
+            started = time.time()
+            verified = precache_nagios_objects(self.nagios_bin, self.nagios_cfg)
+            preflight_seconds = time.time() - started
+            if not verified:
+                print("Nagios pre-flight check failed, discovery changes rolled back")
+                restore_file(self.object_file_loc, rollback_content)
+                return
+
+        if self.wait_seconds <= 0:
+            reload_nagios()
+            print("Nagios reload requested for {} discovery change(s): pre-flight {:.2f}s".format(
+                changes, preflight_seconds))
+            return
+
+        program_start = read_program_start(self.status_file)
+        started = time.time()
+        reload_nagios()
+        if wait_for_program_start_change(self.status_file, program_start,
+                                         self.wait_seconds):
+            print("Nagios reloaded {} discovery change(s): pre-flight {:.2f}s, reload {:.2f}s".format(
+                changes, preflight_seconds, time.time() - started))
+        else:
+            print("Nagios reload requested for {} discovery change(s): pre-flight {:.2f}s, reload not observed in {} within {}s".format(
+                changes, preflight_seconds, self.status_file,
+                self.wait_seconds))
+
+
+def precache_nagios_objects(nagios_bin, nagios_cfg):
+    """verify the configuration and write the precached objects file,
+    printing the errors nagios reports when that fails"""
+    process = subprocess.Popen([nagios_bin, '-pv', nagios_cfg],
+                               stdout=subprocess.PIPE,
+                               stderr=subprocess.STDOUT)
+    output = process.communicate()[0].decode('utf-8', 'replace')
+    if process.returncode == 0:
+        return True
+    for line in output.splitlines():
+        if line.strip().startswith('Error'):
+            print(line.strip())
+    return False
+
+
+def read_program_start(status_file):
+    try:
+        with open(status_file, 'r') as status:
+            for line in status:
+                line = line.strip()
+                if line.startswith('program_start='):
+                    return line.split('=', 1)[1]
+    except (IOError, OSError):
+        pass
+    return None
+
+
+def wait_for_program_start_change(status_file, program_start,
+                                  timeout_seconds=NAGIOS_RELOAD_TIMEOUT_SECONDS):
+    """nagios resets program_start in the status file once a reload has
+    finished reading the configuration"""
+    if program_start is None:
+        return False
+    deadline = time.time() + timeout_seconds
+    while time.time() < deadline:
+        current = read_program_start(status_file)
+        if current is not None and current != program_start:
+            return True
+        time.sleep(0.1)
+    return False
+
+
+def sleep_with_pending_reload(seconds, reloader):
+    """sleep for seconds, waking up to perform a pending reload when due"""
+    deadline = time.time() + seconds
+    while True:
+        due_in = None
+        if reloader:
+            reloader.reload_if_due()
+            due_in = reloader.due_in()
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            return
+        if due_in is None:
+            time.sleep(remaining)
+        else:
+            time.sleep(min(remaining, due_in))
+
+
+def run_probing_daemon(prometheus_api, object_file_loc, min_update_seconds,
+                       max_update_seconds, reloader=None):
+    """run the full discovery only when the change probe differs from the
+    previous cycle. the sleep time doubles up to max_update_seconds while
+    nothing changes and drops back to min_update_seconds on a change"""
+    update_seconds = min_update_seconds
+    previous_probe = None
+    last_probe_time = None
+    while True:
+        now = time.time()
+        if last_probe_time is None:
+            window_seconds = min_update_seconds
+        else:
+            window_seconds = int(now - last_probe_time) + 1
+        last_probe_time = now
+        probe = probe_discovery_sources(prometheus_api, window_seconds)
+        if probe is None or probe != previous_probe:
+            update_config_file(prometheus_api, object_file_loc, reloader)
+            update_seconds = min_update_seconds
+        else:
+            update_seconds = min(max_update_seconds, update_seconds * 2)
+        previous_probe = probe
+        sleep_with_pending_reload(update_seconds, reloader)
+
+
+def probe_discovery_sources(prometheus_api, window_seconds):
+    """return a small fingerprint of the discovery sources, or None if the
+    probe failed. it holds the current series count of node_uname_info and
+    kube_node_labels and the count of series seen over the last
+    window_seconds: added or removed nodes change the former, relabeled
+    nodes briefly raise the latter because old and new series overlap"""
+    parts = []
+    for metric in ('node_uname_info', 'kube_node_labels'):
+        parts.append('label_replace(count({metric}), "probe", "{metric}", "", "")'.format(
+            metric=metric))
+        parts.append(
+            'label_replace(count(count_over_time({metric}[{window}s])), '
+            '"probe", "{metric}_window", "", "")'.format(
+                metric=metric, window=window_seconds))
+    try:
+        probe_json = query_prometheus(prometheus_api, " or ".join(parts))
+        return tuple(sorted(
+            (result['metric']['probe'], result['value'][1])
+            for result in probe_json['data']['result']))
+    except Exception as e:
+        return None
+
+
+def write_if_changed(object_file_loc, content):
+    """replace object_file_loc with content through a temp file and an
+    atomic rename, unless it already holds exactly that content.
+    returns True when the file was written"""
+    if not isinstance(content, bytes):
+        content = content.encode('utf-8')
+    if file_digest(object_file_loc) == hashlib.sha256(content).hexdigest():
+        return False
+
+    mode = 0o644
+    if os.path.exists(object_file_loc):
+        mode = os.stat(object_file_loc).st_mode & 0o777
+    fd, tmp_path = tempfile.mkstemp(
+        dir=os.path.dirname(os.path.abspath(object_file_loc)),
+        prefix='.' + os.path.basename(object_file_loc))
+    try:
+        with os.fdopen(fd, 'wb') as tmp_file:
+            tmp_file.write(content)
+            tmp_file.flush()
+            os.fsync(tmp_file.fileno())
+        os.chmod(tmp_path, mode)
+        os.rename(tmp_path, object_file_loc)
+    except Exception:
+        os.unlink(tmp_path)
+        raise
+    return True
+
+
+def read_file(path):
+    try:
+        with open(path, 'rb') as existing_file:
+            return existing_file.read()
+    except (IOError, OSError):
+        return None
+
+
+def restore_file(path, content):
+    """put back content returned by read_file, which is None when path did
+    not exist, so the file is removed again"""
+    if content is None:
+        if os.path.exists(path):
+            os.unlink(path)
+    else:
+        write_if_changed(path, content)
+
+
+def file_digest(path):
+    digest = hashlib.sha256()
+    try:
+        with open(path, 'rb') as existing_file:
+            for chunk in iter(lambda: existing_file.read(65536), b''):
+                digest.update(chunk)
+    except (IOError, OSError):
+        return None
+    return digest.hexdigest()
 
 
 def reload_nagios():
@@ -122,14 +470,16 @@ def reload_nagios():
         sys.exit(NAGIOS_CRITICAL)
 
 
-def get_nagios_hostgroups(prometheus_api):
+def get_nagios_hostgroups(prometheus_api, hostgroup_dictionary=None):
+    if hostgroup_dictionary is None:
+        hostgroup_dictionary = get_nagios_hostgroups_dictionary(prometheus_api)
     hostgroup_labels = set()
-    for host, labels in get_nagios_hostgroups_dictionary(
-            prometheus_api).iteritems():
+    for host, labels in hostgroup_dictionary.items():
         hostgroup_labels.update(labels)
 
+    # sorted so an unchanged hostgroup set renders to identical content
     nagios_hostgroups = []
-    for label in hostgroup_labels:
+    for label in sorted(hostgroup_labels):
         nagios_hostgroup_defn = NAGIOS_HOSTGROUP_FORMAT.format(
             hostgroup=label)
         nagios_hostgroups.append(nagios_hostgroup_defn)
@@ -137,10 +487,11 @@ def get_nagios_hostgroups(prometheus_api):
     return "\n".join(nagios_hostgroups)
 
 
-def get_nagios_hostgroups_dictionary(prometheus_api):
+def get_nagios_hostgroups_dictionary(prometheus_api, labels_json=None):
     nagios_hostgroups = {}
     try:
-        labels_json = query_prometheus(prometheus_api, 'kube_node_labels')
+        if labels_json is None:
+            labels_json = query_prometheus(prometheus_api, NODE_LABELS_QUERY)
         for label_dictionary in labels_json['data']['result']:
             host_name = label_dictionary['metric']['node']
             labels = set()
@@ -155,18 +506,23 @@ def get_nagios_hostgroups_dictionary(prometheus_api):
     return nagios_hostgroups
 
 
-def get_nagios_hosts(prometheus_api):
+def get_nagios_hosts(prometheus_api, unames_json=None,
+                     hostgroup_dictionary=None):
     nagios_hosts = []
     try:
-        unames_json = query_prometheus(prometheus_api, 'node_uname_info')
-        hostgroup_dictionary = get_nagios_hostgroups_dictionary(prometheus_api)
-        for uname in unames_json['data']['result']:
+        if unames_json is None:
+            unames_json, labels_json = query_prometheus_discovery_sources(
+                prometheus_api)
+            hostgroup_dictionary = get_nagios_hostgroups_dictionary(
+                prometheus_api, labels_json)
+        for uname in sorted(unames_json['data']['result'],
+                            key=lambda uname: uname['metric']['nodename']):
             host_name = uname['metric']['nodename']
             host_ip = uname['metric']['instance'].split(':')[0]
             hostgroups = 'all,base-os'
             if hostgroup_dictionary[host_name]:
                 hostgroups = hostgroups + "," + \
-                    ",".join(hostgroup_dictionary[host_name])
+                    ",".join(sorted(hostgroup_dictionary[host_name]))
                 if hostgroups.find("promenade_genesis") != -1:
                    hostgroups = hostgroups + ",prometheus-hosts"
             nagios_host_defn = NAGIOS_HOST_FORMAT.format(
@@ -179,6 +535,37 @@ def get_nagios_hosts(prometheus_api):
     return "\n".join(nagios_hosts)
 
 
+def query_prometheus_discovery_sources(prometheus_api):
+    """fetch node_uname_info and kube_node_labels once each, in parallel"""
+    try:
+        return query_prometheus_concurrently(
+            prometheus_api, [NODE_UNAME_QUERY, NODE_LABELS_QUERY])
+    except Exception as e:
+        print("Unable to query prometheus at {} to retrieve hosts".format(prometheus_api))
+        sys.exit(NAGIOS_CRITICAL)
+
+
+def query_prometheus_concurrently(prometheus_api, queries):
+    responses = [None] * len(queries)
+    errors = []
+
+    def run_query(position, query):
+        try:
+            responses[position] = query_prometheus(prometheus_api, query)
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=run_query, args=(position, query))
+               for position, query in enumerate(queries)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if errors:
+        raise errors[0]
+    return responses
+
+
 def query_prometheus(prometheus_api, query):
     url = "{}/api/v1/query".format(include_schema(prometheus_api))
     params = {"query": query}
@@ -0,0 +1,192 @@
+#!/usr/bin/env python
+# Copyright 2017 The Openstack-Helm Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# Posts the events spooled by send_http_post_event.py --spool_file.
+# Examples:
+# /usr/lib/nagios/plugins/deliver_http_post_events.py
+#                      --spool_file /opt/nagios/var/http_post_events.db
+#                      -d
+# Events are taken from the spool in batches and posted over keep-alive
+# connections kept per URL. An event is removed once its URL answered, and
+# retried with exponential backoff after a connection error or a 5xx
+# response, until --max_attempts.
+# Given the --suppress_state_file of send_http_post_event.py, the daemon
+# also spools the summaries of coalesced service notifications once their
+# window is over, so they are sent without waiting for a next notification.
+import argparse
+import json
+import sys
+import time
+
+import requests
+
+from eventspool import EventSpool
+from notification_suppressor import add_suppressor_arguments
+from notification_suppressor import FLUSH_INTERVAL_SECONDS
+from notification_suppressor import suppressor_from_args
+
+STATE_OK = 0
+STATE_WARNING = 1
+STATE_UNKNOWN = 3
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Deliver spooled HTTP POST events')
+    parser.add_argument('--spool_file', metavar='spool_file', type=str,
+                        required=True,
+                        help='Spool written by send_http_post_event.py')
+    parser.add_argument(
+        '--batch_size',
+        metavar='batch_size',
+        type=int,
+        required=False,
+        default=100,
+        help='Events taken from the spool at a time')
+    parser.add_argument(
+        '--timeout',
+        metavar='timeout',
+        type=float,
+        required=False,
+        default=5,
+        help='Seconds to wait for a URL to answer')
+    parser.add_argument(
+        '--max_attempts',
+        metavar='max_attempts',
+        type=int,
+        required=False,
+        default=10,
+        help='Attempts before a delivery is dropped, 0 to retry until the'
+             ' spool drops it for its size')
+    parser.add_argument(
+        '--interval',
+        metavar='interval',
+        type=float,
+        required=False,
+        default=1,
+        help='When run as daemon, longest wait for new events in seconds')
+    parser.add_argument(
+        '-d',
+        action='store_true',
+        help="Flag to run as a deamon")
+    add_suppressor_arguments(parser)
+
+    args = parser.parse_args()
+
+    try:
+        spool = EventSpool(args.spool_file)
+    except Exception as e:
+        print("Unknown: unable to open spool {}. {}".format(
+            args.spool_file, str(e)))
+        sys.exit(STATE_UNKNOWN)
+
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=4)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+
+    if args.d:
+        suppressor = suppressor_from_args(args, 'http')
+        flushed = time.time()
+        while True:
+            if suppressor and time.time() - flushed >= FLUSH_INTERVAL_SECONDS:
+                flushed = time.time()
+                try:
+                    spool_summaries(spool, suppressor.flush(flushed))
+                except Exception as e:
+                    print("Error flushing notification summaries: {}".format(
+                        str(e)))
+            try:
+                drain(spool, session, args.batch_size, args.timeout,
+                      args.max_attempts)
+                next_attempt = spool.next_attempt()
+            except Exception as e:
+                print("Error delivering events: {}".format(str(e)))
+                next_attempt = None
+            wait = args.interval
+            if next_attempt is not None:
+                wait = min(wait, max(0, next_attempt - time.time()))
+            time.sleep(wait)
+    else:
+        delivered, retried, dropped = drain(
+            spool, session, args.batch_size, args.timeout, args.max_attempts)
+        message = "delivered {}, retrying {}, dropped {} deliveries".format(
+            delivered, retried, dropped)
+        if retried or dropped:
+            print("Warning: {}".format(message))
+            sys.exit(STATE_WARNING)
+        print("OK: {}".format(message))
+        sys.exit(STATE_OK)
+
+
+def spool_summaries(spool, summaries):
+    """spool the SvcEvent of every NotificationSuppressor summary for the
+    urls its notification was sent to"""
+    for hostname, servicedesc, state_id, output, context in summaries:
+        spool.append(context['urls'], json.dumps({'SvcEvent': {
+            'SvcHostname': hostname,
+            'SvcDesc': servicedesc,
+            'SvcStateID': state_id,
+            'SvcOutput': output,
+            'MonitoringHostName': context['monitoring_hostname']
+        }}))
+
+
+def drain(spool, session, batch_size, timeout, max_attempts):
+    """post every due delivery of an event to a url, return (delivered,
+    retried, dropped) counts of deliveries"""
+    delivered = retried = dropped = 0
+    while True:
+        rows = spool.due(batch_size)
+        if not rows:
+            break
+        succeeded, failed = post_batch(session, rows, timeout)
+        spool.delivered(succeeded)
+        dropped += spool.failed(failed, max_attempts)
+        delivered += len(succeeded)
+        # failed deliveries are rescheduled, so they are not due again here
+        retried += len(failed)
+    return delivered, retried - dropped, dropped
+
+
+def post_batch(session, rows, timeout):
+    """post (id, url, payload, attempts) rows, return the ids of delivered
+    rows and the (id, attempts) of rows to retry. once a URL fails the
+    rest of its rows in the batch are retried later without posting"""
+    succeeded = []
+    failed = []
+    unavailable = set()
+    for id, url, payload, attempts in rows:
+        if url in unavailable:
+            failed.append((id, attempts))
+            continue
+        try:
+            response = session.post(url, data=payload, timeout=timeout,
+                                    verify=False)  # nosec
+            if response.status_code >= 500:
+                raise requests.exceptions.HTTPError(
+                    "{} answered {}".format(url, response.status_code))
+            if response.status_code >= 400:
+                # the event will not be accepted on a retry either
+                print("Event rejected by {} with {}: {}".format(
+                    url, response.status_code, payload))
+            succeeded.append(id)
+        except requests.exceptions.RequestException:
+            unavailable.add(url)
+            failed.append((id, attempts))
+    return succeeded, failed
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,118 @@
+#!/usr/bin/env python
+# Copyright 2017 The Openstack-Helm Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Durable spool of events waiting to be posted to a URL.
+
+Event handlers append to the spool and return immediately, a delivery
+worker drains it. The spool is a SQLite database in WAL mode, so appends
+from many handler processes do not block the worker reading it, and an
+event is only removed once it has been delivered. Every (event, url) pair
+is its own row, a delivery retried with exponential backoff independently
+of the other URLs of the event, and the spool is bounded in deliveries."""
+
+import sqlite3
+import time
+
+BUSY_TIMEOUT_SECONDS = 10
+BACKOFF_BASE_SECONDS = 1
+BACKOFF_MAX_SECONDS = 300
+
+
+def backoff_seconds(attempts):
+    """seconds to wait before the next attempt after attempts failures"""
+    return min(BACKOFF_MAX_SECONDS,
+               BACKOFF_BASE_SECONDS * 2 ** min(attempts - 1, 16))
+
+
+class EventSpool(object):
+
+    def __init__(self, path, max_deliveries=10000):
+        self.max_deliveries = max_deliveries
+        self.connection = sqlite3.connect(path, timeout=BUSY_TIMEOUT_SECONDS)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        # a committed append survives a crash of the process, WAL with
+        # synchronous NORMAL only risks the last commits on power loss
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        with self.connection:
+            self.connection.execute(
+                'CREATE TABLE IF NOT EXISTS events ('
+                ' id INTEGER PRIMARY KEY AUTOINCREMENT,'
+                ' url TEXT NOT NULL,'
+                ' payload TEXT NOT NULL,'
+                ' created REAL NOT NULL,'
+                ' attempts INTEGER NOT NULL DEFAULT 0,'
+                ' next_attempt REAL NOT NULL DEFAULT 0)')
+            self.connection.execute(
+                'CREATE INDEX IF NOT EXISTS events_next_attempt'
+                ' ON events (next_attempt)')
+
+    def close(self):
+        self.connection.close()
+
+    def append(self, urls, payload):
+        """spool payload once for every url, return the number of the
+        oldest deliveries dropped to stay within max_deliveries"""
+        now = time.time()
+        with self.connection:
+            self.connection.executemany(
+                'INSERT INTO events (url, payload, created, next_attempt)'
+                ' VALUES (?, ?, ?, ?)',
+                [(url, payload, now, now) for url in urls])
+            return self.trim()
+
+    def trim(self):
+        count = self.connection.execute(
+            'SELECT COUNT(*) FROM events').fetchone()[0]
+        if count <= self.max_deliveries:
+            return 0
+        self.connection.execute(
+            'DELETE FROM events WHERE id IN'
+            ' (SELECT id FROM events ORDER BY id LIMIT ?)',
+            (count - self.max_deliveries,))
+        return count - self.max_deliveries
+
+    def due(self, limit, now=None):
+        """return up to limit (id, url, payload, attempts) rows whose next
+        attempt is due, oldest first"""
+        return self.connection.execute(
+            'SELECT id, url, payload, attempts FROM events'
+            ' WHERE next_attempt <= ? ORDER BY id LIMIT ?',
+            (time.time() if now is None else now, limit)).fetchall()
+
+    def delivered(self, ids):
+        with self.connection:
+            self.connection.executemany(
+                'DELETE FROM events WHERE id = ?', [(id,) for id in ids])
+
+    def failed(self, rows, max_attempts=None, now=None):
+        """reschedule (id, attempts) rows with backoff, dropping those that
+        reached max_attempts. return the number of dropped rows"""
+        now = time.time() if now is None else now
+        dropped = [(id,) for id, attempts in rows
+                   if max_attempts and attempts + 1 >= max_attempts]
+        retried = [(attempts + 1, now + backoff_seconds(attempts + 1), id)
+                   for id, attempts in rows
+                   if not (max_attempts and attempts + 1 >= max_attempts)]
+        with self.connection:
+            self.connection.executemany(
+                'DELETE FROM events WHERE id = ?', dropped)
+            self.connection.executemany(
+                'UPDATE events SET attempts = ?, next_attempt = ?'
+                ' WHERE id = ?', retried)
+        return len(dropped)
+
+    def next_attempt(self):
+        """time of the earliest pending attempt, None if the spool is empty"""
+        return self.connection.execute(
+            'SELECT MIN(next_attempt) FROM events').fetchone()[0]
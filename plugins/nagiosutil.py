@@ -18,9 +18,14 @@
 from __future__ import print_function
 import os
 import sys
+import time
 
 from contextlib import contextmanager
 
+# writes to a FIFO up to this size are atomic, so a batch of external
+# commands is never interleaved with commands written by other processes
+PIPE_BUF = 4096
+
 
 class NagiosUtil(object):
     @staticmethod
@@ -42,3 +47,33 @@ class NagiosUtil(object):
     def service_unknown(message):
         print('UNKNOWN: %s' % message)
         sys.exit(3)
+
+    @staticmethod
+    def submit_service_check_results(command_file, results):
+        """write PROCESS_SERVICE_CHECK_RESULT external commands to the nagios
+        command file for (host_name, service_description, return_code,
+        plugin_output) tuples, batching as many lines per write as fit in
+        PIPE_BUF. returns the number of results written"""
+        now = int(time.time())
+        batch = []
+        batch_size = 0
+        count = 0
+        fd = os.open(command_file, os.O_WRONLY | os.O_APPEND)
+        try:
+            for host_name, service_description, return_code, output in results:
+                line = '[%d] PROCESS_SERVICE_CHECK_RESULT;%s;%s;%d;%s\n' % (
+                    now, host_name, service_description, return_code,
+                    output.strip().replace('\n', '\\n'))
+                line = line.encode('utf-8')
+                if batch and batch_size + len(line) > PIPE_BUF:
+                    os.write(fd, b''.join(batch))
+                    batch = []
+                    batch_size = 0
+                batch.append(line)
+                batch_size += len(line)
+                count += 1
+            if batch:
+                os.write(fd, b''.join(batch))
+        finally:
+            os.close(fd)
+        return count
@@ -0,0 +1,244 @@
+#!/usr/bin/env python
+# Copyright 2017 The Openstack-Helm Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Suppression and coalescing of service notifications.
+
+Notifications whose output matches a suppressible pattern are dropped. The
+patterns are compiled into a single regular expression, from a file with
+one pattern per line or from the patterns send_service_trap.sh has always
+skipped.
+
+The remaining notifications are counted per (channel, service, state,
+normalized output) in a SQLite state file shared by every notification
+handler, the channel keeping the SNMP and HTTP handlers of one notification
+apart. The first notification of a key is sent and opens a window, repeats
+within the window are only counted, and once the window is over the repeats
+are returned as a single summary notification. Summaries are returned with
+the next notification handled on the channel, and by flush(), which the
+resident sender and delivery worker of a channel call periodically, so a
+storm that stops still gets its summary.
+
+Suppression fails open: a state file that can not be opened, or is locked
+or unwritable while a notification is checked, is printed and the
+notification is sent unsuppressed."""
+
+import json
+import re
+import sqlite3
+import time
+
+DEFAULT_PATTERNS = ("NRPE: Unable to read output",
+                    "(Service Check Timed Out)",
+                    "Connection refused by host",
+                    "CHECK_NRPE: .* Could not complete SSL handshake",
+                    "(Return code of 255 is out of bounds)",
+                    "NRPE: Command .* not defined")
+DEFAULT_WINDOW_SECONDS = 300
+FLUSH_INTERVAL_SECONDS = 10
+BUSY_TIMEOUT_SECONDS = 10
+SUMMARY_HOSTS = 10
+
+NUMBERS = re.compile(r'\d+(\.\d+)?')
+WHITESPACE = re.compile(r'\s+')
+
+
+def load_patterns(patterns_file=None):
+    """return the patterns of patterns_file, one per line with # comments,
+    or the default patterns"""
+    if not patterns_file:
+        return list(DEFAULT_PATTERNS)
+    with open(patterns_file, 'r') as patterns:
+        return [line.strip() for line in patterns
+                if line.strip() and not line.strip().startswith('#')]
+
+
+def compile_patterns(patterns):
+    """one regular expression matching wherever any of patterns matches"""
+    if not patterns:
+        return None
+    return re.compile('|'.join('(?:{})'.format(pattern)
+                               for pattern in patterns))
+
+
+def normalize_output(hostname, output):
+    """output without what differs between hosts and between repeats"""
+    if hostname:
+        output = output.replace(hostname, '<host>')
+    output = NUMBERS.sub('#', output)
+    return WHITESPACE.sub(' ', output).strip()[:256]
+
+
+def add_suppressor_arguments(parser):
+    parser.add_argument(
+        '--suppress_state_file',
+        type=str,
+        required=False,
+        help='suppress and coalesce service notifications, counting them'
+             ' in this state file')
+    parser.add_argument(
+        '--suppress_patterns_file',
+        type=str,
+        required=False,
+        help='suppressible output patterns, one per line')
+    parser.add_argument(
+        '--suppress_window',
+        type=int,
+        required=False,
+        default=DEFAULT_WINDOW_SECONDS,
+        help='seconds repeated notifications are coalesced for')
+
+
+def suppressor_from_args(args, channel):
+    """return the NotificationSuppressor of channel for the
+    add_suppressor_arguments() arguments, None when suppression is not
+    enabled or its files can not be used"""
+    if not args.suppress_state_file:
+        return None
+    try:
+        return NotificationSuppressor(
+            args.suppress_state_file, channel, args.suppress_window,
+            load_patterns(args.suppress_patterns_file))
+    except Exception as e:
+        print("Unable to use suppressor state file {}, notifications are"
+              " not suppressed: {}".format(args.suppress_state_file, str(e)))
+        return None
+
+
+def check_notification(suppressor, hostname, servicedesc, state_id, output,
+                       context=None):
+    """suppressor.check() of a single notification, closing the suppressor
+    afterwards. the notification is sent without summaries when the check
+    fails"""
+    try:
+        return suppressor.check(hostname, servicedesc, state_id, output,
+                                context)
+    except Exception as e:
+        print("Unable to check notification suppression, sending it: {}".format(
+            str(e)))
+        return True, []
+    finally:
+        suppressor.close()
+
+
+class NotificationSuppressor(object):
+
+    def __init__(self, state_file, channel, window=DEFAULT_WINDOW_SECONDS,
+                 patterns=DEFAULT_PATTERNS):
+        self.channel = channel
+        self.window = window
+        self.matcher = compile_patterns(patterns)
+        # transactions are started explicitly with BEGIN IMMEDIATE
+        self.connection = sqlite3.connect(
+            state_file, timeout=BUSY_TIMEOUT_SECONDS, isolation_level=None)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        columns = [row[1] for row in self.connection.execute(
+            'PRAGMA table_info(windows)')]
+        if columns and 'channel' not in columns:
+            # windows of a state file written before channels are dropped
+            self.connection.execute('DROP TABLE windows')
+        self.connection.execute(
+            'CREATE TABLE IF NOT EXISTS windows ('
+            ' key TEXT PRIMARY KEY,'
+            ' channel TEXT NOT NULL,'
+            ' hostname TEXT NOT NULL,'
+            ' servicedesc TEXT NOT NULL,'
+            ' state_id INTEGER NOT NULL,'
+            ' output TEXT NOT NULL,'
+            ' context TEXT NOT NULL,'
+            ' started REAL NOT NULL,'
+            ' expires REAL NOT NULL,'
+            ' repeats INTEGER NOT NULL DEFAULT 0,'
+            ' hosts TEXT NOT NULL DEFAULT \'[]\')')
+        self.connection.execute(
+            'CREATE INDEX IF NOT EXISTS windows_expires'
+            ' ON windows (channel, expires)')
+
+    def close(self):
+        self.connection.close()
+
+    def is_suppressible(self, output):
+        return bool(self.matcher and self.matcher.search(output or ''))
+
+    def check(self, hostname, servicedesc, state_id, output, context=None,
+              now=None):
+        """return whether the notification is to be sent, and the summary
+        notifications of the channel whose windows are over, as (hostname,
+        servicedesc, state_id, output, context) tuples. context is what the
+        channel needs to send a summary of this notification, such as its
+        targets, and is returned as given"""
+        if self.is_suppressible(output):
+            return False, []
+        now = time.time() if now is None else now
+        key = json.dumps([self.channel, servicedesc, state_id,
+                          normalize_output(hostname, output)])
+        self.connection.execute('BEGIN IMMEDIATE')
+        try:
+            summaries = self.expire(now)
+            row = self.connection.execute(
+                'SELECT repeats, hosts FROM windows WHERE key = ?',
+                (key,)).fetchone()
+            if row is None:
+                self.connection.execute(
+                    'INSERT INTO windows (key, channel, hostname,'
+                    ' servicedesc, state_id, output, context, started,'
+                    ' expires) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                    (key, self.channel, hostname, servicedesc, state_id,
+                     output, json.dumps(context), now, now + self.window))
+            else:
+                hosts = json.loads(row[1])
+                if hostname not in hosts and len(hosts) < SUMMARY_HOSTS:
+                    hosts.append(hostname)
+                self.connection.execute(
+                    'UPDATE windows SET repeats = ?, hosts = ? WHERE key = ?',
+                    (row[0] + 1, json.dumps(hosts), key))
+            self.connection.execute('COMMIT')
+        except Exception:
+            self.connection.execute('ROLLBACK')
+            raise
+        return row is None, summaries
+
+    def flush(self, now=None):
+        """return the summary notifications of the channel whose windows
+        are over, as check() does, without handling a notification"""
+        now = time.time() if now is None else now
+        self.connection.execute('BEGIN IMMEDIATE')
+        try:
+            summaries = self.expire(now)
+            self.connection.execute('COMMIT')
+        except Exception:
+            self.connection.execute('ROLLBACK')
+            raise
+        return summaries
+
+    def expire(self, now):
+        """remove the windows of the channel that are over, return the
+        summaries of those with repeats"""
+        rows = self.connection.execute(
+            'SELECT hostname, servicedesc, state_id, output, context,'
+            ' expires - started, repeats, hosts FROM windows'
+            ' WHERE channel = ? AND expires <= ? AND repeats > 0',
+            (self.channel, now)).fetchall()
+        self.connection.execute(
+            'DELETE FROM windows WHERE channel = ? AND expires <= ?',
+            (self.channel, now))
+        summaries = []
+        for (hostname, servicedesc, state_id, output, context, window,
+             repeats, hosts) in rows:
+            summaries.append((hostname, servicedesc, state_id,
+                              "{} more notifications within {:g} seconds on"
+                              " {}: {}".format(repeats, window,
+                                               ','.join(json.loads(hosts)),
+                                               output),
+                              json.loads(context)))
+        return summaries
@@ -0,0 +1,130 @@
+#!/usr/bin/env python
+# Copyright 2017 The Openstack-Helm Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Incremental parser for the prometheus text exposition format.
+
+Lines are consumed one at a time, so a response can be parsed while it is
+being downloaded. Only the lines of the requested metric families are parsed
+beyond their metric name, and since the format keeps all lines of a family
+together, reading stops as soon as every requested family has been seen."""
+
+import re
+
+from collections import namedtuple
+
+# sample names that belong to a family besides the family name itself
+FAMILY_SUFFIXES = ('_bucket', '_count', '_sum', '_total', '_created')
+
+LABEL_PAIR = re.compile(
+    r'\s*([a-zA-Z_][a-zA-Z0-9_]*)\s*=\s*"((?:[^"\\]|\\.)*)"\s*(,?)')
+LABEL_VALUE_ESCAPE = re.compile(r'\\(.)')
+METRIC_NAME_END = re.compile(r'[{\s]')
+
+Sample = namedtuple('Sample', ['family', 'name', 'labels', 'value',
+                               'timestamp', 'series'])
+
+
+def iter_samples(lines, families=None):
+    """yield a Sample for every sample line of the requested metric families,
+    or of all families if families is None. lines may be str or bytes, as
+    returned by requests' Response.iter_lines()"""
+    wanted = None
+    remaining = None
+    if families is not None:
+        wanted = {}
+        for family in families:
+            for suffix in FAMILY_SUFFIXES:
+                wanted.setdefault(family + suffix, family)
+        for family in families:
+            wanted[family] = family
+        remaining = set(families)
+        if not remaining:
+            return
+
+    current_family = None
+    header_family = None
+    for line in lines:
+        if isinstance(line, bytes):
+            line = line.decode('utf-8')
+        line = line.strip()
+        if not line:
+            continue
+        if line[0] == '#':
+            tokens = line.split(None, 3)
+            if len(tokens) < 3 or tokens[1] not in ('HELP', 'TYPE'):
+                continue
+            name = tokens[2]
+            header_family = name
+            is_sample = False
+        else:
+            match = METRIC_NAME_END.search(line)
+            name = line[:match.start()] if match else line
+            is_sample = True
+
+        if wanted is not None:
+            family = wanted.get(name)
+        elif header_family and (
+                name == header_family or
+                (name.startswith(header_family) and
+                 name[len(header_family):] in FAMILY_SUFFIXES)):
+            family = header_family
+        else:
+            family = name
+        if current_family is not None and family != current_family:
+            if remaining is not None:
+                remaining.discard(current_family)
+                if not remaining:
+                    return
+        current_family = family
+        if is_sample and family is not None:
+            yield parse_sample(line, name, family)
+
+
+def parse_sample(line, name, family=None):
+    """parse one sample line whose metric name is already known"""
+    labels = {}
+    position = len(name)
+    if position < len(line) and line[position] == '{':
+        position += 1
+        while True:
+            while position < len(line) and line[position] == ' ':
+                position += 1
+            if position < len(line) and line[position] == '}':
+                position += 1
+                break
+            match = LABEL_PAIR.match(line, position)
+            if not match:
+                raise ValueError("invalid labels in sample: {}".format(line))
+            labels[match.group(1)] = unescape_label_value(match.group(2))
+            position = match.end()
+            if not match.group(3):
+                while position < len(line) and line[position] == ' ':
+                    position += 1
+                if position >= len(line) or line[position] != '}':
+                    raise ValueError(
+                        "invalid labels in sample: {}".format(line))
+
+    tokens = line[position:].split()
+    if not tokens or len(tokens) > 2:
+        raise ValueError("invalid value in sample: {}".format(line))
+    value = float(tokens[0])
+    timestamp = int(tokens[1]) if len(tokens) == 2 else None
+    return Sample(family or name, name, labels, value, timestamp,
+                  line[:position].strip())
+
+
+def unescape_label_value(value):
+    return LABEL_VALUE_ESCAPE.sub(
+        lambda match: '\n' if match.group(1) == 'n' else match.group(1),
+        value)
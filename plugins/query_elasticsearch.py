@@ -25,11 +25,18 @@ import sys
 
 import argparse
 import datetime
+import hashlib
 import json
+import os
 from pprint import pprint
 import requests
+import tempfile
 
 from nagiosutil import NagiosUtil
+from snapshot_cache import read_snapshot
+from snapshot_cache import write_snapshot
+
+STORED_TEMPLATE_PREFIX = 'nagios-query-'
 
 
 def check_range(value):
@@ -66,6 +73,16 @@ def check_match(value):
                                          % value)
 
 
+def check_granularity(value):
+    """validate time granularity"""
+    seconds = int(value)
+    if seconds < 0 or seconds > 3600:
+        raise argparse.ArgumentTypeError('%s is an invalid time granularity.'
+                                         ' Valid values are between 0 and 3600'
+                                         ' seconds.' % value)
+    return seconds
+
+
 def setup_argparse(parser):
     """setup argparse parser with arguments and help texts"""
     range_help = ('relative time range between now and x minutes ago.'
@@ -78,6 +95,23 @@ def setup_argparse(parser):
                   ' ex. field1:value1,field2:value2,...')
     critical_threshold_help = ('Status is Critical if the'
                                ' number of hits >= the threshold')
+    count_only_help = ('only count hits, without fetching documents, and stop'
+                       ' counting once the threshold is reached')
+    time_granularity_help = ('align the time range to multiples of this many'
+                             ' seconds and allow elasticsearch to cache the'
+                             ' shard results, so identical queries within'
+                             ' the same interval share them. elasticsearch'
+                             ' only caches requests without documents, so it'
+                             ' requires --count_only, --group_by or'
+                             ' --incremental. default is 0, not aligned')
+    incremental_help = ('count the range from per minute counts kept in a'
+                        ' local state file, and only query the minutes since'
+                        ' the last run and the trailing --late_minutes')
+    group_by_help = ('field to group the hits by, the threshold applies to'
+                     ' the hits of every value of the field and one result'
+                     ' is returned per value')
+    stored_template_help = ('store the query template in elasticsearch once'
+                            ' and invoke it by id with only the params')
 
     parser.add_argument('endpoint', help=endpoint_help)
     parser.add_argument('index', help='elasticsearch index')
@@ -93,11 +127,53 @@ def setup_argparse(parser):
     parser.add_argument('--match', type=check_match, help=match_help)
     parser.add_argument('--range', type=check_range, default=5,
                         help=range_help)
+    parser.add_argument('--count_only', action='store_true',
+                        help=count_only_help)
+    parser.add_argument('--time_granularity', type=check_granularity,
+                        default=0, help=time_granularity_help)
+    parser.add_argument('--incremental', action='store_true',
+                        help=incremental_help)
+    parser.add_argument('--late_minutes', type=int, default=2,
+                        help='with --incremental, minutes counted again on'
+                             ' every run for late arriving documents,'
+                             ' default is 2')
+    parser.add_argument('--state_dir',
+                        help='with --incremental, directory of the state'
+                             ' files, default is the temp directory')
+    parser.add_argument('--group_by', help=group_by_help)
+    parser.add_argument('--group_size', type=check_threshold, default=100,
+                        help='with --group_by, most matching values returned,'
+                             ' default is 100')
+    parser.add_argument('--groups',
+                        help='with --group_by, comma separated values that'
+                             ' always get a result, also without hits')
+    parser.add_argument('--command_file',
+                        help='with --group_by, submit one passive result per'
+                             ' value to this nagios command file, with the'
+                             ' value as host name')
+    parser.add_argument('--service_description',
+                        help='with --command_file, service of the passive'
+                             ' results')
+    parser.add_argument('--stored_template', action='store_true',
+                        help=stored_template_help)
     parser.add_argument('--usr')
     parser.add_argument('--pwd')
     parser.add_argument('--debug', action='store_true')
 
 
+def get_time_range(args, now):
+    """return the (lt, gte) times of the search range ending at now, aligned
+    to args.time_granularity seconds. elasticsearch only caches requests it
+    has seen before, so the bounds must not change within an interval"""
+    lt_time = now
+    if args.time_granularity:
+        epoch = datetime.datetime(1970, 1, 1)
+        seconds = int((now - epoch).total_seconds())
+        lt_time = epoch + datetime.timedelta(
+            seconds=seconds - seconds % args.time_granularity)
+    return lt_time, lt_time - datetime.timedelta(minutes=(int(args.range)))
+
+
 def get_index_name(args, lt_time, gte_time):
     """build the index name(s) based on the inputs and current time"""
     log_lt = args.index + '-' + lt_time.strftime('%Y.%m.%d')
@@ -110,55 +186,9 @@ def get_index_name(args, lt_time, gte_time):
     return es_index
 
 
-def evaluate_results(response, args):
-    """evaluate the results of the query against the threshold to
-      determine the nagios service status"""
-    if (not response or not hasattr(response, 'status_code')
-            or response.status_code < 200 or response.status_code >= 400
-            or not response.json()):
-        NagiosUtil.service_unknown('Unexpected results found. ' + response.text)
-    elif (not response.json()['hits']
-          or int(response.json()['hits']['total']) < 0):
-        NagiosUtil.service_unknown('Unexpected results found. ' + str(response.json()))
-
-    if args.debug:
-        pprint(response.json())
-
-    results = response.json()
-    hits = results['hits']['total']
-
-    message = ('Found %s >= %s(threshold) occurrences'
-               ' within the last %s minute(s). %s')
-
-    if hits >= args.critical_threshold:
-        NagiosUtil.service_critical(message % (str(hits), args.critical_threshold,
-                                               args.range, args.critical_msg))
-    else:
-        NagiosUtil.service_ok(args.ok_msg)
-
-
-def main():
-    """Query elasticsearch using a combination of simple query pattern,
-    field matches, and/or query clause, then evaluate the results against
-    the alert threshold, and finally return a status to nagios."""
-
-    desc = ('Elasticsearch query using a combination of simple query pattern,'
-            ' field matches, and/or query clause. Evaluate the results'
-            ' against the alert threshold, and return a status to'
-            ' nagios.'
-            ' ex. \"query_elasticsearch.py endpoint index index_type'
-            ' ok_msg critical_msg critical_threshold'
-            ' --query_file query_file_name'
-            ' --simple_query simple_query'
-            ' --simple_query_fields fields'
-            ' --match f1:v1,f2:v2 --range 5 --debug\"')
-    parser = argparse.ArgumentParser(description=desc)
-    setup_argparse(parser)
-    args = parser.parse_args()
-
-    lt_time = datetime.datetime.utcnow()
-    gte_time = lt_time - datetime.timedelta(minutes=(int(args.range)))
-
+def build_search_template(args, lt_time, gte_time):
+    """build the search template and params for the time range, match
+    clauses, simple query and query file clause of args"""
     data = {
         "inline": {
             "query": {
@@ -179,6 +209,13 @@ def main():
         }
     }
 
+    if args.count_only:
+        # hits are only compared with the threshold, so no document needs
+        # to be fetched, and every shard may stop counting at the threshold:
+        # the summed total still reaches it exactly when the real one does
+        data['inline']['size'] = 0
+        data['inline']['terminate_after'] = args.critical_threshold
+
     simple_query_clause = {
         "simple_query_string": {
             "fields": ["{{fields}}"],
@@ -206,26 +243,371 @@ def main():
         params['query'] = args.simple_query
 
     data['params'] = params
+    return data
 
-    url = (args.endpoint + '/' + get_index_name(args, lt_time, gte_time) + '/'
-           + args.index_type + '/' + '_search/template/?ignore_unavailable=true')
+
+def to_stored_template(data):
+    """return the stored script id and source of a search template, and
+    the search template invoking it by id with only the params. the id is
+    derived from the source, so a changed query is stored under a new id"""
+    source = json.dumps(data['inline'], sort_keys=True, separators=(',', ':'))
+    template_id = (STORED_TEMPLATE_PREFIX
+                   + hashlib.sha1(source.encode('utf-8')).hexdigest())
+    return template_id, source, {'id': template_id, 'params': data['params']}
+
+
+def is_missing_template(error):
+    """whether an elasticsearch error refers to an unknown stored script"""
+    error = str(error).lower()
+    return ('resource_not_found_exception' in error
+            or 'unable to find script' in error)
+
+
+def store_search_template(endpoint, template_id, source, auth=None):
+    """store a mustache search template source under template_id"""
+    body = {'script': {'lang': 'mustache', 'source': source}}
+    response = requests.post(endpoint + '/_scripts/' + template_id,
+                             data=json.dumps(body), auth=auth,
+                             headers={"Content-Type": "application/json"})
+    if not 200 <= response.status_code < 300:
+        raise ValueError('Unable to store search template %s. %s'
+                         % (template_id, response.text))
+
+
+def post_search_template(args, url, data):
+    """post a search template, invoking it by id with --stored_template and
+    storing it first if elasticsearch does not know it yet"""
+    stored_template = None
+    if args.stored_template:
+        stored_template = to_stored_template(data)
+        data = stored_template[2]
 
     if args.debug:
         print('query url:\n' + url)
         print('query data:')
         pprint(data)
 
+    auth = (args.usr, args.pwd) if args.usr and args.pwd else None
+    response = requests.post(url, data=json.dumps(data), auth=auth,
+                             headers={"Content-Type": "application/json"})
+    if (stored_template and response.status_code >= 400
+            and is_missing_template(response.text)):
+        # first run of this query, or the cluster state was lost
+        store_search_template(args.endpoint, stored_template[0],
+                              stored_template[1], auth)
+        response = requests.post(url, data=json.dumps(data), auth=auth,
+                                 headers={"Content-Type": "application/json"})
+    return response
+
+
+def evaluate_results(response, args):
+    """evaluate the results of the query against the threshold to
+      determine the nagios service status"""
+    results = None
+    if (response and hasattr(response, 'status_code')
+            and 200 <= response.status_code < 400):
+        try:
+            results = response.json()
+        except ValueError:
+            results = None
+    if not results:
+        NagiosUtil.service_unknown('Unexpected results found. ' + response.text)
+
+    if args.debug:
+        pprint(results)
+
+    exit_with_status(*get_status(results, args))
+
+
+def exit_with_status(status, message):
+    """exit with the nagios state of a get_status() result"""
+    if status == 'critical':
+        NagiosUtil.service_critical(message)
+    elif status == 'unknown':
+        NagiosUtil.service_unknown(message)
+    else:
+        NagiosUtil.service_ok(message)
+
+
+def get_hits(results):
+    """total hits of a parsed search response, None if it has none"""
+    if not results or not results.get('hits'):
+        return None
+    total = results['hits'].get('total')
+    if isinstance(total, dict):  # elasticsearch 7 reports {"value": n}
+        total = total.get('value')
+    if total is None or int(total) < 0:
+        return None
+    return int(total)
+
+
+def get_status(results, args):
+    """return ('ok' | 'critical' | 'unknown', message) for a parsed search
+    response"""
+    hits = get_hits(results)
+    if hits is None:
+        return 'unknown', 'Unexpected results found. ' + str(results)
+
+    message = ('Found %s >= %s(threshold) occurrences'
+               ' within the last %s minute(s). %s')
+
+    if hits >= args.critical_threshold:
+        return 'critical', message % (format_hits(results, hits),
+                                      args.critical_threshold, args.range,
+                                      args.critical_msg)
+    return 'ok', args.ok_msg
+
+
+def format_hits(results, hits):
+    """hits as reported, 'at least' when the shards stopped counting at
+    terminate_after or elasticsearch 7 stopped tracking the total"""
+    total = results['hits'].get('total')
+    if results.get('terminated_early') or (
+            isinstance(total, dict) and total.get('relation') == 'gte'):
+        return 'at least %s' % hits
+    return str(hits)
+
+
+def build_histogram_template(args, lt_time, gte_time):
+    """build the search template counting the matches of every minute
+    between gte_time and lt_time"""
+    data = build_search_template(args, lt_time, gte_time)
+    # every match has to be counted for the minutes to add up to the range
+    data['inline'].pop('terminate_after', None)
+    data['inline']['size'] = 0
+    data['inline']['aggs'] = {
+        'per_minute': {
+            'date_histogram': {'field': '@timestamp', 'interval': '1m'}
+        }
+    }
+    return data
+
+
+def get_minute_counts(results):
+    """return {minute since epoch: count} of a per minute histogram response,
+    None if it has none or is incomplete"""
+    try:
+        if results.get('timed_out') or results['_shards'].get('failed'):
+            return None
+        buckets = results['aggregations']['per_minute']['buckets']
+        return dict((int(bucket['key']) // 60000, int(bucket['doc_count']))
+                    for bucket in buckets)
+    except (AttributeError, KeyError, TypeError, ValueError):
+        return None
+
+
+def build_terms_template(args, lt_time, gte_time):
+    """build the search template counting the matches of every value of
+    args.group_by between gte_time and lt_time"""
+    data = build_search_template(args, lt_time, gte_time)
+    # every match has to be counted for the threshold of each value
+    data['inline'].pop('terminate_after', None)
+    data['inline']['size'] = 0
+    data['inline']['aggs'] = {
+        'groups': {
+            'terms': {'field': args.group_by, 'size': args.group_size}
+        }
+    }
+    return data
+
+
+def get_group_counts(results):
+    """return [(value, count)] of a terms aggregation response, None if it
+    has none"""
+    try:
+        return [(str(bucket['key']), int(bucket['doc_count']))
+                for bucket in results['aggregations']['groups']['buckets']]
+    except (AttributeError, KeyError, TypeError, ValueError):
+        return None
+
+
+def get_group_statuses(args, group_counts):
+    """return [(value, status, message)] for the counted values, and the
+    --groups values without hits"""
+    counts = dict(group_counts)
+    groups = [value for value, count in group_counts]
+    for value in (args.groups or '').split(','):
+        if value and value not in counts:
+            groups.append(value)
+    return [(value,) + get_status({'hits': {'total': counts.get(value, 0)}},
+                                  args)
+            for value in groups]
+
+
+def evaluate_grouped_results(response, args):
+    """report the status of every group value of a terms aggregation
+    response, as passive results or in a multi-line summary"""
+    group_counts = None
+    if 200 <= response.status_code < 400:
+        try:
+            group_counts = get_group_counts(response.json())
+        except ValueError:
+            group_counts = None
+    if group_counts is None:
+        NagiosUtil.service_unknown('Unexpected results found. ' + response.text)
+
+    statuses = get_group_statuses(args, group_counts)
+    if args.debug:
+        pprint(statuses)
+
+    if args.command_file:
+        nagios_states = {'ok': 0, 'critical': 2, 'unknown': 3}
+        try:
+            submitted = NagiosUtil.submit_service_check_results(
+                args.command_file,
+                [(value, args.service_description, nagios_states[status],
+                  message) for value, status, message in statuses])
+        except Exception as ex:
+            NagiosUtil.service_unknown('Unable to submit results. ' + str(ex))
+        NagiosUtil.service_ok('submitted %d %s results'
+                              % (submitted, args.group_by))
+
+    critical = [value for value, status, message in statuses
+                if status == 'critical']
+    lines = ['%s: %s: %s' % (value, status.upper(), message)
+             for value, status, message in statuses]
+    if critical:
+        NagiosUtil.service_critical(
+            '%d of %d %s values have >= %s(threshold) occurrences: %s\n%s'
+            % (len(critical), len(statuses), args.group_by,
+               args.critical_threshold, ','.join(critical), '\n'.join(lines)))
+    NagiosUtil.service_ok('%s\n%s' % (args.ok_msg, '\n'.join(lines)))
+
+
+def get_state_file(args, lt_time, gte_time):
+    """return the state file of the query of args, and the key identifying
+    the query inside it"""
+    data = build_histogram_template(args, lt_time, gte_time)
+    params = dict((name, value) for name, value in data['params'].items()
+                  if name not in ('lt_timestamp', 'gte_timestamp'))
+    key = hashlib.sha1(json.dumps(
+        [args.endpoint, args.index, args.index_type, args.range,
+         data['inline'], params], sort_keys=True).encode('utf-8')).hexdigest()
+    state_file = os.path.join(args.state_dir or tempfile.gettempdir(),
+                              'elasticsearch_counts_{}.json'.format(key))
+    return state_file, key
+
+
+def evaluate_incremental(args, now):
+    """return get_status() of the range ending at now, summed from the per
+    minute counts of earlier runs and of the minutes queried now. the state
+    is dropped and the whole range counted again after a gap longer than
+    the range, a query change or a change of the daily indices covered"""
+    lt_time, gte_time = get_time_range(args, now)
+    epoch = datetime.datetime(1970, 1, 1)
+    end_minute = int((lt_time - epoch).total_seconds()) // 60
+    start_minute = end_minute - int(args.range)
+    indices = get_index_name(args, lt_time, gte_time)
+    state_file, key = get_state_file(args, lt_time, gte_time)
+
+    minutes = {}
+    fetch_start = start_minute
+    state = read_snapshot(state_file, int(args.range) * 60)
+    if (state and state.get('query') == key and state.get('indices') == indices
+            and start_minute <= state['until'] <= end_minute):
+        fetch_start = max(start_minute, state['until'] - args.late_minutes)
+        minutes = dict((int(minute), count)
+                       for minute, count in state['minutes'].items()
+                       if start_minute <= int(minute) < fetch_start)
+
+    if fetch_start < end_minute:
+        fetch_gte = epoch + datetime.timedelta(minutes=fetch_start)
+        url = (args.endpoint + '/' + get_index_name(args, lt_time, fetch_gte)
+               + '/' + args.index_type + '/_search/template/'
+               '?ignore_unavailable=true'
+               '&filter_path=aggregations,_shards.failed,timed_out,error')
+        if args.time_granularity:
+            url += '&request_cache=true'
+        response = post_search_template(
+            args, url, build_histogram_template(args, lt_time, fetch_gte))
+        counts = None
+        if 200 <= response.status_code < 400:
+            try:
+                counts = get_minute_counts(response.json())
+            except ValueError:
+                counts = None
+        if counts is None:
+            return 'unknown', 'Unexpected results found. ' + response.text
+        minutes.update((minute, count) for minute, count in counts.items()
+                       if fetch_start <= minute < end_minute)
+
+    try:
+        write_snapshot(state_file, {'query': key, 'indices': indices,
+                                    'until': end_minute, 'minutes': minutes})
+    except (IOError, OSError):
+        pass  # the next run counts the whole range again
+
+    return get_status({'hits': {'total': sum(minutes.values())}}, args)
+
+
+def main(argv=None):
+    """Query elasticsearch using a combination of simple query pattern,
+    field matches, and/or query clause, then evaluate the results against
+    the alert threshold, and finally return a status to nagios."""
+
+    desc = ('Elasticsearch query using a combination of simple query pattern,'
+            ' field matches, and/or query clause. Evaluate the results'
+            ' against the alert threshold, and return a status to'
+            ' nagios.'
+            ' ex. \"query_elasticsearch.py endpoint index index_type'
+            ' ok_msg critical_msg critical_threshold'
+            ' --query_file query_file_name'
+            ' --simple_query simple_query'
+            ' --simple_query_fields fields'
+            ' --match f1:v1,f2:v2 --range 5 --debug\"')
+    parser = argparse.ArgumentParser(description=desc)
+    setup_argparse(parser)
+    args = parser.parse_args(argv)
+
+    if args.command_file and not (args.group_by and args.service_description):
+        parser.error('--command_file requires --group_by and'
+                     ' --service_description')
+    if args.incremental and args.group_by:
+        parser.error('--incremental can not be combined with --group_by')
+    if args.time_granularity and not (args.count_only or args.group_by
+                                      or args.incremental):
+        parser.error('--time_granularity requires --count_only, --group_by'
+                     ' or --incremental')
+
+    if args.incremental:
+        if (args.time_granularity or 60) % 60:
+            parser.error('--time_granularity must be a multiple of 60 seconds'
+                         ' with --incremental')
+        args.time_granularity = args.time_granularity or 60
+        try:
+            exit_with_status(*evaluate_incremental(
+                args, datetime.datetime.utcnow()))
+        except requests.exceptions.RequestException as req_ex:
+            NagiosUtil.service_unknown('Unexpected Error Occurred. '
+                                       + str(req_ex))
+        except ValueError as val_ex:
+            NagiosUtil.service_unknown(str(val_ex))
+
+    lt_time, gte_time = get_time_range(args, datetime.datetime.utcnow())
+
+    if args.group_by:
+        data = build_terms_template(args, lt_time, gte_time)
+    else:
+        data = build_search_template(args, lt_time, gte_time)
+
+    url = (args.endpoint + '/' + get_index_name(args, lt_time, gte_time) + '/'
+           + args.index_type + '/' + '_search/template/?ignore_unavailable=true')
+    if args.group_by:
+        url += '&filter_path=aggregations.groups.buckets,error'
+    elif args.count_only:
+        url += '&filter_path=hits.total,terminated_early,error'
+    if args.time_granularity:
+        url += '&request_cache=true'
+
     try:
-        if args.usr and args.pwd:
-            response = requests.post(url, data=json.dumps(data),
-                                     headers={"Content-Type": "application/json"},
-                                     auth=(args.usr, args.pwd))
-        else:
-            response = requests.post(url, data=json.dumps(data),
-                                     headers={"Content-Type": "application/json"})
+        response = post_search_template(args, url, data)
     except requests.exceptions.RequestException as req_ex:
         NagiosUtil.service_unknown('Unexpected Error Occurred. ' + str(req_ex))
+    except ValueError as val_ex:
+        NagiosUtil.service_unknown(str(val_ex))
 
+    if args.group_by:
+        evaluate_grouped_results(response, args)
     evaluate_results(response, args)
 
 
@@ -0,0 +1,269 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright 2017 The Openstack-Helm Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""Run many query_elasticsearch.py checks as one _msearch/template request.
+
+The definitions file holds a JSON list of checks, each with the positional
+arguments and options of query_elasticsearch.py as keys, ex.
+    {
+        "service_description": "Logs_nova_errors",
+        "index": "logstash",
+        "index_type": "fluentd",
+        "ok_msg": "no nova errors",
+        "critical_msg": "nova errors found",
+        "critical_threshold": 5,
+        "match": "application:nova,level:ERROR",
+        "range": 10
+    }
+The queries are built exactly as query_elasticsearch.py builds them, and
+each response is evaluated against its own threshold."""
+
+from __future__ import print_function
+
+import sys
+
+import argparse
+import datetime
+import json
+from pprint import pprint
+import requests
+
+from nagiosutil import NagiosUtil
+from query_elasticsearch import build_search_template
+from query_elasticsearch import get_index_name
+from query_elasticsearch import get_status
+from query_elasticsearch import get_time_range
+from query_elasticsearch import is_missing_template
+from query_elasticsearch import setup_argparse
+from query_elasticsearch import store_search_template
+from query_elasticsearch import to_stored_template
+
+NAGIOS_STATES = {'ok': 0, 'critical': 2, 'unknown': 3}
+STATE_SEVERITY = ['ok', 'unknown', 'critical']
+
+DEFINITION_OPTIONS = ('query_file', 'query_clause', 'simple_query',
+                      'simple_query_fields', 'match', 'range',
+                      'time_granularity')
+
+
+class DefinitionParser(argparse.ArgumentParser):
+    """query_elasticsearch.py arguments, raising instead of exiting"""
+
+    def error(self, message):
+        raise ValueError(message)
+
+
+def parse_definition(endpoint, definition, count_only, stored_template=False):
+    """return the query_elasticsearch.py arguments for a definition"""
+    argv = [endpoint]
+    for key in ('index', 'index_type', 'ok_msg', 'critical_msg',
+                'critical_threshold'):
+        if definition.get(key) is None:
+            raise ValueError('%s is required in definition %s'
+                             % (key, definition))
+        argv.append(str(definition[key]))
+    for key in DEFINITION_OPTIONS:
+        if definition.get(key) is not None:
+            argv.extend(['--' + key, str(definition[key])])
+    if count_only or definition.get('count_only'):
+        argv.append('--count_only')
+    if stored_template or definition.get('stored_template'):
+        argv.append('--stored_template')
+    parser = DefinitionParser()
+    setup_argparse(parser)
+    args = parser.parse_args(argv)
+    if args.time_granularity and not args.count_only:
+        # elasticsearch only caches the results of count only searches
+        parser.error('time_granularity requires count_only in definition %s'
+                     % definition)
+    return args
+
+
+def build_msearch_body(checks, now, stored_templates=None):
+    """build the newline delimited _msearch/template body, a header and a
+    search template line per check. the (id, source) of the stored template
+    of each check, or None, is appended to stored_templates if given"""
+    lines = []
+    for args in checks:
+        lt_time, gte_time = get_time_range(args, now)
+        header = {'index': get_index_name(args, lt_time, gte_time),
+                  'type': args.index_type,
+                  'ignore_unavailable': True}
+        if args.time_granularity:
+            header['request_cache'] = True
+        lines.append(json.dumps(header))
+        data = build_search_template(args, lt_time, gte_time)
+        stored_template = None
+        if args.stored_template:
+            template_id, source, data = to_stored_template(data)
+            stored_template = (template_id, source)
+        if stored_templates is not None:
+            stored_templates.append(stored_template)
+        lines.append(json.dumps(data))
+    return '\n'.join(lines) + '\n'
+
+
+def get_missing_templates(response, stored_templates):
+    """return the (id, source) of the stored templates elasticsearch did
+    not find when answering the _msearch request"""
+    try:
+        responses = response.json()['responses']
+    except (ValueError, KeyError, TypeError):
+        return set()
+    return set(stored_template for stored_template, result
+               in zip(stored_templates, responses)
+               if stored_template and 'error' in result
+               and is_missing_template(result['error']))
+
+
+def evaluate_responses(checks, response):
+    """return (status, message) per check from the _msearch response"""
+    try:
+        if response.status_code < 200 or response.status_code >= 400:
+            raise ValueError(response.text)
+        responses = response.json()['responses']
+        if len(responses) != len(checks):
+            raise ValueError('expected %d responses, got %d'
+                             % (len(checks), len(responses)))
+    except Exception as ex:
+        message = 'Unexpected results found. ' + str(ex)
+        return [('unknown', message)] * len(checks)
+
+    results = []
+    for args, result in zip(checks, responses):
+        if 'error' in result:
+            results.append(('unknown',
+                            'Unexpected results found. ' + str(result['error'])))
+        else:
+            results.append(get_status(result, args))
+    return results
+
+
+def main(argv=None):
+    """Run a batch of elasticsearch log checks with a single request and
+    report every result to nagios."""
+
+    desc = ('Run many query_elasticsearch.py checks with a single'
+            ' _msearch/template request. Results are printed one per line'
+            ' after a summary line, or submitted as passive check results'
+            ' with --command_file.'
+            ' ex. \"query_elasticsearch_batch.py endpoint definitions_file'
+            ' --command_file /opt/nagios/var/rw/nagios.cmd'
+            ' --host_name elasticsearch\"')
+    parser = argparse.ArgumentParser(description=desc)
+    parser.add_argument('endpoint', help='elasticsearch API service endpoint url')
+    parser.add_argument('definitions_file',
+                        help='JSON list of query_elasticsearch.py checks')
+    parser.add_argument('--command_file',
+                        help='submit results as passive checks to this'
+                             ' nagios command file')
+    parser.add_argument('--host_name',
+                        help='nagios host of definitions without host_name')
+    parser.add_argument('--count_only', action='store_true',
+                        help='run every check in count only mode')
+    parser.add_argument('--stored_template', action='store_true',
+                        help='invoke every check query as a stored template')
+    parser.add_argument('--time_granularity', type=int, default=0,
+                        help='time_granularity of count only definitions'
+                             ' without one')
+    parser.add_argument('--usr')
+    parser.add_argument('--pwd')
+    parser.add_argument('--debug', action='store_true')
+    args = parser.parse_args(argv)
+
+    try:
+        with open(args.definitions_file, 'r') as definitions_json:
+            definitions = json.load(definitions_json)
+        for definition in definitions:
+            if args.time_granularity and (args.count_only
+                                          or definition.get('count_only')):
+                definition.setdefault('time_granularity', args.time_granularity)
+        checks = [parse_definition(args.endpoint, definition, args.count_only,
+                                   args.stored_template)
+                  for definition in definitions]
+        if args.command_file:
+            for definition in definitions:
+                definition.setdefault('host_name', args.host_name)
+                if not definition['host_name'] or \
+                        not definition.get('service_description'):
+                    raise ValueError('host_name and service_description are'
+                                     ' required in definition %s with'
+                                     ' --command_file' % definition)
+    except Exception as ex:
+        NagiosUtil.service_unknown('Invalid check definitions. ' + str(ex))
+
+    if not checks:
+        NagiosUtil.service_ok('no check definitions')
+
+    url = args.endpoint + '/_msearch/template'
+    if all(check.count_only for check in checks):
+        url += ('?filter_path=responses.hits.total,'
+                'responses.terminated_early,responses.error')
+    stored_templates = []
+    data = build_msearch_body(checks, datetime.datetime.utcnow(),
+                              stored_templates)
+
+    if args.debug:
+        print('query url:\n' + url)
+        print('query data:\n' + data)
+
+    try:
+        auth = (args.usr, args.pwd) if args.usr and args.pwd else None
+        response = requests.post(url, data=data, auth=auth,
+                                 headers={"Content-Type": "application/x-ndjson"})
+        missing_templates = get_missing_templates(response, stored_templates)
+        if missing_templates:
+            for template_id, source in sorted(missing_templates):
+                store_search_template(args.endpoint, template_id, source, auth)
+            response = requests.post(
+                url, data=data, auth=auth,
+                headers={"Content-Type": "application/x-ndjson"})
+        results = evaluate_responses(checks, response)
+    except requests.exceptions.RequestException as req_ex:
+        results = [('unknown', 'Unexpected Error Occurred. ' + str(req_ex))
+                   ] * len(checks)
+    except ValueError as val_ex:
+        results = [('unknown', str(val_ex))] * len(checks)
+
+    if args.debug:
+        pprint(results)
+
+    if args.command_file:
+        try:
+            submitted = NagiosUtil.submit_service_check_results(
+                args.command_file,
+                [(definition['host_name'], definition['service_description'],
+                  NAGIOS_STATES[status], message)
+                 for definition, (status, message) in zip(definitions, results)])
+        except Exception as ex:
+            NagiosUtil.service_unknown('Unable to submit results. ' + str(ex))
+        NagiosUtil.service_ok('submitted %d elasticsearch check results'
+                              % submitted)
+
+    worst = max([status for status, message in results],
+                key=STATE_SEVERITY.index)
+    failing = len([status for status, message in results if status != 'ok'])
+    print('%s: %d of %d elasticsearch checks are not OK'
+          % (worst.upper(), failing, len(results)))
+    for definition, (status, message) in zip(definitions, results):
+        name = definition.get('service_description', definition['index'])
+        print('%s: %s: %s' % (name, status.upper(), message))
+    sys.exit(NAGIOS_STATES[worst])
+
+
+if __name__ == '__main__':
+    sys.exit(main())
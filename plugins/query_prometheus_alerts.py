@@ -20,17 +20,46 @@
 #                      --msg_format 'statefulset {statefulset} has low replica count'
 # Output:
 #  CRITICAL: statefulset prometheus has low replica count
+#
+# With --cache_ttl the full ALERTS vector is fetched at most once per ttl
+# into a snapshot file shared by all invocations, and filtered locally:
+# /opt/nagios/libexec/query_prometheus_alerts.py
+#                      --prometheus_api http://prom-metrics.openstack.svc.cluster.local:9090
+#                      --alertname statefulset_replicas_unavailable
+#                      --labels_csv 'statefulset="prometheus"'
+#                      --msg_format 'statefulset {statefulset} has low replica count'
+#                      --cache_ttl 30
+#
+# With --fused_query and --metrics_csv the ALERTS series and the absent()
+# result of every listed metric are fetched in one request, tagged with a
+# nagios_part label, and the missing metrics are named in the output.
+#
+# With --source rules_api active alerts are read from /api/v1/alerts, which
+# is served by the rule manager without touching storage, and filtered by
+# alertname and --labels_csv locally.
 import argparse
+import hashlib
+import os
+import re
 import sys
+import tempfile
 import requests
 
+from snapshot_cache import load_snapshot
+
 STATE_OK = 0
 STATE_WARNING = 1
 STATE_CRITICAL = 2
 STATE_UNKNOWN = 3
 
+SNAPSHOT_QUERY_TIMEOUT_SECONDS = 10
+
+LABEL_MATCHER = re.compile(
+    r'\s*([a-zA-Z_][a-zA-Z0-9_]*)\s*(=~|!~|!=|=)\s*'
+    r'(?:"((?:[^"\\]|\\.)*)"|\'((?:[^\'\\]|\\.)*)\')\s*(,|$)')
+
 
-def main():
+def main(argv=None):
     parser = argparse.ArgumentParser(
         description='Nagios plugin to query prometheus ALERTS metric')
     parser.add_argument('--prometheus_api', metavar='prometheus_api', type=str,
@@ -66,11 +95,55 @@ def main():
         type=str,
         required=False,
         help='Check if metrics are available, raise unknown if not available. example: metric1,metric2')
+    parser.add_argument(
+        '--cache_ttl',
+        metavar='cache_ttl',
+        type=int,
+        required=False,
+        default=0,
+        help='Seconds to reuse a shared snapshot of all prometheus ALERTS instead of querying per check. 0 disables the cache.')
+    parser.add_argument(
+        '--cache_file',
+        metavar='cache_file',
+        type=str,
+        required=False,
+        help='Location of the shared ALERTS snapshot. Defaults to a file per prometheus_api in the temp directory.')
+    parser.add_argument(
+        '--source',
+        metavar='source',
+        type=str,
+        required=False,
+        choices=['query', 'rules_api'],
+        default='query',
+        help='Read alerts from an ALERTS instant query or from the /api/v1/alerts rules API.')
+    parser.add_argument(
+        '--fused_query',
+        action='store_true',
+        help='Query alerts and --metrics_csv availability in a single request and report the missing metrics. Requires --metrics_csv and the query source without --cache_ttl.')
 
-    args = parser.parse_args()
+    args = parser.parse_args(argv)
+    if args.fused_query:
+        if not args.metrics_csv:
+            parser.error('--fused_query requires --metrics_csv')
+        if args.cache_ttl > 0 or args.source != 'query':
+            parser.error('--fused_query can not be used with --cache_ttl or'
+                         ' --source rules_api')
 
-    prometheus_response, error_messages = query_prometheus(
-        args.prometheus_api, args.alertname, args.labels_csv)
+    missing_metrics = None
+    if args.cache_ttl > 0:
+        prometheus_response, error_messages = query_prometheus_snapshot(
+            args.prometheus_api, args.alertname, args.labels_csv,
+            args.cache_ttl, args.cache_file, args.source)
+    elif args.source == 'rules_api':
+        prometheus_response, error_messages = query_prometheus_rules_api(
+            args.prometheus_api, args.alertname, args.labels_csv)
+    elif args.fused_query and args.metrics_csv:
+        prometheus_response, missing_metrics, error_messages = query_prometheus_fused(
+            args.prometheus_api, args.alertname, args.labels_csv,
+            args.metrics_csv.split(","))
+    else:
+        prometheus_response, error_messages = query_prometheus(
+            args.prometheus_api, args.alertname, args.labels_csv)
     if error_messages:
         print(
             "Unknown: unable to query prometheus alerts. {}".format(
@@ -82,53 +155,111 @@ def main():
                 str(prometheus_response)))
         sys.exit(STATE_UNKNOWN)
 
-    firingScalarMessages = []
-    for metric in prometheus_response['data']['result']:
-        alertstate = metric['metric']['alertstate']
-        message = args.msg_format.format(**metric['metric'])
-        if alertstate == 'firing':
-            firingScalarMessages.append(message)
+    firingScalarMessages = get_firing_messages(
+        prometheus_response['data']['result'], args.msg_format)
 
     if firingScalarMessages:
         print(",".join(firingScalarMessages))
         sys.exit(STATE_CRITICAL)
     else:
-        if args.metrics_csv:
+        if missing_metrics:
+            print(get_metrics_unavailable_message(",".join(missing_metrics)))
+            sys.exit(STATE_UNKNOWN)
+        elif args.metrics_csv and missing_metrics is None:
             metrics_available, error_messages = check_prom_metrics_available(
                 args.prometheus_api, args.metrics_csv.split(","), args.labels_csv)
             if not metrics_available and not error_messages:
-                print(
-                    "UNKNOWN: no metrics available to evaluate alert. Please ensure following metrics are flowing to the system: {}".format(
-                        args.metrics_csv))
+                print(get_metrics_unavailable_message(args.metrics_csv))
                 sys.exit(STATE_UNKNOWN)
-        if args.ok_message:
-            print(args.ok_message)
-        else:
-            if args.labels_csv:
-                print(
-                    "OK: no alerts with prometheus alertname={alertname} and labels {labels}".format(
-                        alertname=args.alertname,
-                        labels=args.labels_csv))
-            else:
-                print(
-                    "OK: no alerts with prometheus alertname={alertname}".format(
-                        alertname=args.alertname))
+        print(get_ok_message(args.alertname, args.labels_csv, args.ok_message))
         sys.exit(STATE_OK)
 
 
+def get_firing_messages(result, msg_format):
+    firingScalarMessages = []
+    for metric in result:
+        alertstate = metric['metric']['alertstate']
+        message = msg_format.format(**metric['metric'])
+        if alertstate == 'firing':
+            firingScalarMessages.append(message)
+    return firingScalarMessages
+
+
+def get_metrics_unavailable_message(metrics_csv):
+    return "UNKNOWN: no metrics available to evaluate alert. Please ensure following metrics are flowing to the system: {}".format(
+        metrics_csv)
+
+
+def get_ok_message(alertname, labels_csv, ok_message):
+    if ok_message:
+        return ok_message
+    if labels_csv:
+        return "OK: no alerts with prometheus alertname={alertname} and labels {labels}".format(
+            alertname=alertname,
+            labels=labels_csv)
+    return "OK: no alerts with prometheus alertname={alertname}".format(
+        alertname=alertname)
+
+
 def query_prometheus(prometheus_api, alertname, labels_csv):
+    promql = 'ALERTS{alertname="' + alertname + '"'
+    if labels_csv:
+        promql = promql + "," + labels_csv
+    promql = promql + "}"
+    return execute_promql(prometheus_api, promql)
+
+
+def query_prometheus_fused(prometheus_api, alertname, labels_csv, metrics):
+    """query the ALERTS series and absent() of every metric in one request.
+    returns the alerts response, the metrics that are absent and errors"""
+    alerts_promql = 'ALERTS{alertname="' + alertname + '"'
+    if labels_csv:
+        alerts_promql = alerts_promql + "," + labels_csv
+    alerts_promql = alerts_promql + "}"
+    parts = ['label_replace({}, "nagios_part", "alerts", "", "")'.format(
+        alerts_promql)]
+    for metric in metrics:
+        if labels_csv:
+            absent_promql = "absent({metric}{{{labels}}})".format(
+                metric=metric, labels=labels_csv)
+        else:
+            absent_promql = "absent({metric})".format(metric=metric)
+        # nagios_metric keeps each absent() series distinct for "or"
+        parts.append(
+            'label_replace(label_replace({absent}, "nagios_part", "absent", "", ""), '
+            '"nagios_metric", "{metric}", "", "")'.format(
+                absent=absent_promql, metric=metric))
+
+    response_json, error_messages = execute_promql(
+        prometheus_api, " or ".join(parts))
+    missing_metrics = []
+    if error_messages or response_json.get('status') != 'success':
+        return response_json, missing_metrics, error_messages
+
+    alerts = []
+    absent = set()
+    for metric in response_json['data']['result']:
+        part = metric['metric'].pop('nagios_part', None)
+        if part == 'absent':
+            if metric['value'][1] == "1":
+                absent.add(metric['metric'].get('nagios_metric'))
+        else:
+            alerts.append(metric)
+    response_json['data']['result'] = alerts
+    missing_metrics = [metric for metric in metrics if metric in absent]
+    return response_json, missing_metrics, error_messages
+
+
+def execute_promql(prometheus_api, promql, timeout=None):
     error_messages = []
     response_json = dict()
     try:
-        promql = 'ALERTS{alertname="' + alertname + '"'
-        if labels_csv:
-            promql = promql + "," + labels_csv
-        promql = promql + "}"
         query = {'query': promql}
         response = requests.get(
             include_schema(prometheus_api) +
             "/api/v1/query",
-            params=query)
+            params=query,
+            timeout=timeout)
         response_json = response.json()
     except Exception as e:
         error_messages.append(
@@ -138,7 +269,151 @@ def query_prometheus(prometheus_api, alertname, labels_csv):
     return response_json, error_messages
 
 
-def check_prom_metrics_available(prometheus_api, metrics, labels_csv):
+def query_prometheus_rules_api(prometheus_api, alertname, labels_csv):
+    """same result as query_prometheus, built from the rules API"""
+    try:
+        matchers = parse_label_matchers(labels_csv)
+    except ValueError as e:
+        return dict(), [str(e)]
+
+    response_json, error_messages = get_rules_api_alerts(prometheus_api)
+    if error_messages or response_json.get('status') != 'success':
+        return response_json, error_messages
+
+    return filter_alerts(response_json, alertname, matchers), []
+
+
+def get_rules_api_alerts(prometheus_api, timeout=None):
+    """read /api/v1/alerts and shape the active alerts like the response
+    of an ALERTS instant query"""
+    error_messages = []
+    response_json = dict()
+    try:
+        response = requests.get(
+            include_schema(prometheus_api) +
+            "/api/v1/alerts",
+            timeout=timeout)
+        response_json = response.json()
+    except Exception as e:
+        error_messages.append(
+            "ERROR invoking prometheus api {}".format(
+                str(e)))
+    if error_messages or response_json.get('status') != 'success':
+        return response_json, error_messages
+
+    result = []
+    for alert in response_json['data']['alerts']:
+        labels = dict(alert['labels'])
+        labels['__name__'] = 'ALERTS'
+        labels['alertstate'] = alert['state']
+        result.append({'metric': labels, 'value': [0, "1"]})
+    return {'status': 'success',
+            'data': {'resultType': 'vector', 'result': result}}, []
+
+
+def filter_alerts(response_json, alertname, matchers):
+    matchers = [('alertname', '=', alertname)] + matchers
+    result = [metric for metric in response_json['data']['result']
+              if labels_match(metric['metric'], matchers)]
+    return {'status': 'success',
+            'data': {'resultType': 'vector', 'result': result}}
+
+
+def query_prometheus_snapshot(prometheus_api, alertname, labels_csv,
+                              cache_ttl, cache_file=None, source='query'):
+    """same result as query_prometheus, but filtered locally from a
+    snapshot of every ALERTS series shared by all invocations"""
+    try:
+        matchers = parse_label_matchers(labels_csv)
+    except ValueError:
+        # let prometheus interpret selectors we can't evaluate locally, the
+        # rules API can not and reports them
+        if source == 'rules_api':
+            return query_prometheus_rules_api(
+                prometheus_api, alertname, labels_csv)
+        return query_prometheus(prometheus_api, alertname, labels_csv)
+
+    if not cache_file:
+        cache_file = os.path.join(
+            tempfile.gettempdir(),
+            'prometheus_alerts_{}_{}.json'.format(source, hashlib.sha1(
+                include_schema(prometheus_api).encode('utf-8')).hexdigest()[:12]))
+
+    def fetch_all_alerts():
+        if source == 'rules_api':
+            response_json, error_messages = get_rules_api_alerts(
+                prometheus_api, timeout=SNAPSHOT_QUERY_TIMEOUT_SECONDS)
+        else:
+            response_json, error_messages = execute_promql(
+                prometheus_api, 'ALERTS', timeout=SNAPSHOT_QUERY_TIMEOUT_SECONDS)
+        if not error_messages and response_json.get('status') != 'success':
+            error_messages.append(
+                "Error response from prometheus: {}".format(str(response_json)))
+        return response_json, error_messages
+
+    try:
+        snapshot, error_messages = load_snapshot(
+            cache_file, cache_ttl, fetch_all_alerts)
+    except Exception as e:
+        return dict(), ["ERROR using alerts snapshot {}: {}".format(
+            cache_file, str(e))]
+    if error_messages:
+        return dict(), error_messages
+
+    return filter_alerts(snapshot, alertname, matchers), []
+
+
+def parse_label_matchers(labels_csv):
+    """parse a PromQL label selector body such as
+    lab1="val1",lab2=~"val.*" into (label, operator, value) tuples"""
+    matchers = []
+    if not labels_csv or not labels_csv.strip():
+        return matchers
+    position = 0
+    while position < len(labels_csv):
+        match = LABEL_MATCHER.match(labels_csv, position)
+        if not match or match.end() == position:
+            raise ValueError(
+                "unable to parse label matchers {}".format(labels_csv))
+        value = match.group(3)
+        if value is None:
+            value = match.group(4)
+        matchers.append((match.group(1), match.group(2), unescape(value)))
+        position = match.end()
+        if not match.group(5):
+            break
+    if labels_csv[position:].strip():
+        raise ValueError(
+            "unable to parse label matchers {}".format(labels_csv))
+    return matchers
+
+
+def unescape(value):
+    return re.sub(r'\\(.)',
+                  lambda m: '\n' if m.group(1) == 'n' else m.group(1),
+                  value)
+
+
+def labels_match(labels, matchers):
+    """evaluate label matchers the way prometheus does: a missing label
+    is the empty string and regular expressions are fully anchored"""
+    for name, operator, value in matchers:
+        actual = labels.get(name, '')
+        if operator == '=':
+            matched = actual == value
+        elif operator == '!=':
+            matched = actual != value
+        else:
+            matched = re.match('(?:' + value + r')\Z', actual) is not None
+            if operator == '!~':
+                matched = not matched
+        if not matched:
+            return False
+    return True
+
+
+def check_prom_metrics_available(prometheus_api, metrics, labels_csv,
+                                 timeout=None):
     error_messages = []
     metrics_available = False
     try:
@@ -156,13 +431,13 @@ def check_prom_metrics_available(prometheus_api, metrics, labels_csv):
         response = requests.get(
             include_schema(prometheus_api) +
             "/api/v1/query",
-            params=query)
+            params=query,
+            timeout=timeout)
         response_json = response.json()
-        if response_json['data']['result']:
-            if response_json['data']['result'][0]['value'][1] == "1":
-                metrics_available = False
-            else:
-                metrics_available = True
+        # absent() only returns a series for a metric that is missing
+        metrics_available = not any(
+            result['value'][1] == "1"
+            for result in response_json['data']['result'])
     except Exception as e:
         error_messages.append(
             "ERROR invoking prometheus api {}".format(
@@ -0,0 +1,235 @@
+#!/usr/bin/env python
+# Copyright 2017 The Openstack-Helm Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# Evaluates every query_prometheus_alerts.py service definition from one
+# ALERTS query per cycle and submits the results as passive checks.
+# Examples:
+# /opt/nagios/libexec/query_prometheus_alerts_bulk.py
+#                      --prometheus_api http://prom-metrics.openstack.svc.cluster.local:9090
+#                      --definitions_file /opt/nagios/etc/prometheus_alert_services.json
+#                      --command_file /opt/nagios/var/rw/nagios.cmd
+#                      -d
+# where the definitions file holds a list of:
+#    {
+#        "host_name": "prometheus-hosts",
+#        "service_description": "Prometheus_replica-count",
+#        "alertname": "statefulset_replicas_unavailable",
+#        "labels_csv": "statefulset=\"prometheus\"",
+#        "msg_format": "statefulset {statefulset} has low replica count",
+#        "ok_message": "OK: statefulset prometheus replicas are available",
+#        "metrics_csv": "kube_statefulset_replicas"
+#    }
+# host_name defaults to --host_name; labels_csv, ok_message and metrics_csv
+# are optional and behave as the query_prometheus_alerts.py arguments.
+import argparse
+import json
+import sys
+import time
+
+from collections import defaultdict
+
+from nagiosutil import NagiosUtil
+from query_prometheus_alerts import STATE_CRITICAL
+from query_prometheus_alerts import STATE_OK
+from query_prometheus_alerts import STATE_UNKNOWN
+from query_prometheus_alerts import check_prom_metrics_available
+from query_prometheus_alerts import execute_promql
+from query_prometheus_alerts import get_firing_messages
+from query_prometheus_alerts import get_metrics_unavailable_message
+from query_prometheus_alerts import get_ok_message
+from query_prometheus_alerts import labels_match
+from query_prometheus_alerts import parse_label_matchers
+
+FIRING_ALERTS_QUERY = 'ALERTS{alertstate="firing"}'
+QUERY_TIMEOUT_SECONDS = 30
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Evaluate many prometheus alert services with one query and submit passive check results')
+    parser.add_argument('--prometheus_api', metavar='prometheus_api', type=str,
+                        required=True,
+                        help='Prometheus API location with scheme and port')
+    parser.add_argument(
+        '--definitions_file',
+        metavar='definitions_file',
+        type=str,
+        required=True,
+        help='JSON list of service definitions. See examples.')
+    parser.add_argument(
+        '--command_file',
+        metavar='command_file',
+        type=str,
+        required=False,
+        default='/opt/nagios/var/rw/nagios.cmd',
+        help='Nagios external command file')
+    parser.add_argument(
+        '--host_name',
+        metavar='host_name',
+        type=str,
+        required=False,
+        help='Nagios host for definitions that do not set host_name')
+    parser.add_argument(
+        '--interval',
+        metavar='interval',
+        type=int,
+        required=False,
+        default=60,
+        help='When run as daemon, seconds between evaluation cycles')
+    parser.add_argument(
+        '-d',
+        action='store_true',
+        help="Flag to run as a deamon")
+
+    args = parser.parse_args(argv)
+
+    try:
+        definitions = load_definitions(args.definitions_file, args.host_name)
+    except Exception as e:
+        print("Unknown: unable to load service definitions. {}".format(str(e)))
+        sys.exit(STATE_UNKNOWN)
+
+    if args.d:
+        while True:
+            started = time.time()
+            try:
+                run_cycle(args.prometheus_api, definitions, args.command_file)
+            except Exception as e:
+                print("Error submitting prometheus alert results: {}".format(
+                    str(e)))
+            time.sleep(max(0, args.interval - (time.time() - started)))
+    else:
+        try:
+            submitted = run_cycle(
+                args.prometheus_api, definitions, args.command_file)
+        except Exception as e:
+            print("Unknown: unable to submit prometheus alert results. {}".format(
+                str(e)))
+            sys.exit(STATE_UNKNOWN)
+        print("OK: submitted {} prometheus alert service results".format(
+            submitted))
+        sys.exit(STATE_OK)
+
+
+def load_definitions(definitions_file, default_host_name):
+    with open(definitions_file, 'r') as definitions_json:
+        definitions = json.load(definitions_json)
+    for definition in definitions:
+        for key in ('service_description', 'alertname', 'msg_format'):
+            if not definition.get(key):
+                raise ValueError(
+                    "{} is required in definition {}".format(key, definition))
+        definition.setdefault('host_name', default_host_name)
+        if not definition['host_name']:
+            raise ValueError(
+                "host_name is required in definition {} when --host_name is not set".format(
+                    definition))
+        definition['matchers'] = parse_label_matchers(
+            definition.get('labels_csv'))
+    return definitions
+
+
+def run_cycle(prometheus_api, definitions, command_file):
+    results = evaluate_definitions(prometheus_api, definitions)
+    return NagiosUtil.submit_service_check_results(command_file, results)
+
+
+def evaluate_definitions(prometheus_api, definitions):
+    """return (host_name, service_description, state, output) for every
+    definition, using a single ALERTS query for all of them"""
+    prometheus_response, error_messages = execute_promql(
+        prometheus_api, FIRING_ALERTS_QUERY, timeout=QUERY_TIMEOUT_SECONDS)
+    if not error_messages and prometheus_response.get('status') != 'success':
+        error_messages.append(
+            "Error response from prometheus: {}".format(str(prometheus_response)))
+    if error_messages:
+        output = "Unknown: unable to query prometheus alerts. {}".format(
+            ",".join(error_messages))
+        return [(definition['host_name'], definition['service_description'],
+                 STATE_UNKNOWN, output) for definition in definitions]
+
+    index = AlertIndex(prometheus_response['data']['result'])
+    metrics_availability = {}
+    results = []
+    for definition in definitions:
+        try:
+            state, output = evaluate_definition(
+                prometheus_api, index, definition, metrics_availability)
+        except Exception as e:
+            # such as a msg_format naming a label the alert does not have
+            state = STATE_UNKNOWN
+            output = "Unknown: unable to evaluate alert {}. {}".format(
+                definition['alertname'], repr(e))
+        results.append((definition['host_name'],
+                        definition['service_description'], state, output))
+    return results
+
+
+def evaluate_definition(prometheus_api, index, definition,
+                        metrics_availability):
+    """return (state, output) of a definition from the index of the firing
+    alerts. metrics_availability caches the metrics_csv checks of the
+    cycle"""
+    firing = get_firing_messages(
+        index.select(definition['alertname'], definition['matchers']),
+        definition['msg_format'])
+    if firing:
+        return STATE_CRITICAL, ",".join(firing)
+    output = get_ok_message(
+        definition['alertname'], definition.get('labels_csv'),
+        definition.get('ok_message'))
+    metrics_csv = definition.get('metrics_csv')
+    if metrics_csv:
+        # services often share a metric check, ask once per cycle
+        key = (metrics_csv, definition.get('labels_csv'))
+        if key not in metrics_availability:
+            metrics_availability[key] = check_prom_metrics_available(
+                prometheus_api, metrics_csv.split(","),
+                definition.get('labels_csv'), timeout=QUERY_TIMEOUT_SECONDS)
+        metrics_available, metric_errors = metrics_availability[key]
+        if not metrics_available and not metric_errors:
+            return STATE_UNKNOWN, get_metrics_unavailable_message(metrics_csv)
+    return STATE_OK, output
+
+
+class AlertIndex(object):
+    """inverted index of ALERTS series keyed by (alertname, label, value)"""
+
+    def __init__(self, series):
+        self.series = series
+        self.by_alertname = defaultdict(set)
+        self.postings = defaultdict(set)
+        for position, metric in enumerate(series):
+            labels = metric['metric']
+            alertname = labels.get('alertname', '')
+            self.by_alertname[alertname].add(position)
+            for name, value in labels.items():
+                self.postings[(alertname, name, value)].add(position)
+
+    def select(self, alertname, matchers):
+        """return the series of alertname matching every label matcher"""
+        candidates = self.by_alertname.get(alertname, set())
+        postings = [self.postings.get((alertname, name, value), set())
+                    for name, operator, value in matchers
+                    if operator == '=' and value != '']
+        for posting in sorted(postings, key=len):
+            if not candidates:
+                break
+            candidates = candidates & posting
+        return [self.series[position] for position in sorted(candidates)
+                if labels_match(self.series[position]['metric'], matchers)]
+
+
+if __name__ == '__main__':
+    sys.exit(main())
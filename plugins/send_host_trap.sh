@@ -14,6 +14,14 @@
 
 export SNMP_PERSISTENT_DIR="/tmp"
 
+# the resident sender on SNMP_NOTIF_SOCKET sends the traps without snmptrap
+if [ -n "$SNMP_NOTIF_SOCKET" ]; then
+  exec "$(dirname "$0")/send_snmp_trap.py" --type host --community "$1" \
+    --hostname "$2" --state_id "$3" --output "$4" \
+    ${5:+--primary_target "$5"} ${6:+--secondary_target "$6"} \
+    --socket "$SNMP_NOTIF_SOCKET"
+fi
+
 if [ ! -z "$5" ]; then
   /usr/bin/snmptrap -v 2c -c "$1" "$5" '' NAGIOS-NOTIFY-MIB::nHostEvent \
     nHostname s "$2"  \
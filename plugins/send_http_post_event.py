@@ -42,12 +42,22 @@
 #        "SvcOutput":"nova-compute stop/waiting",
 #        "MonitoringHostName":"nagioshost.x.y.com"
 #    }
+#
+# With --spool_file the event is only appended to the spool and posted by
+# deliver_http_post_events.py, which retries undelivered events. Given the
+# same --suppress_state_file, the delivery worker also spools the summaries
+# of coalesced service notifications once their window is over.
 
 import sys
 import requests
 import argparse
 import json
 
+from eventspool import EventSpool
+from notification_suppressor import add_suppressor_arguments
+from notification_suppressor import check_notification
+from notification_suppressor import suppressor_from_args
+
 parser = argparse.ArgumentParser(
     description='HTTP POST event handler for nagios.')
 parser.add_argument(
@@ -96,6 +106,21 @@ parser.add_argument(
     required=False,
     help='secondary REST API with scheme, host, port, api path to POST event to')
 
+parser.add_argument(
+    '--spool_file',
+    type=str,
+    required=False,
+    help='spool the event here for deliver_http_post_events.py instead of'
+         ' posting it')
+parser.add_argument(
+    '--spool_max_deliveries',
+    type=int,
+    required=False,
+    default=10000,
+    help='oldest spooled deliveries, one per event and URL, are dropped'
+         ' beyond this many')
+add_suppressor_arguments(parser)
+
 args = parser.parse_args()
 
 payload = {}
@@ -119,23 +144,65 @@ elif args.type == 'service':
         'MonitoringHostName': args.monitoring_hostname
     }
 
-try:
-    requests.post(
-        args.primary_url,
-        data=json.dumps(payload),
-        timeout=0.0000001,
-        verify=False)
-except Exception as e:
-    pass
-
+urls = [args.primary_url]
 if args.secondary_url:
+    urls.append(args.secondary_url)
+
+payloads = [payload]
+suppressor = None
+if args.type == 'service':
+    suppressor = suppressor_from_args(args, 'http')
+if suppressor:
+    send, summaries = check_notification(
+        suppressor, args.hostname, args.servicedesc, args.state_id,
+        args.output,
+        {'monitoring_hostname': args.monitoring_hostname, 'urls': urls})
+    if not send:
+        print("skipping notification for host: {}, service: {}, service state: {}, service output: {}".format(
+            args.hostname, args.servicedesc, args.state_id, args.output))
+        payloads = []
+    for hostname, servicedesc, state_id, output, context in summaries:
+        payloads.append({'SvcEvent': {
+            'SvcHostname': hostname,
+            'SvcDesc': servicedesc,
+            'SvcStateID': state_id,
+            'SvcOutput': output,
+            'MonitoringHostName': context['monitoring_hostname']
+        }})
+
+if args.spool_file:
+    try:
+        spool = EventSpool(args.spool_file, args.spool_max_deliveries)
+        try:
+            dropped = 0
+            for payload in payloads:
+                dropped += spool.append(urls, json.dumps(payload))
+        finally:
+            spool.close()
+        if dropped:
+            print("Spool full, dropped {} oldest deliveries".format(dropped))
+    except Exception as e:
+        print("Unable to spool event: {}".format(str(e)))
+    sys.exit(0)
+
+for payload in payloads:
     try:
         requests.post(
-            args.secondary_url,
+            args.primary_url,
             data=json.dumps(payload),
             timeout=0.0000001,
             verify=False)
     except Exception as e:
         pass
 
+    if args.secondary_url:
+        try:
+            requests.post(
+                args.secondary_url,
+                data=json.dumps(payload),
+                timeout=0.0000001,
+                verify=False)
+        except Exception as e:
+            pass
+
 sys.exit(0)
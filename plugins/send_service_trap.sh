@@ -18,6 +18,19 @@
 
 export SNMP_PERSISTENT_DIR="/tmp"
 
+# with a suppressor state file, send_snmp_trap.py suppresses the patterns of
+# NOTIF_SUPPRESSOR_PATTERNS_FILE, coalesces repeated notifications and sends
+# the traps itself, through the resident sender on SNMP_NOTIF_SOCKET if set
+if [ -n "$NOTIF_SUPPRESSOR_STATE_FILE" ]; then
+  exec "$(dirname "$0")/send_snmp_trap.py" --type service --community "$1" \
+    --hostname "$2" --servicedesc "$3" --state_id "$4" --output "$5" \
+    ${6:+--primary_target "$6"} ${7:+--secondary_target "$7"} \
+    ${SNMP_NOTIF_SOCKET:+--socket "$SNMP_NOTIF_SOCKET"} \
+    --suppress_state_file "$NOTIF_SUPPRESSOR_STATE_FILE" \
+    ${NOTIF_SUPPRESSOR_PATTERNS_FILE:+--suppress_patterns_file "$NOTIF_SUPPRESSOR_PATTERNS_FILE"} \
+    ${NOTIF_SUPPRESSOR_WINDOW:+--suppress_window "$NOTIF_SUPPRESSOR_WINDOW"}
+fi
+
 suppressible_patterns=("NRPE: Unable to read output"
                        "(Service Check Timed Out)"
                        "Connection refused by host"
@@ -42,6 +55,17 @@ if [ $match -eq 1 ]; then
    exit 0
 fi
 
+# the resident sender on SNMP_NOTIF_SOCKET sends the traps without snmptrap
+# (an array, as isSuppressiblePattern left IFS empty)
+if [ -n "$SNMP_NOTIF_SOCKET" ]; then
+  targets=()
+  [ -n "$6" ] && targets+=(--primary_target "$6")
+  [ -n "$7" ] && targets+=(--secondary_target "$7")
+  exec "$(dirname "$0")/send_snmp_trap.py" --type service --community "$1" \
+    --hostname "$2" --servicedesc "$3" --state_id "$4" --output "$5" \
+    "${targets[@]}" --socket "$SNMP_NOTIF_SOCKET"
+fi
+
 if [ ! -z "$6" ]; then
   /usr/bin/snmptrap -v 2c -c "$1" "$6" '' NAGIOS-NOTIFY-MIB::nSvcEvent \
     nSvcHostname s "$2" \
@@ -0,0 +1,377 @@
+#!/usr/bin/env python
+# Copyright 2017 The Openstack-Helm Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# Sends the NAGIOS-NOTIFY-MIB nHostEvent and nSvcEvent SNMPv2c traps of
+# send_host_trap.sh and send_service_trap.sh without forking snmptrap or
+# loading the MIBs: the OIDs are resolved in advance and every constant
+# part of the PDU is encoded once.
+# Examples:
+# /usr/lib/nagios/plugins/send_snmp_trap.py
+#                      --type service
+#                      --community public
+#                      --hostname 'hostwithevent.y.x.com'
+#                      --servicedesc 'Service_nova-compute'
+#                      --state_id 2
+#                      --output 'nova-compute stop/waiting'
+#                      --primary_target 192.168.0.1:15132
+#                      --secondary_target 192.168.0.2:15132
+# sends to both collectors the equivalent of
+#    snmptrap -v 2c -c public 192.168.0.1:15132 '' NAGIOS-NOTIFY-MIB::nSvcEvent
+#        nSvcHostname s 'hostwithevent.y.x.com' nSvcDesc s 'Service_nova-compute'
+#        nSvcStateID i 2 nSvcOutput s 'nova-compute stop/waiting'
+#
+# /usr/lib/nagios/plugins/send_snmp_trap.py --serve --socket /tmp/snmp_trap.sock
+# runs the resident sender: it keeps one connected UDP socket per collector
+# and sends the notifications it receives on the local socket in batches.
+# Given --socket, the command above hands its notification to the resident
+# sender, and only sends the traps itself when none is listening. Given
+# --suppress_state_file as well, the resident sender also sends the summary
+# traps of coalesced service notifications once their window is over.
+import argparse
+import errno
+import json
+import os
+import random
+import socket
+import sys
+import time
+
+from notification_suppressor import add_suppressor_arguments
+from notification_suppressor import check_notification
+from notification_suppressor import FLUSH_INTERVAL_SECONDS
+from notification_suppressor import suppressor_from_args
+
+DEFAULT_TRAP_PORT = 162
+SNMP_VERSION_2C = 1
+MAX_DATAGRAM_BYTES = 65507
+SERVE_BATCH_SIZE = 256
+
+# BER tags
+INTEGER = 0x02
+OCTET_STRING = 0x04
+OBJECT_IDENTIFIER = 0x06
+SEQUENCE = 0x30
+TIMETICKS = 0x43
+SNMPV2_TRAP_PDU = 0xa7
+
+SYS_UPTIME_0 = '1.3.6.1.2.1.1.3.0'
+SNMP_TRAP_OID_0 = '1.3.6.1.6.3.1.1.4.1.0'
+
+# NAGIOS-NOTIFY-MIB, nagiosNotify is { enterprises nagios(20006) 1 }
+NAGIOS_NOTIFY = '1.3.6.1.4.1.20006.1'
+N_HOST_EVENT = NAGIOS_NOTIFY + '.5'
+N_SVC_EVENT = NAGIOS_NOTIFY + '.7'
+N_HOST_EVENT_ENTRY = NAGIOS_NOTIFY + '.1.1'
+N_SVC_EVENT_ENTRY = NAGIOS_NOTIFY + '.3.1'
+
+# the varbinds of each trap type: (event field, OID, BER type)
+EVENT_VARBINDS = {
+    'host': (N_HOST_EVENT, [
+        ('hostname', N_HOST_EVENT_ENTRY + '.2', OCTET_STRING),    # nHostname
+        ('state_id', N_HOST_EVENT_ENTRY + '.4', INTEGER),         # nHostStateID
+        ('output', N_HOST_EVENT_ENTRY + '.14', OCTET_STRING),     # nHostOutput
+    ]),
+    'service': (N_SVC_EVENT, [
+        ('hostname', N_SVC_EVENT_ENTRY + '.2', OCTET_STRING),     # nSvcHostname
+        ('servicedesc', N_SVC_EVENT_ENTRY + '.6', OCTET_STRING),  # nSvcDesc
+        ('state_id', N_SVC_EVENT_ENTRY + '.7', INTEGER),          # nSvcStateID
+        ('output', N_SVC_EVENT_ENTRY + '.17', OCTET_STRING),      # nSvcOutput
+    ]),
+}
+
+
+def encode_length(length):
+    if length < 0x80:
+        return bytearray([length])
+    octets = bytearray()
+    while length:
+        octets.insert(0, length & 0xff)
+        length >>= 8
+    return bytearray([0x80 | len(octets)]) + octets
+
+
+def encode_tlv(tag, value):
+    return bytearray([tag]) + encode_length(len(value)) + value
+
+
+def encode_integer(value, tag=INTEGER):
+    octets = bytearray()
+    while True:
+        octets.insert(0, value & 0xff)
+        value >>= 8
+        if (value == 0 and not octets[0] & 0x80) or \
+                (value == -1 and octets[0] & 0x80):
+            break
+    return encode_tlv(tag, octets)
+
+
+def encode_octet_string(value):
+    if not isinstance(value, bytes):
+        value = value.encode('utf-8')
+    return encode_tlv(OCTET_STRING, bytearray(value))
+
+
+def encode_oid(oid):
+    arcs = [int(arc) for arc in oid.split('.')]
+    octets = bytearray([arcs[0] * 40 + arcs[1]])
+    for arc in arcs[2:]:
+        encoded = bytearray([arc & 0x7f])
+        arc >>= 7
+        while arc:
+            encoded.insert(0, 0x80 | (arc & 0x7f))
+            arc >>= 7
+        octets += encoded
+    return encode_tlv(OBJECT_IDENTIFIER, octets)
+
+
+class TrapTemplate(object):
+    """pre-encoded parts of the trap of one event type"""
+
+    def __init__(self, event_type):
+        trap_oid, varbinds = EVENT_VARBINDS[event_type]
+        self.sys_uptime_name = encode_oid(SYS_UPTIME_0)
+        self.trap_oid_varbind = encode_tlv(
+            SEQUENCE, encode_oid(SNMP_TRAP_OID_0) + encode_oid(trap_oid))
+        self.varbinds = [(field, encode_oid(oid), ber_type)
+                         for field, oid, ber_type in varbinds]
+        self.pdu_fields_suffix = encode_integer(0) + encode_integer(0)
+
+    def encode(self, community, request_id, uptime_ticks, event):
+        varbinds = encode_tlv(
+            SEQUENCE, self.sys_uptime_name
+            + encode_integer(uptime_ticks, TIMETICKS))
+        varbinds += self.trap_oid_varbind
+        for field, name, ber_type in self.varbinds:
+            if ber_type == INTEGER:
+                value = encode_integer(int(event[field]))
+            else:
+                value = encode_octet_string(event.get(field) or '')
+            varbinds += encode_tlv(SEQUENCE, name + value)
+        pdu = encode_tlv(SNMPV2_TRAP_PDU,
+                         encode_integer(request_id) + self.pdu_fields_suffix
+                         + encode_tlv(SEQUENCE, varbinds))
+        return bytes(encode_tlv(
+            SEQUENCE, encode_integer(SNMP_VERSION_2C)
+            + encode_octet_string(community) + pdu))
+
+
+TEMPLATES = dict((event_type, TrapTemplate(event_type))
+                 for event_type in EVENT_VARBINDS)
+
+
+def uptime_ticks():
+    """hundredths of a second since boot, as snmptrap sends for ''"""
+    try:
+        with open('/proc/uptime', 'r') as uptime:
+            seconds = float(uptime.read().split()[0])
+    except (IOError, OSError, ValueError, IndexError):
+        seconds = time.time()
+    return int(seconds * 100) & 0xffffffff
+
+
+def parse_target(target):
+    host, _, port = target.rpartition(':')
+    if not host or not port.isdigit():
+        return target, DEFAULT_TRAP_PORT
+    return host.strip('[]'), int(port)
+
+
+class TrapSender(object):
+    """sends traps over one connected UDP socket per collector"""
+
+    def __init__(self):
+        self.sockets = {}
+        self.request_id = random.randint(1, 0x7fffffff)
+
+    def socket_for(self, target):
+        sock = self.sockets.get(target)
+        if sock is None:
+            host, port = parse_target(target)
+            family, socktype, proto, canonname, address = socket.getaddrinfo(
+                host, port, 0, socket.SOCK_DGRAM)[0]
+            sock = socket.socket(family, socktype, proto)
+            sock.connect(address)
+            self.sockets[target] = sock
+        return sock
+
+    def send(self, event, targets):
+        """send the trap of event to every target, return the errors"""
+        self.request_id = self.request_id % 0x7fffffff + 1
+        message = TEMPLATES[event['type']].encode(
+            event['community'], self.request_id, uptime_ticks(), event)
+        errors = []
+        for target in targets:
+            try:
+                self.socket_for(target).send(message)
+            except (socket.error, socket.gaierror) as e:
+                # connected UDP sockets report earlier ICMP errors here,
+                # reconnect on the next trap
+                sock = self.sockets.pop(target, None)
+                if sock:
+                    sock.close()
+                errors.append("{}: {}".format(target, e))
+        return errors
+
+    def close(self):
+        for sock in self.sockets.values():
+            sock.close()
+        self.sockets = {}
+
+
+def summary_notification(summary):
+    """return the (event, targets) of a NotificationSuppressor summary"""
+    hostname, servicedesc, state_id, output, context = summary
+    return ({'type': 'service', 'community': context['community'],
+             'hostname': hostname, 'servicedesc': servicedesc,
+             'state_id': state_id, 'output': output}, context['targets'])
+
+
+def serve(socket_path, suppressor=None, batch_size=SERVE_BATCH_SIZE):
+    """receive notifications as JSON datagrams on socket_path and send
+    their traps, draining every queued notification per batch. with a
+    suppressor, the summaries of its windows that are over are sent every
+    FLUSH_INTERVAL_SECONDS"""
+    if os.path.exists(socket_path):
+        os.unlink(socket_path)
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+    server.bind(socket_path)
+    os.chmod(socket_path, 0o660)
+    sender = TrapSender()
+    flushed = time.time()
+    while True:
+        server.settimeout(FLUSH_INTERVAL_SECONDS if suppressor else None)
+        try:
+            batch = [server.recv(MAX_DATAGRAM_BYTES)]
+        except socket.timeout:
+            batch = []
+        server.setblocking(False)
+        while batch and len(batch) < batch_size:
+            try:
+                batch.append(server.recv(MAX_DATAGRAM_BYTES))
+            except socket.error as e:
+                if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    raise
+                break
+        if suppressor and time.time() - flushed >= FLUSH_INTERVAL_SECONDS:
+            flushed = time.time()
+            try:
+                summaries = suppressor.flush(flushed)
+            except Exception as e:
+                print("Unable to flush notification summaries: {}".format(
+                    str(e)))
+                summaries = []
+            for event, targets in map(summary_notification, summaries):
+                for error in sender.send(event, targets):
+                    print("Unable to send trap: {}".format(error))
+        for datagram in batch:
+            try:
+                notification = json.loads(datagram.decode('utf-8'))
+                errors = sender.send(notification['event'],
+                                     notification['targets'])
+            except Exception as e:
+                errors = [str(e)]
+            for error in errors:
+                print("Unable to send trap: {}".format(error))
+        sys.stdout.flush()
+
+
+def hand_off(socket_path, event, targets):
+    """pass the notification to the resident sender, False if none runs"""
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+    try:
+        client.sendto(json.dumps({'event': event, 'targets': targets}).encode(
+            'utf-8'), socket_path)
+        return True
+    except socket.error:
+        return False
+    finally:
+        client.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='SNMP trap sender for nagios host and service events.')
+    parser.add_argument('--type', type=str, choices=['host', 'service'],
+                        help='type of event')
+    parser.add_argument('--community', type=str, help='SNMP community string')
+    parser.add_argument('--hostname', type=str,
+                        help='Source host of the event')
+    parser.add_argument('--state_id', type=int, choices=[0, 1, 2, 3],
+                        help='host 0-UP,1-DOWN,2-UNREACHABLE or service'
+                             ' 0-OK,1-WARN,2-CRIT,3-UNKWN')
+    parser.add_argument('--output', type=str,
+                        help='Output associated with the event')
+    parser.add_argument('--servicedesc', type=str,
+                        help='Monitor name with event')
+    parser.add_argument('--primary_target', type=str,
+                        help='primary snmp collector IP with port')
+    parser.add_argument('--secondary_target', type=str,
+                        help='standby snmp collector IP with port')
+    parser.add_argument('--socket', type=str,
+                        help='local socket of the resident sender')
+    parser.add_argument('--serve', action='store_true',
+                        help='run as the resident sender on --socket')
+    add_suppressor_arguments(parser)
+    args = parser.parse_args()
+
+    if args.serve:
+        if not args.socket:
+            parser.error('--serve requires --socket')
+        serve(args.socket, suppressor_from_args(args, 'snmp'))
+
+    for required in ('type', 'community', 'hostname', 'state_id', 'output'):
+        if getattr(args, required) is None:
+            parser.error('--{} is required'.format(required))
+    if args.type == 'service' and args.servicedesc is None:
+        print("Please provide a servicedesc")
+        sys.exit(0)
+
+    targets = [target for target in (args.primary_target,
+                                     args.secondary_target) if target]
+    if not targets:
+        sys.exit(0)
+
+    event = {'type': args.type, 'community': args.community,
+             'hostname': args.hostname, 'servicedesc': args.servicedesc,
+             'state_id': args.state_id, 'output': args.output}
+    notifications = [(event, targets)]
+    if args.type == 'service':
+        suppressor = suppressor_from_args(args, 'snmp')
+        if suppressor:
+            send, summaries = check_notification(
+                suppressor, args.hostname, args.servicedesc, args.state_id,
+                args.output, {'community': args.community,
+                              'targets': targets})
+            if not send:
+                print("skipping notification for host: {}, service: {},"
+                      " service state: {}, service output: {}".format(
+                          args.hostname, args.servicedesc, args.state_id,
+                          args.output))
+                notifications = []
+            notifications.extend(map(summary_notification, summaries))
+
+    sender = None
+    for event, targets in notifications:
+        if args.socket and hand_off(args.socket, event, targets):
+            continue
+        sender = sender or TrapSender()
+        for error in sender.send(event, targets):
+            print("Unable to send trap: {}".format(error))
+    if sender:
+        sender.close()
+    sys.exit(0)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
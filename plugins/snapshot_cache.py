@@ -0,0 +1,80 @@
+#!/usr/bin/env python
+# Copyright 2017 The Openstack-Helm Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""On-disk snapshot shared by concurrent plugin invocations.
+
+The first process that finds the snapshot missing or older than the ttl
+takes an exclusive lock and refreshes it. Every other process blocks on
+the same lock and then reads the refreshed copy instead of going to the
+backend itself."""
+
+import fcntl
+import json
+import os
+import tempfile
+import time
+
+
+def load_snapshot(cache_file, ttl, fetch):
+    """return (data, error_messages) from cache_file if it is younger than
+    ttl seconds, otherwise from fetch() which is then written to cache_file.
+    fetch must return (data, error_messages); failed fetches are not cached"""
+    data = read_snapshot(cache_file, ttl)
+    if data is not None:
+        return data, []
+
+    with open(cache_file + '.lock', 'a') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            # another process may have refreshed it while we were waiting
+            data = read_snapshot(cache_file, ttl)
+            if data is not None:
+                return data, []
+            data, error_messages = fetch()
+            if error_messages:
+                return data, error_messages
+            write_snapshot(cache_file, data)
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    return data, []
+
+
+def read_snapshot(cache_file, ttl):
+    """return the cached data, or None if absent, unreadable or expired"""
+    try:
+        with open(cache_file, 'r') as snapshot_file:
+            snapshot = json.load(snapshot_file)
+        age = time.time() - snapshot['fetched_at']
+        if 0 <= age < ttl:
+            return snapshot['data']
+    except (IOError, OSError, ValueError, KeyError, TypeError):
+        pass
+    return None
+
+
+def write_snapshot(cache_file, data):
+    """write through a temp file and rename so readers never see a
+    partially written snapshot"""
+    fd, tmp_path = tempfile.mkstemp(
+        dir=os.path.dirname(os.path.abspath(cache_file)),
+        prefix='.' + os.path.basename(cache_file))
+    try:
+        with os.fdopen(fd, 'w') as tmp_file:
+            json.dump({'fetched_at': time.time(), 'data': data}, tmp_file)
+        os.chmod(tmp_path, 0o644)
+        os.rename(tmp_path, cache_file)
+    except Exception:
+        os.unlink(tmp_path)
+        raise
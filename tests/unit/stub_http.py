@@ -0,0 +1,47 @@
+#!/usr/bin/env python
+# Copyright 2017 The Openstack-Helm Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Local HTTP servers standing in for the endpoints the plugins query."""
+
+import json
+import threading
+
+from http.server import BaseHTTPRequestHandler
+from http.server import HTTPServer
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    """request handler that does not log the requests"""
+
+    def reply(self, body, status=200):
+        """answer with body, JSON encoded unless it is bytes"""
+        if not isinstance(body, bytes):
+            body = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def serve(handler_class):
+    """serve handler_class on a free local port from a daemon thread, return
+    the server and its host:port. stop it with server.shutdown()"""
+    server = HTTPServer(('127.0.0.1', 0), handler_class)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server, '127.0.0.1:{}'.format(server.server_port)
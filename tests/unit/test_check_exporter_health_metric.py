@@ -0,0 +1,131 @@
+#!/usr/bin/env python
+# Copyright 2017 The Openstack-Helm Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import gzip
+import json
+import subprocess
+import time
+
+from tests.unit.stub_http import serve
+from tests.unit.stub_http import StubHandler
+
+EXPOSITION = b"""# HELP ceph_health_status Cluster health
+# TYPE ceph_health_status gauge
+ceph_health_status{cluster="ceph"} 1
+# TYPE ceph_osd_up gauge
+ceph_osd_up{osd="0"} 1
+ceph_osd_up{osd="1"} 0
+"""
+
+
+class ExporterHandler(StubHandler):
+    """answers /metrics with EXPOSITION and /huge with a body without
+    newlines, gzip compressed when accepted, and /trickle a byte at a
+    time"""
+
+    def do_GET(self):
+        if self.path in ('/metrics', '/huge'):
+            body = EXPOSITION if self.path == '/metrics' else b'a' * 100000
+            self.send_response(200)
+            if 'gzip' in self.headers.get('Accept-Encoding', ''):
+                body = gzip.compress(body)
+                self.send_header('Content-Encoding', 'gzip')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        else:
+            self.send_response(200)
+            self.send_header('Content-Length', '50')
+            self.end_headers()
+            try:
+                for byte in range(50):
+                    self.wfile.write(b'a')
+                    self.wfile.flush()
+                    time.sleep(0.1)
+            except (IOError, OSError):
+                pass  # the plugin gave up
+
+
+def run(*options):
+    p = subprocess.Popen(
+        ["plugins/check_exporter_health_metric.py"] + list(options),
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        shell=False)
+    out, err = p.communicate()
+    return p.returncode, out.decode('utf-8')
+
+
+def test_health_metric_and_rules_from_one_scrape(tmpdir):
+    rules_file = tmpdir.join("rules.json")
+    rules_file.write(json.dumps([
+        {"service_description": "CEPH_health",
+         "health_metric": "ceph_health_status", "critical": 2, "warning": 1},
+        {"service_description": "CEPH_osd_1",
+         "health_metric": "ceph_osd_up", "labels": {"osd": "1"},
+         "critical": 0}]))
+    server, address = serve(ExporterHandler)
+    try:
+        single = run("--exporter_api", address + "/metrics",
+                     "--health_metric", "ceph_health_status",
+                     "--critical", "2", "--warning", "1")
+        rules = run("--exporter_api", address + "/metrics",
+                    "--rules_file", str(rules_file))
+    finally:
+        server.shutdown()
+    assert single == (1, 'Warning: ceph_health_status metric is a warning'
+                         ' value of 1.0(ceph_health_status{cluster="ceph"})\n')
+    code, out = rules
+    assert code == 2
+    lines = out.splitlines()
+    assert lines[0] == "CRITICAL: 2 of 2 exporter rules are not OK"
+    assert lines[2] == ('CEPH_osd_1: Critical: ceph_osd_up metric is a'
+                        ' critical value of 0.0(ceph_osd_up{osd="1"})')
+
+
+def test_metric_family_absent_from_the_scrape_is_unknown():
+    server, address = serve(ExporterHandler)
+    try:
+        # a prefix of ceph_health_status is not a family of the scrape
+        code, out = run("--exporter_api", address + "/metrics",
+                        "--health_metric", "ceph_health", "--critical", "2")
+    finally:
+        server.shutdown()
+    assert code == 3
+    assert out == "Unknown: no ceph_health samples in the exporter scrape\n"
+
+
+def test_scrape_larger_than_max_bytes_is_unknown():
+    server, address = serve(ExporterHandler)
+    try:
+        code, out = run("--exporter_api", address + "/huge",
+                        "--critical", "2", "--max_bytes", "1000")
+    finally:
+        server.shutdown()
+    assert code == 3
+    assert "exporter response is larger than 1000 bytes" in out
+
+
+def test_trickling_scrape_is_cut_at_the_timeout():
+    server, address = serve(ExporterHandler)
+    try:
+        started = time.time()
+        code, out = run("--exporter_api", address + "/trickle",
+                        "--critical", "2", "--timeout", "1")
+        elapsed = time.time() - started
+    finally:
+        server.shutdown()
+    assert code == 3
+    assert "exporter response took longer than the timeout" in out
+    assert elapsed < 2.5
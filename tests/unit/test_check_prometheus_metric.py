@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+# Copyright 2017 The Openstack-Helm Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import subprocess
+
+from tests.unit.stub_http import serve
+from tests.unit.stub_http import StubHandler
+
+
+def serve_query(result_type, result):
+
+    class QueryHandler(StubHandler):
+
+        def do_GET(self):
+            self.reply({'status': 'success',
+                        'data': {'resultType': result_type,
+                                 'result': result}})
+
+    server, address = serve(QueryHandler)
+    return server, 'http://' + address
+
+
+def run(result_type, result, *options):
+    server, address = serve_query(result_type, result)
+    try:
+        p = subprocess.Popen(
+            ["plugins/check_prometheus_metric.py", "-H", address,
+             "-q", "up", "-n", "metric"] + list(options),
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            shell=False)
+        out, err = p.communicate()
+    finally:
+        server.shutdown()
+    return p.returncode, out.decode('utf-8').splitlines()
+
+
+def sample(value, **labels):
+    return {'metric': labels, 'value': [1500000000, value]}
+
+
+def test_scalar_value_is_rounded_and_compared():
+    code, lines = run('vector', [sample('4.6')], '-w', '4', '-c', '6')
+    assert code == 1
+    assert lines == ['WARNING - metric is 5']
+    code, lines = run('vector', [sample('+Inf')], '-w', '4', '-c', '6')
+    assert code == 2
+    assert lines == ['CRITICAL - metric is 10']
+    code, lines = run('vector', [sample('-Inf')], '-w', '4', '-c', '6',
+                      '-m', 'lt')
+    assert code == 2
+    assert lines == ['CRITICAL - metric is -1']
+
+
+def test_nan_and_empty_results():
+    code, lines = run('vector', [sample('NaN')], '-w', '1', '-c', '2')
+    assert code == 3
+    assert lines == ['UNKNOWN - unable to parse prometheus response',
+                     'metric is NaN']
+    code, lines = run('vector', [sample('NaN')], '-w', '1', '-c', '2', '-O')
+    assert code == 0
+    assert lines == ['OK - metric is NaN']
+    code, lines = run('vector', [], '-w', '1', '-c', '2', '-t', 'vector')
+    assert code == 3
+    assert lines[1] == 'metric is null'
+
+
+def test_matrix_and_string_results_are_unknown():
+    matrix = [{'metric': {}, 'values': [[1500000000, '1']]}]
+    for options in ([], ['-t', 'vector']):
+        code, lines = run('matrix', matrix, '-w', '1', '-c', '2', *options)
+        assert code == 3
+        assert lines == ['UNKNOWN - unable to parse prometheus response',
+                         'metric is null']
+    code, lines = run('string', [1500000000, 'up'], '-w', '1', '-c', '2')
+    assert code == 3
+    assert lines[0] == 'UNKNOWN - unable to parse prometheus response'
+
+
+def test_vector_reports_worst_series():
+    result = [sample('1', instance='a'), sample('9', instance='b'),
+              sample('12', instance='c'), sample('15', instance='d')]
+    code, lines = run('vector', result, '-w', '8', '-c', '12',
+                      '-t', 'vector', '-i')
+    assert code == 2
+    assert lines == ['CRITICAL - metric is 12 (2 of 4 series CRITICAL):'
+                     ' { instance: c }']
+    code, lines = run('vector', result[:1], '-w', '8', '-c', '12',
+                      '-t', 'vector')
+    assert code == 0
+    assert lines == ['OK - metric is 1']
+
+
+def test_levels_must_be_non_negative_integers():
+    code, lines = run('vector', [], '-w', '-1', '-c', '2')
+    assert code == 3
+    assert lines[0].startswith('UNKNOWN - ')
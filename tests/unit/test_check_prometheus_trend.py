@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+# Copyright 2017 The Openstack-Helm Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import subprocess
+import time
+
+from urllib.parse import parse_qs
+from urllib.parse import urlparse
+
+from tests.unit.stub_http import serve
+from tests.unit.stub_http import StubHandler
+
+
+def serve_range(requests):
+    """answers query_range with a rising and a flat series, appending the
+    query parameters of every request to requests"""
+
+    class RangeHandler(StubHandler):
+
+        def do_GET(self):
+            params = dict((name, values[0]) for name, values in
+                          parse_qs(urlparse(self.path).query).items())
+            requests.append(params)
+            steps = range(int(params['start']), int(params['end']) + 1,
+                          int(params['step']))
+            self.reply({'status': 'success', 'data': {
+                'resultType': 'matrix',
+                'result': [
+                    {'metric': {'instance': 'rising'},
+                     'values': [[t, str(t * 0.5)] for t in steps]},
+                    {'metric': {'instance': 'flat'},
+                     'values': [[t, '7'] for t in steps]}]}})
+
+    return serve(RangeHandler)
+
+
+def run(address, *options):
+    p = subprocess.Popen(
+        ["plugins/check_prometheus_trend.py", "--prometheus_api", address,
+         "--query", "used", "--metric_name", "used space"] + list(options),
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        shell=False)
+    out, err = p.communicate()
+    return p.returncode, out.decode('utf-8').strip()
+
+
+def test_slope_and_cached_steps(tmpdir):
+    requests = []
+    server, address = serve_range(requests)
+    options = ["--mode", "slope", "--warning", "0.1", "--critical", "1",
+               "--range", "3600", "--step", "60",
+               "--cache_file", str(tmpdir.join("trend.json"))]
+    try:
+        first = run(address, *options)
+        second = run(address, *options)
+    finally:
+        server.shutdown()
+    for code, out in (first, second):
+        assert code == 1
+        assert out.startswith("WARNING: used space slope is 0.5/s"
+                              " (1 of 2 series WARNING)")
+    assert int(requests[0]['end']) - int(requests[0]['start']) == 3600
+    # the second run only asks for the late steps again
+    assert int(requests[1]['end']) - int(requests[1]['start']) <= 180
+
+
+def test_time_to_exhaustion_and_percent_over(tmpdir):
+    requests = []
+    server, address = serve_range(requests)
+    try:
+        threshold = str(int(time.time() + 3000) * 0.5)
+        code, out = run(address, "--mode", "time_to_exhaustion",
+                        "--threshold", threshold, "--warning", "3600",
+                        "--critical", "60",
+                        "--cache_file", str(tmpdir.join("tte.json")))
+        assert code == 1
+        assert out.startswith("WARNING: used space reaches ")
+        code, out = run(address, "--mode", "percent_over",
+                        "--threshold", "5", "--warning", "50",
+                        "--critical", "90",
+                        "--cache_file", str(tmpdir.join("over.json")))
+        assert code == 2
+        assert out == ('CRITICAL: used space is over 5 in 100.0% of the'
+                       ' samples (2 of 2 series CRITICAL) on'
+                       ' {instance="flat"}')
+    finally:
+        server.shutdown()
+
+
+def test_cache_is_only_reused_for_the_same_range(tmpdir):
+    requests = []
+    server, address = serve_range(requests)
+    options = ["--mode", "slope", "--warning", "1", "--critical", "2",
+               "--step", "60", "--cache_file", str(tmpdir.join("trend.json"))]
+    try:
+        run(address, "--range", "3600", *options)
+        run(address, "--range", "21630", *options)
+    finally:
+        server.shutdown()
+    start, end = int(requests[1]['start']), int(requests[1]['end'])
+    # a longer range is fetched whole, from a start on the step grid
+    assert end - start == 21600
+    assert start % 60 == 0
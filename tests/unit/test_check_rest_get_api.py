@@ -0,0 +1,143 @@
+#!/usr/bin/env python
+# Copyright 2017 The Openstack-Helm Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import json
+import os
+import subprocess
+import sys
+
+from tests.unit.stub_http import serve
+from tests.unit.stub_http import StubHandler
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..', 'plugins'))
+
+import check_rest_get_api  # noqa: E402
+
+
+class StatusHandler(StubHandler):
+    """answers /<code> with that status code"""
+
+    def do_GET(self):
+        self.reply({}, int(self.path.strip('/')))
+
+
+def test_single_url_output_is_unchanged():
+    server, address = serve(StatusHandler)
+    try:
+        p = subprocess.Popen(
+            ["plugins/check_rest_get_api.py", "--url", address + "/200"],
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            shell=False)
+        out, err = p.communicate()
+    finally:
+        server.shutdown()
+    assert 0 == p.returncode
+    assert out.decode('utf-8').startswith(
+        "OK: URL {}/200 returned response code 200. [RT=".format(address))
+
+
+def test_urls_file_reports_every_url(tmpdir):
+    server, address = serve(StatusHandler)
+    urls_file = tmpdir.join("urls.json")
+    urls_file.write(json.dumps([
+        {"url": address + "/200", "service_description": "API_ok"},
+        {"url": address + "/503", "service_description": "API_unavailable"},
+        {"url": address + "/404", "expected_response_codes": [200, 404],
+         "service_description": "API_not_found"}]))
+    command_file = tmpdir.join("nagios.cmd")
+    command_file.write("")
+    try:
+        p = subprocess.Popen(
+            ["plugins/check_rest_get_api.py", "--urls_file", str(urls_file),
+             "--workers", "2"],
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            shell=False)
+        out, err = p.communicate()
+        passive = subprocess.Popen(
+            ["plugins/check_rest_get_api.py", "--urls_file", str(urls_file),
+             "--command_file", str(command_file), "--host_name", "apis"],
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            shell=False)
+        passive.communicate()
+    finally:
+        server.shutdown()
+    lines = out.decode('utf-8').splitlines()
+    assert 2 == p.returncode
+    assert "CRITICAL: 1 of 3 URLs are not OK" == lines[0]
+    assert lines[1].startswith("OK: URL {}/200".format(address))
+    assert lines[2].startswith("CRITICAL: using URL {}/503".format(address))
+    assert lines[3].startswith("OK: URL {}/404".format(address))
+
+    assert 0 == passive.returncode
+    submitted = command_file.read().splitlines()
+    assert 3 == len(submitted)
+    assert ";apis;API_unavailable;2;CRITICAL:" in submitted[1]
+
+
+def test_invalid_definition_is_rejected_when_loaded(tmpdir):
+    urls_file = tmpdir.join("urls.json")
+    urls_file.write(json.dumps([
+        {"url": "127.0.0.1:1/200"},
+        {"url": "127.0.0.1:1/503", "warning_response_seconds": "1.5"}]))
+    p = subprocess.Popen(
+        ["plugins/check_rest_get_api.py", "--urls_file", str(urls_file)],
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        shell=False)
+    out, err = p.communicate()
+    assert 3 == p.returncode
+    assert out.decode('utf-8').startswith(
+        "UNKNOWN: unable to load URL definitions. invalid definition")
+
+
+def test_failing_url_check_is_unknown_for_that_url_only(monkeypatch):
+    def check_definition(session, definition):
+        if definition['url'] == 'broken':
+            raise ValueError("no check for you")
+        return check_rest_get_api.STATE_OK, "OK: URL {}".format(
+            definition['url'])
+
+    monkeypatch.setattr(check_rest_get_api, 'check_definition',
+                        check_definition)
+    results = check_rest_get_api.check_definitions(
+        [{'url': 'first'}, {'url': 'broken'}, {'url': 'last'}], 2)
+    assert [(0, "OK: URL first"),
+            (3, "UNKNOWN: unable to check URL broken. no check for you"),
+            (0, "OK: URL last")] == results
+
+
+def test_phase_timing_reports_every_phase_as_perfdata():
+    server, address = serve(StatusHandler)
+    try:
+        p = subprocess.Popen(
+            ["plugins/check_rest_get_api.py", "--url", address + "/200",
+             "--phase_timing", "--phase_warning_seconds", "connect=0,ttfb=5",
+             "--max_body_bytes", "1"],
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            shell=False)
+        out, err = p.communicate()
+    finally:
+        server.shutdown()
+    output, perfdata = out.decode('utf-8').strip().split(' | ')
+    assert 1 == p.returncode
+    assert output.startswith(
+        "WARNING: using URL {}/200 connect seconds".format(address))
+    labels = [item.split('=')[0] for item in perfdata.split()]
+    assert ['dns', 'connect', 'tls', 'ttfb', 'transfer', 'total',
+            'size'] == labels
+    assert "size=1B;;;0" in perfdata
@@ -0,0 +1,142 @@
+#!/usr/bin/env python
+# Copyright 2017 The Openstack-Helm Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import socket
+import subprocess
+import time
+
+from tests.unit.stub_http import serve
+from tests.unit.stub_http import StubHandler
+
+
+class QueryHandler(StubHandler):
+    """answers every prometheus query with a single sample of 5, counting
+    the connections it was asked on"""
+    protocol_version = 'HTTP/1.1'
+    connections = set()
+
+    def do_GET(self):
+        QueryHandler.connections.add(self.client_address)
+        self.reply({'status': 'success', 'data': {
+            'resultType': 'vector',
+            'result': [{'metric': {}, 'value': [0, '5']}]}})
+
+
+def start_check_server(socket_path, *options):
+    server = subprocess.Popen(
+        ["plugins/check_server.py", "--socket", socket_path] + list(options),
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        shell=False)
+    # printed once the socket is listening
+    assert b"Serving" in server.stdout.readline()
+    return server
+
+
+def run(command):
+    p = subprocess.Popen(
+        command,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        shell=False)
+    out, err = p.communicate()
+    return p.returncode, out.decode('utf-8'), err.decode('utf-8')
+
+
+def test_client_output_matches_the_plugin(tmpdir):
+    prometheus, address = serve(QueryHandler)
+    socket_path = str(tmpdir.join("check_server.sock"))
+    server = start_check_server(socket_path)
+    check = ["check_prometheus_metric.py", "-H",
+             address,
+             "-q", "up", "-n", "up", "-w", "4", "-c", "6"]
+    try:
+        direct = run(["plugins/" + check[0]] + check[1:])
+        QueryHandler.connections.clear()
+        client = ["plugins/check_client.py", "--socket", socket_path]
+        served = [run(client + check) for attempt in range(3)]
+        usage = run(["plugins/check_client.py", "--socket", socket_path,
+                     "query_prometheus_alerts.py"])
+    finally:
+        server.terminate()
+        server.wait()
+        prometheus.shutdown()
+    assert direct == (1, "WARNING - up is 5\n", "")
+    assert served == [direct] * 3
+    # the checks reused the pooled connection
+    assert len(QueryHandler.connections) == 1
+    assert usage[0] == 2
+    assert usage[2].startswith("usage: query_prometheus_alerts.py")
+    assert "arguments are required: --prometheus_api" in usage[2]
+
+
+def test_hung_backend_does_not_wedge_the_server(tmpdir):
+    # accepts connections into its backlog and never answers
+    backend = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    backend.bind(('127.0.0.1', 0))
+    backend.listen(16)
+    address = "127.0.0.1:{}".format(backend.getsockname()[1])
+    socket_path = str(tmpdir.join("check_server.sock"))
+    server = start_check_server(socket_path, "--workers", "1",
+                                "--check_timeout", "3",
+                                "--request_timeout", "1")
+    client = ["plugins/check_client.py", "--socket", socket_path]
+    try:
+        # requests made without a timeout get the check timeout
+        started = time.time()
+        code, out, err = run(client + [
+            "query_prometheus_alerts.py", "--prometheus_api", address,
+            "--alertname", "up", "--msg_format", "down"])
+        assert code == 3
+        assert out.startswith("Unknown: unable to query prometheus alerts")
+        # a check running past the check timeout is answered UNKNOWN
+        code, out, err = run(client + [
+            "check_prometheus_trend.py", "--prometheus_api", address,
+            "--query", "up", "--metric_name", "up", "--mode", "slope",
+            "--warning", "1", "--critical", "2", "--timeout", "30",
+            "--cache_file", str(tmpdir.join("trend.json"))])
+        assert code == 3
+        assert "did not finish within" in out
+        # while it keeps the only worker, checks run by themselves
+        code, out, err = run(client + ["query_prometheus_alerts.py"])
+        assert code == 2
+        assert "arguments are required: --prometheus_api" in err
+        assert time.time() - started < 10
+    finally:
+        server.terminate()
+        server.wait()
+        backend.close()
+
+
+def test_plugins_not_served_run_by_themselves(tmpdir):
+    socket_path = str(tmpdir.join("check_server.sock"))
+    server = start_check_server(socket_path)
+    try:
+        code, out, err = run(["plugins/check_client.py", "--socket",
+                              socket_path, "query_prometheus_alerts_bulk.py",
+                              "--help"])
+    finally:
+        server.terminate()
+        server.wait()
+    assert code == 0
+    assert out.startswith("usage: query_prometheus_alerts_bulk.py")
+    assert "-d" in out
+
+
+def test_client_runs_the_plugin_without_server(tmpdir):
+    code, out, err = run(["plugins/check_client.py", "--socket",
+                          str(tmpdir.join("missing.sock")),
+                          "query_prometheus_alerts.py"])
+    assert code == 2
+    assert "arguments are required: --prometheus_api" in err
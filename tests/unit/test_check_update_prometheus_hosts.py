@@ -0,0 +1,150 @@
+#!/usr/bin/env python
+# Copyright 2017 The Openstack-Helm Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..', 'plugins'))
+
+import check_update_prometheus_hosts as discovery  # noqa: E402
+
+READ_PROGRAM_START = discovery.read_program_start
+
+
+def discovery_sources(*nodes):
+    """node_uname_info and kube_node_labels results of nodes"""
+    unames = {'data': {'result': [
+        {'metric': {'nodename': node, 'instance': '10.0.0.{}:9100'.format(
+            number)}} for number, node in enumerate(nodes)]}}
+    labels = {'data': {'result': [
+        {'metric': {'node': node, 'label_compute': 'enabled'}}
+        for node in nodes]}}
+    return unames, labels
+
+
+@pytest.fixture
+def nagios(monkeypatch):
+    """discovery answering with the nodes of nagios.nodes, counting the
+    reloads and pre-flight checks instead of signalling nagios"""
+    class Nagios(object):
+        nodes = ('node1',)
+        reloads = 0
+        preflights = []
+
+    def reload_nagios():
+        Nagios.reloads += 1
+
+    def precache_nagios_objects(nagios_bin, nagios_cfg):
+        return Nagios.preflights.pop(0)
+
+    monkeypatch.setattr(discovery, 'query_prometheus_discovery_sources',
+                        lambda prometheus_api: discovery_sources(*Nagios.nodes))
+    monkeypatch.setattr(discovery, 'reload_nagios', reload_nagios)
+    monkeypatch.setattr(discovery, 'precache_nagios_objects',
+                        precache_nagios_objects)
+    # no status file, so the reload is not waited for
+    monkeypatch.setattr(discovery, 'read_program_start', lambda path: None)
+    return Nagios
+
+
+def reloader(object_file, window_seconds=0, precache_objects=False):
+    return discovery.NagiosReloader(
+        str(object_file), window_seconds, precache_objects, 'nagios',
+        'nagios.cfg', 'status.dat')
+
+
+def test_unchanged_discovery_is_not_rewritten_or_reloaded(tmpdir, nagios):
+    object_file = tmpdir.join("objects.cfg")
+    assert discovery.update_config_file('prometheus', str(object_file))
+    written = os.stat(str(object_file))
+    assert not discovery.update_config_file('prometheus', str(object_file))
+    # a rewrite renames a new file into place
+    assert os.stat(str(object_file)).st_ino == written.st_ino
+    assert nagios.reloads == 1
+
+    nagios.nodes = ('node1', 'node2')
+    assert discovery.update_config_file('prometheus', str(object_file))
+    assert "host_name node2" in object_file.read()
+    assert nagios.reloads == 2
+
+
+def test_failed_preflight_rolls_back(tmpdir, nagios):
+    object_file = tmpdir.join("objects.cfg")
+    nagios.preflights = [True, False]
+    discovery.update_config_file(
+        'prometheus', str(object_file), reloader(object_file, 0, True))
+    verified = object_file.read()
+    assert nagios.reloads == 1
+
+    nagios.nodes = ('node1', 'node2')
+    discovery.update_config_file(
+        'prometheus', str(object_file), reloader(object_file, 0, True))
+    assert object_file.read() == verified
+    assert nagios.reloads == 1
+
+
+def test_failed_preflight_removes_a_new_object_file(tmpdir, nagios):
+    object_file = tmpdir.join("objects.cfg")
+    nagios.preflights = [False]
+    discovery.update_config_file(
+        'prometheus', str(object_file), reloader(object_file, 0, True))
+    assert not object_file.exists()
+    assert nagios.reloads == 0
+
+
+def test_changes_within_the_window_share_one_reload(tmpdir, nagios, capsys):
+    object_file = tmpdir.join("objects.cfg")
+    window = reloader(object_file, 3600)
+    for nodes in (('node1',), ('node1', 'node2'), ('node2',)):
+        nagios.nodes = nodes
+        discovery.update_config_file('prometheus', str(object_file), window)
+    assert nagios.reloads == 0
+    assert 0 < window.due_in() <= 3600
+
+    window.pending_since -= 3600
+    discovery.sleep_with_pending_reload(0, window)
+    assert nagios.reloads == 1
+    assert window.due_in() is None
+    assert "requested for 3 discovery change(s)" in capsys.readouterr().out
+
+
+def test_reload_is_only_waited_for_when_asked(tmpdir, nagios, monkeypatch,
+                                              capsys):
+    status_file = tmpdir.join("status.dat")
+    status_file.write("info {\n}\nprogramstatus {\n program_start=1000\n}\n")
+
+    def reload_nagios():
+        nagios.reloads += 1
+        status_file.write("programstatus {{\n program_start={}\n}}\n".format(
+            1000 + nagios.reloads))
+
+    monkeypatch.setattr(discovery, 'reload_nagios', reload_nagios)
+    monkeypatch.setattr(discovery, 'read_program_start', READ_PROGRAM_START)
+    object_file = tmpdir.join("objects.cfg")
+    requesting = discovery.NagiosReloader(
+        str(object_file), 0, False, 'nagios', 'nagios.cfg', str(status_file),
+        0)
+    discovery.update_config_file('prometheus', str(object_file), requesting)
+    assert "reload requested for 1 discovery change(s): pre-flight" \
+        in capsys.readouterr().out
+
+    nagios.nodes = ('node1', 'node2')
+    waiting = discovery.NagiosReloader(
+        str(object_file), 0, False, 'nagios', 'nagios.cfg', str(status_file),
+        5)
+    discovery.update_config_file('prometheus', str(object_file), waiting)
+    assert "Nagios reloaded 1 discovery change(s)" in capsys.readouterr().out
+    assert nagios.reloads == 2
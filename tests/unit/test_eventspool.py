@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+# Copyright 2017 The Openstack-Helm Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import json
+import os
+import subprocess
+import sys
+
+from tests.unit.stub_http import serve
+from tests.unit.stub_http import StubHandler
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..', 'plugins'))
+
+from eventspool import EventSpool  # noqa: E402
+
+
+def test_spool_is_bounded_and_retries_with_backoff(tmpdir):
+    spool = EventSpool(str(tmpdir.join("events.db")), max_deliveries=3)
+    assert 0 == spool.append(["http://a", "http://b"], "first")
+    assert 1 == spool.append(["http://a", "http://b"], "second")
+    rows = spool.due(10, now=1e12)
+    assert [("http://b", "first"), ("http://a", "second"),
+            ("http://b", "second")] == [(url, payload)
+                                        for id, url, payload, attempts in rows]
+
+    spool.delivered([rows[0][0]])
+    assert 0 == spool.failed([(rows[1][0], 0), (rows[2][0], 2)],
+                             max_attempts=4, now=1000)
+    assert [] == spool.due(10, now=1000.5)
+    assert [rows[1][0]] == [row[0] for row in spool.due(10, now=1001)]
+    assert 1001 == spool.next_attempt()
+    assert 1 == spool.failed([(rows[2][0], 3)], max_attempts=4, now=1000)
+    spool.close()
+
+
+class EventHandler(StubHandler):
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        self.server.events.append(json.loads(self.rfile.read(length)))
+        self.reply(b'')
+
+
+def test_spooled_events_are_delivered_and_retried(tmpdir):
+    server, address = serve(EventHandler)
+    server.events = []
+    spool_file = str(tmpdir.join("events.db"))
+    try:
+        for state_id in ('1', '2'):
+            subprocess.check_call([
+                "plugins/send_http_post_event.py", "--type", "host",
+                "--hostname", "node-1", "--state_id", state_id,
+                "--output", "PING CRITICAL", "--monitoring_hostname", "nagios",
+                "--primary_url", "http://{}/events".format(address),
+                "--secondary_url", "http://127.0.0.1:1/events",
+                "--spool_file", spool_file])
+        p = subprocess.Popen(
+            ["plugins/deliver_http_post_events.py", "--spool_file", spool_file],
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            shell=False)
+        out, err = p.communicate()
+    finally:
+        server.shutdown()
+    assert 1 == p.returncode
+    assert "delivered 2, retrying 2, dropped 0 deliveries" in out.decode('utf-8')
+    assert [1, 2] == [event['HostEvent']['HostStateID']
+                      for event in server.events]
+
+
+def test_service_event_is_spooled_when_the_state_file_is_unusable(tmpdir):
+    spool_file = str(tmpdir.join("events.db"))
+    subprocess.check_call([
+        "plugins/send_http_post_event.py", "--type", "service",
+        "--hostname", "node-1", "--servicedesc", "Service_nova-compute",
+        "--state_id", "2", "--output", "nova-compute stop/waiting",
+        "--monitoring_hostname", "nagios",
+        "--primary_url", "http://127.0.0.1:1/events",
+        "--spool_file", spool_file,
+        "--suppress_state_file", str(tmpdir.join("missing", "state.db"))])
+    spool = EventSpool(spool_file)
+    rows = spool.due(10, now=1e12)
+    spool.close()
+    assert 1 == len(rows)
+    assert "Service_nova-compute" == json.loads(
+        rows[0][2])['SvcEvent']['SvcDesc']
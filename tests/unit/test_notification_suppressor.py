@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+# Copyright 2017 The Openstack-Helm Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..', 'plugins'))
+
+import notification_suppressor  # noqa: E402
+
+
+def test_default_patterns_are_suppressed(tmpdir):
+    suppressor = notification_suppressor.NotificationSuppressor(
+        str(tmpdir.join("state.db")), "snmp")
+    for output in ("NRPE: Unable to read output",
+                   "CHECK_NRPE: Error - Could not complete SSL handshake.",
+                   "(Return code of 255 is out of bounds)"):
+        assert (False, []) == suppressor.check("node-1", "Service_nrpe", 2,
+                                               output, now=1000)
+    assert (True, []) == suppressor.check("node-1", "Service_nrpe", 2,
+                                          "NRPE: OK", now=1000)
+    suppressor.close()
+
+
+def test_patterns_file(tmpdir):
+    patterns_file = tmpdir.join("patterns")
+    patterns_file.write("# flapping exporters\nexporter .* unreachable\n\n")
+    patterns = notification_suppressor.load_patterns(str(patterns_file))
+    assert ["exporter .* unreachable"] == patterns
+    matcher = notification_suppressor.compile_patterns(patterns)
+    assert matcher.search("node exporter on node-1 unreachable")
+    assert not matcher.search("NRPE: Unable to read output")
+
+
+def test_repeats_are_coalesced_into_a_summary(tmpdir):
+    suppressor = notification_suppressor.NotificationSuppressor(
+        str(tmpdir.join("state.db")), "snmp", window=60)
+    assert (True, []) == suppressor.check(
+        "node-1", "Service_nova-compute", 2, "node-1 down for 12s", now=1000)
+    for host in range(2, 6):
+        send, summaries = suppressor.check(
+            "node-{}".format(host), "Service_nova-compute", 2,
+            "node-{} down for {}s".format(host, host * 7), now=1000 + host)
+        assert (False, []) == (send, summaries)
+    assert (True, []) == suppressor.check(
+        "node-1", "Service_nova-compute", 0, "node-1 up", now=1010)
+
+    send, summaries = suppressor.check(
+        "node-9", "Service_nova-compute", 2, "node-9 down for 1s", now=1061)
+    assert send
+    assert 1 == len(summaries)
+    hostname, servicedesc, state_id, output, context = summaries[0]
+    assert ("node-1", "Service_nova-compute", 2) == (hostname, servicedesc,
+                                                     state_id)
+    assert output.startswith(
+        "4 more notifications within 60 seconds on node-2,node-3,node-4,node-5")
+    suppressor.close()
+
+
+def test_channels_sharing_a_state_file(tmpdir):
+    state_file = str(tmpdir.join("state.db"))
+    snmp = notification_suppressor.NotificationSuppressor(
+        state_file, "snmp", window=60)
+    http = notification_suppressor.NotificationSuppressor(
+        state_file, "http", window=60)
+    for host in range(1, 4):
+        output = "node-{} down".format(host)
+        expected = (host == 1, [])
+        assert expected == snmp.check("node-{}".format(host), "Service_ovs",
+                                      2, output, {"targets": ["collector"]},
+                                      now=1000 + host)
+        assert expected == http.check("node-{}".format(host), "Service_ovs",
+                                      2, output, {"urls": ["http://rest"]},
+                                      now=1000 + host)
+
+    # the storm stopped, the summaries are flushed without a notification
+    assert [] == snmp.flush(now=1059)
+    summaries = snmp.flush(now=1061)
+    assert [("node-1", "Service_ovs", 2,
+             "2 more notifications within 60 seconds on node-2,node-3:"
+             " node-1 down", {"targets": ["collector"]})] == summaries
+    assert [] == snmp.flush(now=1062)
+    summaries = http.flush(now=1061)
+    assert 1 == len(summaries)
+    assert {"urls": ["http://rest"]} == summaries[0][4]
+    snmp.close()
+    http.close()
+
+
+def test_unusable_state_file_sends_unsuppressed(tmpdir):
+    class Args(object):
+        suppress_state_file = str(tmpdir.join("missing", "state.db"))
+        suppress_patterns_file = None
+        suppress_window = 300
+
+    assert notification_suppressor.suppressor_from_args(Args, "http") is None
+
+    suppressor = notification_suppressor.NotificationSuppressor(
+        str(tmpdir.join("state.db")), "http")
+    # as a state file that turned unwritable or stayed locked does
+    suppressor.connection.close()
+    assert (True, []) == notification_suppressor.check_notification(
+        suppressor, "node-1", "Service_nova-compute", 2,
+        "nova-compute stop/waiting")
@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+# Copyright 2017 The Openstack-Helm Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import math
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..',
+                                'plugins'))
+
+from prometheus_exposition import iter_samples  # noqa: E402
+
+EXPOSITION = b"""# HELP go_info Information about the Go environment.
+# TYPE go_info gauge
+go_info{version="go1.9.1"} 1
+# HELP ceph_health_status Cluster health status
+# TYPE ceph_health_status untyped
+ceph_health_status{cluster="ceph one",note="say \\"hi\\", then\\\\leave"} 2 1500000000000
+# HELP ceph_osd_latency OSD latency
+# TYPE ceph_osd_latency histogram
+ceph_osd_latency_bucket{le="+Inf"} 4
+ceph_osd_latency_sum NaN
+ceph_osd_latency_count 4
+node_load1 0.5
+""".splitlines()
+
+
+def test_labels_with_spaces_escapes_and_timestamps():
+    samples = list(iter_samples(EXPOSITION, ['ceph_health_status']))
+    assert 1 == len(samples)
+    sample = samples[0]
+    assert {"cluster": "ceph one", "note": 'say "hi", then\\leave'} == sample.labels
+    assert 2.0 == sample.value
+    assert 1500000000000 == sample.timestamp
+
+
+def test_family_includes_suffixed_samples():
+    samples = list(iter_samples(EXPOSITION, ['ceph_osd_latency']))
+    assert ['ceph_osd_latency_bucket', 'ceph_osd_latency_sum',
+            'ceph_osd_latency_count'] == [sample.name for sample in samples]
+    assert {"le": "+Inf"} == samples[0].labels
+    assert math.isnan(samples[1].value)
+
+
+def test_stops_reading_once_family_is_complete():
+    consumed = []
+
+    def lines():
+        for line in EXPOSITION:
+            consumed.append(line)
+            yield line
+
+    samples = list(iter_samples(lines(), ['go_info']))
+    assert ['go_info{version="go1.9.1"}'] == [sample.series for sample in samples]
+    assert len(consumed) < len(EXPOSITION)
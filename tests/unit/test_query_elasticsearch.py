@@ -0,0 +1,155 @@
+#!/usr/bin/env python
+# Copyright 2017 The Openstack-Helm Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import argparse
+import datetime
+import json
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..', 'plugins'))
+
+import query_elasticsearch  # noqa: E402
+
+EPOCH = datetime.datetime(1970, 1, 1)
+
+
+class FakeElasticsearch(object):
+    """answers per minute histogram searches from a list of document times"""
+
+    def __init__(self, documents):
+        self.documents = documents
+        self.ranges = []
+
+    def post(self, url, data=None, **kwargs):
+        params = json.loads(data)['params']
+        gte = datetime.datetime.strptime(params['gte_timestamp'],
+                                         '%Y-%m-%dT%H:%M:%S')
+        lt = datetime.datetime.strptime(params['lt_timestamp'],
+                                        '%Y-%m-%dT%H:%M:%S')
+        self.ranges.append((gte, lt))
+        counts = {}
+        for document in self.documents:
+            if gte <= document < lt:
+                minute = int((document - EPOCH).total_seconds()) // 60
+                counts[minute] = counts.get(minute, 0) + 1
+        return FakeResponse({
+            '_shards': {'failed': 0}, 'timed_out': False,
+            'aggregations': {'per_minute': {'buckets': [
+                {'key': minute * 60000, 'doc_count': count}
+                for minute, count in sorted(counts.items())]}}})
+
+
+class FakeResponse(object):
+
+    def __init__(self, body):
+        self.status_code = 200
+        self.text = json.dumps(body)
+        self.body = body
+
+    def json(self):
+        return self.body
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser()
+    query_elasticsearch.setup_argparse(parser)
+    return parser.parse_args(argv)
+
+
+def test_incremental_counts_match_full_range_counts(tmpdir, monkeypatch):
+    start = datetime.datetime(2017, 1, 1, 10, 0)
+    documents = [start + datetime.timedelta(seconds=seconds)
+                 for seconds in range(0, 3 * 3600, 7)]
+    elasticsearch = FakeElasticsearch(documents)
+    monkeypatch.setattr(query_elasticsearch.requests, 'post',
+                        elasticsearch.post)
+    args = parse_args(['http://es:9200', 'logstash', 'fluentd', 'ok',
+                       'critical', '100000', '--range', '60',
+                       '--incremental', '--time_granularity', '60',
+                       '--state_dir', str(tmpdir)])
+
+    for minutes in (61, 62, 63, 70, 200):
+        now = start + datetime.timedelta(minutes=minutes, seconds=30)
+        status, message = query_elasticsearch.evaluate_incremental(args, now)
+        lt = start + datetime.timedelta(minutes=minutes)
+        expected = len([document for document in documents
+                        if lt - datetime.timedelta(minutes=60) <= document < lt])
+        with open(query_elasticsearch.get_state_file(
+                args, lt, lt - datetime.timedelta(minutes=60))[0]) as state:
+            counted = sum(json.load(state)['data']['minutes'].values())
+        assert expected == counted
+
+    gte_62, lt_62 = elasticsearch.ranges[1]
+    assert datetime.timedelta(minutes=3) == lt_62 - gte_62
+    gte_200, lt_200 = elasticsearch.ranges[-1]
+    assert datetime.timedelta(minutes=60) == lt_200 - gte_200
+
+
+def test_group_by_applies_threshold_per_value():
+    args = parse_args(['http://es:9200', 'logstash', 'fluentd', 'ok',
+                       'errors found', '5', '--count_only',
+                       '--group_by', 'kubernetes.host', '--group_size', '50',
+                       '--groups', 'node-1,node-3'])
+    now = datetime.datetime(2017, 1, 1, 12, 0)
+    data = query_elasticsearch.build_terms_template(
+        args, now, now - datetime.timedelta(minutes=5))
+    assert 0 == data['inline']['size']
+    assert 'terminate_after' not in data['inline']
+    assert {'field': 'kubernetes.host', 'size': 50} == \
+        data['inline']['aggs']['groups']['terms']
+
+    group_counts = query_elasticsearch.get_group_counts(
+        {'aggregations': {'groups': {'buckets': [
+            {'key': 'node-2', 'doc_count': 9},
+            {'key': 'node-1', 'doc_count': 3}]}}})
+    statuses = query_elasticsearch.get_group_statuses(args, group_counts)
+    assert ['node-2', 'node-1', 'node-3'] == [value for value, s, m in statuses]
+    assert 'critical' == statuses[0][1]
+    assert 'Found 9 >= 5(threshold)' in statuses[0][2]
+    assert ('node-1', 'ok', 'ok') == statuses[1]
+    assert ('node-3', 'ok', 'ok') == statuses[2]
+
+
+def test_count_stopped_at_the_threshold_is_reported_as_at_least():
+    args = parse_args(['http://es:9200', 'logstash', 'fluentd', 'ok',
+                       'errors found', '5', '--count_only'])
+    now = datetime.datetime(2017, 1, 1, 12, 0)
+    data = query_elasticsearch.build_search_template(
+        args, now, now - datetime.timedelta(minutes=5))
+    assert 5 == data['inline']['terminate_after']
+
+    status, message = query_elasticsearch.get_status(
+        {'hits': {'total': 5}, 'terminated_early': True}, args)
+    assert 'critical' == status
+    assert message.startswith('Found at least 5 >= 5(threshold)')
+    status, message = query_elasticsearch.get_status(
+        {'hits': {'total': {'value': 5, 'relation': 'gte'}}}, args)
+    assert message.startswith('Found at least 5 >= 5(threshold)')
+    status, message = query_elasticsearch.get_status(
+        {'hits': {'total': 7}, 'terminated_early': False}, args)
+    assert message.startswith('Found 7 >= 5(threshold)')
+    assert ('ok', 'ok') == query_elasticsearch.get_status(
+        {'hits': {'total': 4}}, args)
+
+
+def test_time_granularity_requires_a_cacheable_search(capsys):
+    with pytest.raises(SystemExit) as exit_info:
+        query_elasticsearch.main(['http://es:9200', 'logstash', 'fluentd',
+                                  'ok', 'critical', '5',
+                                  '--time_granularity', '60'])
+    assert 2 == exit_info.value.code
+    assert '--time_granularity requires --count_only' in capsys.readouterr()[1]
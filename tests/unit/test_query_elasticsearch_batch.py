@@ -0,0 +1,148 @@
+#!/usr/bin/env python
+# Copyright 2017 The Openstack-Helm Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import json
+import os
+import subprocess
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..', 'plugins'))
+
+import query_elasticsearch_batch  # noqa: E402
+
+
+class FakeResponse(object):
+
+    def __init__(self, body):
+        self.status_code = 200
+        self.text = json.dumps(body)
+        self.body = body
+
+    def json(self):
+        return self.body
+
+
+def test_msearch_responses_map_back_to_their_checks():
+    definitions = [
+        {"index": "logstash", "index_type": "fluentd", "ok_msg": "no errors",
+         "critical_msg": "errors found", "critical_threshold": 5,
+         "match": "level:ERROR", "range": 10},
+        {"index": "logstash", "index_type": "fluentd", "ok_msg": "quiet",
+         "critical_msg": "noisy", "critical_threshold": 1},
+        {"index": "missing", "index_type": "fluentd", "ok_msg": "ok",
+         "critical_msg": "critical", "critical_threshold": 1}]
+    checks = [query_elasticsearch_batch.parse_definition(
+        "http://es:9200", definition, True) for definition in definitions]
+    body = query_elasticsearch_batch.build_msearch_body(
+        checks, query_elasticsearch_batch.datetime.datetime(2017, 1, 1, 0, 5))
+    lines = body.splitlines()
+    assert 6 == len(lines)
+    header = json.loads(lines[0])
+    assert "logstash-2017.01.01,logstash-2016.12.31" == header["index"]
+    assert header["ignore_unavailable"]
+    assert 0 == json.loads(lines[1])["inline"]["size"]
+
+    results = query_elasticsearch_batch.evaluate_responses(checks, FakeResponse(
+        {"responses": [{"hits": {"total": 7}},
+                       {"hits": {"total": 0}},
+                       {"error": "index_not_found"}]}))
+    assert "critical" == results[0][0]
+    assert "Found 7 >= 5(threshold) occurrences" in results[0][1]
+    assert ("ok", "quiet") == results[1]
+    assert "unknown" == results[2][0]
+
+
+def test_unreachable_elasticsearch_submits_unknown_for_every_check(tmpdir):
+    definitions_file = tmpdir.join("definitions.json")
+    definitions_file.write(json.dumps([
+        {"service_description": "Logs_nova_errors", "index": "logstash",
+         "index_type": "fluentd", "ok_msg": "ok", "critical_msg": "critical",
+         "critical_threshold": 5, "match": "application:nova"},
+        {"host_name": "other-host", "service_description": "Logs_glance_errors",
+         "index": "logstash", "index_type": "fluentd", "ok_msg": "ok",
+         "critical_msg": "critical", "critical_threshold": 5}]))
+    command_file = tmpdir.join("nagios.cmd")
+    command_file.write("")
+    command = [
+        "plugins/query_elasticsearch_batch.py",
+        "http://test.nowhere.com:9200",
+        str(definitions_file),
+        "--command_file",
+        str(command_file),
+        "--host_name",
+        "elasticsearch"]
+    p = subprocess.Popen(
+        command,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        shell=False)
+    out, err = p.communicate()
+    assert 0 == p.returncode
+    lines = command_file.read().splitlines()
+    assert 2 == len(lines)
+    assert "PROCESS_SERVICE_CHECK_RESULT;elasticsearch;Logs_nova_errors;3;Unexpected Error Occurred." in lines[0]
+    assert "PROCESS_SERVICE_CHECK_RESULT;other-host;Logs_glance_errors;3;" in lines[1]
+
+
+def test_missing_stored_templates_are_found_per_check():
+    definitions = [
+        {"index": "logstash", "index_type": "fluentd", "ok_msg": "ok",
+         "critical_msg": "critical", "critical_threshold": 5},
+        {"index": "logstash", "index_type": "fluentd", "ok_msg": "ok",
+         "critical_msg": "critical", "critical_threshold": 5,
+         "match": "level:ERROR"}]
+    checks = [query_elasticsearch_batch.parse_definition(
+        "http://es:9200", definition, False, True) for definition in definitions]
+    stored_templates = []
+    body = query_elasticsearch_batch.build_msearch_body(
+        checks, query_elasticsearch_batch.datetime.datetime(2017, 1, 1),
+        stored_templates)
+    search = json.loads(body.splitlines()[1])
+    assert "inline" not in search
+    assert stored_templates[0][0] == search["id"]
+    assert search["id"].startswith("nagios-query-")
+    assert stored_templates[0][0] != stored_templates[1][0]
+
+    missing = query_elasticsearch_batch.get_missing_templates(FakeResponse(
+        {"responses": [{"hits": {"total": 0}},
+                       {"error": {"type": "resource_not_found_exception",
+                                  "reason": "unable to find script"}}]}),
+        stored_templates)
+    assert set([stored_templates[1]]) == missing
+
+
+def test_time_granularity_aligns_windows_and_enables_request_cache():
+    definition = {"index": "logstash", "index_type": "fluentd", "ok_msg": "ok",
+                  "critical_msg": "critical", "critical_threshold": 5,
+                  "range": 5, "time_granularity": 60}
+    checks = [query_elasticsearch_batch.parse_definition(
+        "http://es:9200", definition, True)]
+    bodies = [query_elasticsearch_batch.build_msearch_body(
+        checks, query_elasticsearch_batch.datetime.datetime(
+            2017, 1, 1, 0, 5, second, microsecond))
+        for second, microsecond in ((0, 0), (12, 345), (59, 999999))]
+    assert bodies[0] == bodies[1] == bodies[2]
+    header, search = [json.loads(line) for line in bodies[0].splitlines()]
+    assert header["request_cache"]
+    assert "2017-01-01T00:05:00" == search["params"]["lt_timestamp"]
+    assert "2017-01-01T00:00:00" == search["params"]["gte_timestamp"]
+
+    definition["count_only"] = False
+    try:
+        query_elasticsearch_batch.parse_definition("http://es:9200", definition,
+                                                   False)
+    except ValueError as ex:
+        assert "time_granularity requires count_only" in str(ex)
+    else:
+        assert False, "a definition without count_only was accepted"
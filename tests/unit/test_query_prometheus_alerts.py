@@ -12,7 +12,29 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
+import json
 import subprocess
+import time
+
+try:
+    from urllib.parse import parse_qs
+    from urllib.parse import urlparse
+except ImportError:
+    from urlparse import parse_qs
+    from urlparse import urlparse
+
+from tests.unit.stub_http import serve
+from tests.unit.stub_http import StubHandler
+
+
+def run(*options):
+    p = subprocess.Popen(
+        ["plugins/query_prometheus_alerts.py"] + list(options),
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        shell=False)
+    out, err = p.communicate()
+    return p.returncode, out.decode('utf-8'), err.decode('utf-8')
 
 
 def test_usage():
@@ -46,3 +68,153 @@ def test_invalid_prometheus_api_location_results_nagios_unknown():
     assert "Unknown: unable to query prometheus alerts" in str(
         out)
     assert 3 == p.returncode
+
+
+def test_cached_snapshot_is_filtered_locally(tmpdir):
+    cache_file = tmpdir.join("alerts_snapshot.json")
+    alert = {"metric": {"__name__": "ALERTS",
+                        "alertname": "statefulset_replicas_unavailable",
+                        "alertstate": "firing",
+                        "statefulset": "prometheus"},
+             "value": [0, "1"]}
+    other = {"metric": {"__name__": "ALERTS",
+                        "alertname": "statefulset_replicas_unavailable",
+                        "alertstate": "firing",
+                        "statefulset": "alertmanager"},
+             "value": [0, "1"]}
+    cache_file.write(json.dumps({
+        "fetched_at": time.time(),
+        "data": {"status": "success",
+                 "data": {"resultType": "vector",
+                          "result": [alert, other]}}}))
+    command = [
+        "plugins/query_prometheus_alerts.py",
+        "--prometheus_api",
+        "test.nowhere.com:9090",
+        "--alertname",
+        "statefulset_replicas_unavailable",
+        "--labels_csv",
+        'statefulset="prometheus"',
+        "--msg_format",
+        "statefulset {statefulset} has low replica count",
+        "--cache_ttl",
+        "300",
+        "--cache_file",
+        str(cache_file)]
+    p = subprocess.Popen(
+        command,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        shell=False)
+    out, err = p.communicate()
+    assert "statefulset prometheus has low replica count" in str(out)
+    assert "alertmanager" not in str(out)
+    assert 2 == p.returncode
+
+
+class FusedHandler(StubHandler):
+    """answers the fused query as prometheus would with kube_pod_info
+    present and node_load1 absent, keeping the queries it was asked"""
+    queries = []
+    alerts = []
+
+    def do_GET(self):
+        query = parse_qs(urlparse(self.path).query)['query'][0]
+        FusedHandler.queries.append(query)
+        result = [{'metric': dict(alert, nagios_part='alerts'),
+                   'value': [0, '1']} for alert in FusedHandler.alerts]
+        result.append({'metric': {'nagios_part': 'absent',
+                                  'nagios_metric': 'node_load1'},
+                       'value': [0, '1']})
+        self.reply({'status': 'success',
+                    'data': {'resultType': 'vector', 'result': result}})
+
+
+def test_fused_query_reports_alerts_and_missing_metrics():
+    options = ["--alertname", "node_down", "--labels_csv", 'job="node"',
+               "--msg_format", "node {instance} is down",
+               "--metrics_csv", "kube_pod_info,node_load1", "--fused_query"]
+    server, address = serve(FusedHandler)
+    try:
+        missing = run("--prometheus_api", address, *options)
+        FusedHandler.alerts = [{'__name__': 'ALERTS', 'alertname': 'node_down',
+                                'alertstate': 'firing', 'job': 'node',
+                                'instance': 'node-1'}]
+        firing = run("--prometheus_api", address, *options)
+    finally:
+        server.shutdown()
+    # one request per check, absent() tagged per metric
+    assert 2 == len(FusedHandler.queries)
+    assert '"nagios_metric", "node_load1"' in FusedHandler.queries[0]
+    assert 'absent(kube_pod_info{job="node"})' in FusedHandler.queries[0]
+    assert (3, "UNKNOWN: no metrics available to evaluate alert. Please"
+               " ensure following metrics are flowing to the system:"
+               " node_load1\n", "") == missing
+    assert (2, "node node-1 is down\n", "") == firing
+
+
+def test_fused_query_is_rejected_where_it_would_be_ignored():
+    options = ["--prometheus_api", "test.nowhere.com:9090",
+               "--alertname", "node_down", "--msg_format", "down",
+               "--fused_query"]
+    code, out, err = run(*options)
+    assert 2 == code
+    assert "--fused_query requires --metrics_csv" in err
+    for other in (["--cache_ttl", "30"], ["--source", "rules_api"]):
+        code, out, err = run(*(options + ["--metrics_csv", "up"] + other))
+        assert 2 == code
+        assert "--fused_query can not be used with --cache_ttl" in err
+
+
+class RulesApiHandler(StubHandler):
+    """answers /api/v1/alerts with a firing and a pending alert of the
+    prometheus statefulset and a firing one of alertmanager, keeping the
+    paths it was asked"""
+    paths = []
+
+    def do_GET(self):
+        RulesApiHandler.paths.append(urlparse(self.path).path)
+        if urlparse(self.path).path != '/api/v1/alerts':
+            self.reply({'status': 'error', 'error': 'not the rules API'}, 400)
+            return
+        self.reply({'status': 'success', 'data': {'alerts': [
+            {'labels': {'alertname': 'replicas_unavailable',
+                        'statefulset': statefulset, 'pod': pod},
+             'annotations': {}, 'state': state, 'value': '1'}
+            for statefulset, pod, state in (
+                ('prometheus', 'prometheus-0', 'firing'),
+                ('prometheus', 'prometheus-1', 'pending'),
+                ('alertmanager', 'alertmanager-0', 'firing'))]}})
+
+
+def test_rules_api_source_filters_labels_and_pending_alerts(tmpdir):
+    options = ["--alertname", "replicas_unavailable",
+               "--msg_format", "{statefulset} pod {pod} is unavailable",
+               "--source", "rules_api"]
+    server, address = serve(RulesApiHandler)
+    try:
+        direct = run("--prometheus_api", address, "--labels_csv",
+                     'statefulset="prometheus"', *options)
+        regex = run("--prometheus_api", address, "--labels_csv",
+                    'statefulset=~"alert.*"', *options)
+        none = run("--prometheus_api", address, "--labels_csv",
+                   'statefulset="thanos"', *options)
+        cached = run("--prometheus_api", address, "--labels_csv",
+                     'statefulset="prometheus"', "--cache_ttl", "30",
+                     "--cache_file", str(tmpdir.join("snapshot.json")),
+                     *options)
+        # a selector that is not evaluated locally is not sent as an
+        # ALERTS query either
+        unparsed = run("--prometheus_api", address, "--labels_csv",
+                       'statefulset', "--cache_ttl", "30",
+                       "--cache_file", str(tmpdir.join("snapshot.json")),
+                       *options)
+    finally:
+        server.shutdown()
+    assert (2, "prometheus pod prometheus-0 is unavailable\n", "") == direct
+    assert (2, "alertmanager pod alertmanager-0 is unavailable\n", "") == regex
+    assert 0 == none[0]
+    assert direct == cached
+    assert 3 == unparsed[0]
+    assert "unable to parse label matchers" in unparsed[1]
+    assert set(RulesApiHandler.paths) == set(['/api/v1/alerts'])
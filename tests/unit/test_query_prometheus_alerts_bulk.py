@@ -0,0 +1,150 @@
+#!/usr/bin/env python
+# Copyright 2017 The Openstack-Helm Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import json
+import os
+import subprocess
+import sys
+
+try:
+    from urllib.parse import parse_qs
+    from urllib.parse import urlparse
+except ImportError:
+    from urlparse import parse_qs
+    from urlparse import urlparse
+
+from tests.unit.stub_http import serve
+from tests.unit.stub_http import StubHandler
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..', 'plugins'))
+
+import query_prometheus_alerts_bulk as bulk  # noqa: E402
+from query_prometheus_alerts import parse_label_matchers  # noqa: E402
+
+FIRING = [
+    {'metric': {'alertname': 'node_down', 'alertstate': 'firing',
+                'instance': 'node-1', 'job': 'node-exporter'}},
+    {'metric': {'alertname': 'node_down', 'alertstate': 'firing',
+                'instance': 'node-2', 'job': 'node-exporter'}},
+    {'metric': {'alertname': 'node_down', 'alertstate': 'firing',
+                'instance': 'node-3', 'job': 'kubelet'}},
+    {'metric': {'alertname': 'disk_full', 'alertstate': 'firing',
+                'instance': 'node-1'}}]
+
+
+class AlertsHandler(StubHandler):
+    """answers the ALERTS query with FIRING, and absent() queries as if
+    only metrics named missing_* were absent"""
+
+    def do_GET(self):
+        query = parse_qs(urlparse(self.path).query)['query'][0]
+        if query.startswith('ALERTS'):
+            result = FIRING
+        elif 'absent(missing_' in query:
+            result = [{'metric': {}, 'value': [0, '1']}]
+        else:
+            result = []
+        self.reply({'status': 'success',
+                    'data': {'resultType': 'vector', 'result': result}})
+
+
+def test_unreachable_prometheus_submits_unknown_for_every_service(tmpdir):
+    definitions_file = tmpdir.join("definitions.json")
+    definitions_file.write(json.dumps([
+        {"service_description": "Prometheus_replica-count",
+         "alertname": "statefulset_replicas_unavailable",
+         "labels_csv": 'statefulset="prometheus"',
+         "msg_format": "statefulset {statefulset} has low replica count"},
+        {"host_name": "other-host",
+         "service_description": "Node_load",
+         "alertname": "node_load1_90percent",
+         "msg_format": "node {instance} is under heavy load"}]))
+    command_file = tmpdir.join("nagios.cmd")
+    command_file.write("")
+    command = [
+        "plugins/query_prometheus_alerts_bulk.py",
+        "--prometheus_api",
+        "test.nowhere.com:9090",
+        "--definitions_file",
+        str(definitions_file),
+        "--command_file",
+        str(command_file),
+        "--host_name",
+        "prometheus-hosts"]
+    p = subprocess.Popen(
+        command,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        shell=False)
+    out, err = p.communicate()
+    assert 0 == p.returncode
+    lines = command_file.read().splitlines()
+    assert 2 == len(lines)
+    assert "PROCESS_SERVICE_CHECK_RESULT;prometheus-hosts;Prometheus_replica-count;3;Unknown: unable to query prometheus alerts" in lines[0]
+    assert "PROCESS_SERVICE_CHECK_RESULT;other-host;Node_load;3;" in lines[1]
+
+
+def test_alert_index_selects_like_label_matchers():
+    index = bulk.AlertIndex(FIRING)
+
+    def instances(alertname, labels_csv):
+        return [series['metric']['instance'] for series in index.select(
+            alertname, parse_label_matchers(labels_csv))]
+
+    assert ['node-1', 'node-2', 'node-3'] == instances('node_down', None)
+    assert ['node-1', 'node-2'] == instances(
+        'node_down', 'job="node-exporter"')
+    assert ['node-2'] == instances(
+        'node_down', 'job="node-exporter",instance=~"node-[2-9]"')
+    assert ['node-3'] == instances('node_down', 'job!="node-exporter"')
+    # a missing label is the empty string
+    assert ['node-1'] == instances('disk_full', 'job=""')
+    assert [] == instances('disk_full', 'instance="node-2"')
+    assert [] == instances('node_up', None)
+
+
+def test_definitions_are_evaluated_one_by_one(tmpdir):
+    definitions_file = tmpdir.join("definitions.json")
+    definitions_file.write(json.dumps([
+        {"service_description": "Node_down",
+         "alertname": "node_down", "labels_csv": 'job="node-exporter"',
+         "msg_format": "node {instance} is down"},
+        {"service_description": "Node_up",
+         "alertname": "node_up", "msg_format": "node {instance} is up",
+         "metrics_csv": "up"},
+        {"service_description": "Node_missing_metrics",
+         "alertname": "node_up", "msg_format": "node {instance} is up",
+         "ok_message": "OK: all nodes are up",
+         "metrics_csv": "missing_up"},
+        {"service_description": "Disk_full",
+         "alertname": "disk_full", "msg_format": "disk {device} is full"}]))
+    definitions = bulk.load_definitions(str(definitions_file), "hosts")
+    server, address = serve(AlertsHandler)
+    try:
+        results = bulk.evaluate_definitions(address, definitions)
+    finally:
+        server.shutdown()
+    assert [
+        ("hosts", "Node_down", 2, "node node-1 is down,node node-2 is down"),
+        ("hosts", "Node_up", 0, "OK: no alerts with prometheus"
+                                " alertname=node_up"),
+        ("hosts", "Node_missing_metrics", 3,
+         "UNKNOWN: no metrics available to evaluate alert. Please ensure"
+         " following metrics are flowing to the system: missing_up")] == \
+        results[:3]
+    # the msg_format names a label the alert does not have
+    host_name, service_description, state, output = results[3]
+    assert 3 == state
+    assert output.startswith("Unknown: unable to evaluate alert disk_full.")
+    assert "device" in output
@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+# Copyright 2017 The Openstack-Helm Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import os
+import socket
+import subprocess
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..', 'plugins'))
+
+import send_snmp_trap  # noqa: E402
+
+
+def test_ber_encoding():
+    assert b'\x02\x01\x00' == bytes(send_snmp_trap.encode_integer(0))
+    assert b'\x02\x02\x00\x80' == bytes(send_snmp_trap.encode_integer(128))
+    assert b'\x02\x01\xff' == bytes(send_snmp_trap.encode_integer(-1))
+    assert b'\x43\x05\x00\xff\xff\xff\xff' == bytes(
+        send_snmp_trap.encode_integer(0xffffffff, send_snmp_trap.TIMETICKS))
+    assert b'\x06\x08\x2b\x06\x01\x04\x01\x81\x9c\x26' == bytes(
+        send_snmp_trap.encode_oid('1.3.6.1.4.1.20006'))
+    assert b'\x82\x01\x2c' == bytes(send_snmp_trap.encode_length(300))
+
+
+def send(command):
+    collector = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    collector.bind(('127.0.0.1', 0))
+    collector.settimeout(5)
+    target = '127.0.0.1:{}'.format(collector.getsockname()[1])
+    subprocess.check_call(command + ['--primary_target', target])
+    try:
+        return collector.recv(65535)
+    finally:
+        collector.close()
+
+
+def test_service_trap_is_sent_directly_and_by_the_resident_sender(tmpdir):
+    command = ["plugins/send_snmp_trap.py", "--type", "service",
+               "--community", "public", "--hostname", "node-1",
+               "--servicedesc", "Service_nova-compute", "--state_id", "2",
+               "--output", "nova-compute stop/waiting"]
+    expected = [send_snmp_trap.encode_octet_string('public'),
+                send_snmp_trap.encode_oid('1.3.6.1.4.1.20006.1.7'),
+                send_snmp_trap.encode_oid('1.3.6.1.4.1.20006.1.3.1.17')
+                + send_snmp_trap.encode_octet_string(
+                    'nova-compute stop/waiting')]
+
+    trap = send(command)
+    assert all(bytes(part) in trap for part in expected)
+
+    socket_path = str(tmpdir.join("snmp_trap.sock"))
+    server = subprocess.Popen(
+        ["plugins/send_snmp_trap.py", "--serve", "--socket", socket_path])
+    try:
+        for _ in range(50):
+            if os.path.exists(socket_path):
+                break
+            time.sleep(0.1)
+        trap = send(command + ["--socket", socket_path])
+    finally:
+        server.kill()
+        server.wait()
+    assert all(bytes(part) in trap for part in expected)
+
+
+def test_service_trap_is_sent_when_the_state_file_is_unusable(tmpdir):
+    trap = send(["plugins/send_snmp_trap.py", "--type", "service",
+                 "--community", "public", "--hostname", "node-1",
+                 "--servicedesc", "Service_nova-compute", "--state_id", "2",
+                 "--output", "nova-compute stop/waiting",
+                 "--suppress_state_file",
+                 str(tmpdir.join("missing", "state.db"))])
+    assert bytes(send_snmp_trap.encode_octet_string(
+        'nova-compute stop/waiting')) in trap
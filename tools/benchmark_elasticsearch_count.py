@@ -0,0 +1,173 @@
+#!/usr/bin/env python3
+# Copyright 2017 The Openstack-Helm Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# Compares the default search of query_elasticsearch.py (size 10) with
+# --count_only (size 0, terminate_after threshold, filter_path=hits.total)
+# by response payload and client latency.
+#
+# tools/benchmark_elasticsearch_count.py --documents 200000 --threshold 10
+#
+# Without --endpoint a local elasticsearch stand-in is started. It counts
+# matches by scanning its --documents synthetic log documents per shard,
+# honouring terminate_after, and returns up to size documents of about
+# 1KB each together with hits.total.
+import argparse
+import datetime
+import json
+import os
+import sys
+import threading
+import time
+
+from http.server import BaseHTTPRequestHandler
+from http.server import ThreadingHTTPServer
+from urllib.parse import parse_qs
+from urllib.parse import urlparse
+
+import requests
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'plugins'))
+
+import query_elasticsearch  # noqa: E402
+
+SHARDS = 5
+
+
+class StubElasticsearch(object):
+
+    def __init__(self, documents, matching_every):
+        self.shards = []
+        for shard in range(SHARDS):
+            self.shards.append([
+                {'@timestamp': '2017-01-01T00:00:00',
+                 'message': 'line {} {}'.format(i, 'x' * 900),
+                 'matches': i % matching_every == 0}
+                for i in range(shard, documents, SHARDS)])
+
+    def search(self, body, filter_path):
+        inline = body['inline']
+        size = inline.get('size', 10)
+        terminate_after = inline.get('terminate_after')
+        total = 0
+        hits = []
+        for shard in self.shards:
+            shard_total = 0
+            for document in shard:
+                if not document['matches']:
+                    continue
+                shard_total += 1
+                if len(hits) < size:
+                    hits.append({'_index': 'logstash', '_type': 'log',
+                                 '_source': document})
+                if terminate_after and shard_total >= terminate_after:
+                    break
+            total += shard_total
+        if filter_path == 'hits.total':
+            return {'hits': {'total': total}}
+        return {'took': 1, 'timed_out': False,
+                '_shards': {'total': SHARDS, 'successful': SHARDS, 'failed': 0},
+                'hits': {'total': total, 'max_score': 1.0, 'hits': hits}}
+
+    def serve(self):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+
+            def do_POST(self):
+                url = urlparse(self.path)
+                length = int(self.headers.get('Content-Length', 0))
+                request = json.loads(self.rfile.read(length).decode('utf-8'))
+                filter_path = parse_qs(url.query).get('filter_path', [None])[0]
+                body = json.dumps(stub.search(request, filter_path)).encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return 'http://127.0.0.1:{}'.format(server.server_port)
+
+
+def run(endpoint, index, count_only, threshold, iterations):
+    parser = argparse.ArgumentParser()
+    query_elasticsearch.setup_argparse(parser)
+    argv = [endpoint, index, 'log', 'ok', 'critical', str(threshold),
+            '--match', 'level:ERROR']
+    if count_only:
+        argv.append('--count_only')
+    args = parser.parse_args(argv)
+
+    latencies = []
+    payload = 0
+    status = None
+    session = requests.Session()
+    for _ in range(iterations):
+        started = time.time()
+        lt = datetime.datetime.utcnow()
+        gte = lt - datetime.timedelta(minutes=args.range)
+        data = query_elasticsearch.build_search_template(args, lt, gte)
+        url = (endpoint + '/' + query_elasticsearch.get_index_name(args, lt, gte)
+               + '/log/_search/template/?ignore_unavailable=true')
+        if count_only:
+            url += '&filter_path=hits.total'
+        response = session.post(url, data=json.dumps(data),
+                                headers={'Content-Type': 'application/json'})
+        status, message = query_elasticsearch.get_status(response.json(), args)
+        latencies.append(time.time() - started)
+        payload = len(response.content)
+    latencies.sort()
+    return {'mode': 'count_only' if count_only else 'search',
+            'p50_ms': latencies[len(latencies) // 2] * 1000,
+            'p95_ms': latencies[int(len(latencies) * 0.95) - 1] * 1000,
+            'payload_bytes': payload,
+            'status': status}
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Benchmark query_elasticsearch.py --count_only')
+    parser.add_argument('--endpoint', type=str,
+                        help='Benchmark a real elasticsearch instead of the stand-in')
+    parser.add_argument('--index', type=str, default='logstash')
+    parser.add_argument('--documents', type=int, default=100000,
+                        help='Documents held by the stand-in')
+    parser.add_argument('--matching_every', type=int, default=10,
+                        help='One in this many stand-in documents matches')
+    parser.add_argument('--threshold', type=int, default=10)
+    parser.add_argument('--iterations', type=int, default=50)
+    args = parser.parse_args()
+
+    endpoint = args.endpoint
+    if not endpoint:
+        endpoint = StubElasticsearch(args.documents, args.matching_every).serve()
+
+    print('{:<12} {:>10} {:>10} {:>14} {:>9}'.format(
+        'mode', 'p50 ms', 'p95 ms', 'payload bytes', 'status'))
+    for count_only in (False, True):
+        result = run(endpoint, args.index, count_only, args.threshold,
+                     args.iterations)
+        print('{mode:<12} {p50_ms:>10.2f} {p95_ms:>10.2f} '
+              '{payload_bytes:>14} {status:>9}'.format(**result))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
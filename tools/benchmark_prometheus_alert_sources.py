@@ -0,0 +1,199 @@
+#!/usr/bin/env python3
+# Copyright 2017 The Openstack-Helm Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# Compares the ALERTS instant query and the /api/v1/alerts rules API as the
+# alert source of query_prometheus_alerts.py. Client latency is measured per
+# check and server cost is the process_cpu_seconds_total delta read from the
+# server's own /metrics, so the same numbers can be taken from a real
+# Prometheus with --prometheus_api.
+#
+# tools/benchmark_prometheus_alert_sources.py --alerts 2000 --iterations 200
+#
+# Without --prometheus_api a local stub server is started. It keeps a store
+# of --series synthetic series and answers instant queries by scanning it for
+# the selector, the way a query touches storage, while the rules API returns
+# its alert list directly. The stub runs in a process of its own, so the
+# CPU time its /metrics reports is spent serving the checks only.
+import argparse
+import json
+import multiprocessing
+import os
+import re
+import sys
+import time
+
+from http.server import BaseHTTPRequestHandler
+from http.server import HTTPServer
+from urllib.parse import parse_qs
+from urllib.parse import urlparse
+
+import requests
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'plugins'))
+
+import query_prometheus_alerts  # noqa: E402
+
+SELECTOR = re.compile(r'^(\w+)\{(.*)\}$')
+
+
+class StubPrometheus(object):
+
+    def __init__(self, alerts, series):
+        self.alerts = []
+        self.store = []
+        for i in range(alerts):
+            labels = {'alertname': 'alert_{}'.format(i % 50),
+                      'instance': 'host-{}:9100'.format(i),
+                      'severity': 'page'}
+            state = 'firing' if i % 3 else 'pending'
+            self.alerts.append({'labels': labels, 'annotations': {},
+                                'state': state, 'value': 1})
+            series_labels = dict(labels, __name__='ALERTS', alertstate=state)
+            self.store.append(series_labels)
+        for i in range(series):
+            self.store.append({'__name__': 'node_load1',
+                               'instance': 'host-{}:9100'.format(i)})
+
+    def instant_query(self, promql):
+        match = SELECTOR.match(promql.strip())
+        if match:
+            name = match.group(1)
+            matchers = query_prometheus_alerts.parse_label_matchers(
+                match.group(2))
+        else:
+            name, matchers = promql.strip(), []
+        result = [{'metric': labels, 'value': [time.time(), '1']}
+                  for labels in self.store
+                  if labels['__name__'] == name and
+                  query_prometheus_alerts.labels_match(labels, matchers)]
+        return {'status': 'success',
+                'data': {'resultType': 'vector', 'result': result}}
+
+    def rules_api(self):
+        return {'status': 'success', 'data': {'alerts': self.alerts}}
+
+    def start(self):
+        """serve the stub from a child process, return its url and the
+        process"""
+        ports = multiprocessing.Queue()
+        process = multiprocessing.Process(target=self.serve, args=(ports,))
+        process.daemon = True
+        process.start()
+        return 'http://127.0.0.1:{}'.format(ports.get(timeout=60)), process
+
+    def serve(self, ports):
+        """run in the child process, put the listening port on ports"""
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+
+            def do_GET(self):
+                url = urlparse(self.path)
+                if url.path == '/api/v1/query':
+                    body = json.dumps(stub.instant_query(
+                        parse_qs(url.query)['query'][0]))
+                elif url.path == '/api/v1/alerts':
+                    body = json.dumps(stub.rules_api())
+                elif url.path == '/metrics':
+                    body = 'process_cpu_seconds_total {}\n'.format(
+                        time.process_time())
+                else:
+                    self.send_response(404)
+                    self.end_headers()
+                    return
+                body = body.encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        server = HTTPServer(('127.0.0.1', 0), Handler)
+        ports.put(server.server_port)
+        server.serve_forever()
+
+
+def server_cpu_seconds(prometheus_api):
+    response = requests.get(prometheus_api + '/metrics')
+    for line in response.text.splitlines():
+        if line.startswith('process_cpu_seconds_total'):
+            return float(line.split()[-1])
+    return float('nan')
+
+
+def run(prometheus_api, source, iterations, alertname, labels_csv):
+    latencies = []
+    cpu_before = server_cpu_seconds(prometheus_api)
+    for _ in range(iterations):
+        started = time.time()
+        if source == 'rules_api':
+            response, errors = query_prometheus_alerts.query_prometheus_rules_api(
+                prometheus_api, alertname, labels_csv)
+        else:
+            response, errors = query_prometheus_alerts.query_prometheus(
+                prometheus_api, alertname, labels_csv)
+        latencies.append(time.time() - started)
+        if errors:
+            raise RuntimeError(",".join(errors))
+    cpu = server_cpu_seconds(prometheus_api) - cpu_before
+    latencies.sort()
+    return {'source': source,
+            'p50_ms': latencies[len(latencies) // 2] * 1000,
+            'p95_ms': latencies[int(len(latencies) * 0.95) - 1] * 1000,
+            'server_cpu_ms_per_check': cpu * 1000 / iterations,
+            'firing': len(response['data']['result'])}
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Benchmark ALERTS query against /api/v1/alerts')
+    parser.add_argument('--prometheus_api', type=str,
+                        help='Benchmark a real prometheus instead of the stub')
+    parser.add_argument('--alerts', type=int, default=1000,
+                        help='Active alerts served by the stub')
+    parser.add_argument('--series', type=int, default=50000,
+                        help='Other series stored by the stub')
+    parser.add_argument('--iterations', type=int, default=100)
+    parser.add_argument('--alertname', type=str, default='alert_7')
+    parser.add_argument('--labels_csv', type=str,
+                        default='instance=~"host-1.*"')
+    args = parser.parse_args()
+
+    prometheus_api = args.prometheus_api
+    stub_process = None
+    if not prometheus_api:
+        prometheus_api, stub_process = StubPrometheus(
+            args.alerts, args.series).start()
+    prometheus_api = query_prometheus_alerts.include_schema(prometheus_api)
+
+    try:
+        print('{:<10} {:>10} {:>10} {:>24} {:>8}'.format(
+            'source', 'p50 ms', 'p95 ms', 'server cpu ms/check', 'matched'))
+        for source in ('query', 'rules_api'):
+            result = run(prometheus_api, source, args.iterations,
+                         args.alertname, args.labels_csv)
+            print('{source:<10} {p50_ms:>10.2f} {p95_ms:>10.2f} '
+                  '{server_cpu_ms_per_check:>24.3f} {firing:>8}'.format(
+                      **result))
+    finally:
+        if stub_process:
+            stub_process.terminate()
+            stub_process.join()
+
+
+if __name__ == '__main__':
+    sys.exit(main())